@@ -13,4 +13,17 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'EcoFoods.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from api.streams import ChatStreamApplication, ExportStreamApplication  # noqa: E402  (needs the app registry loaded above)
+
+chat_stream_application = ChatStreamApplication()
+export_stream_application = ExportStreamApplication()
+
+
+async def application(scope, receive, send):
+    if chat_stream_application.matches(scope):
+        return await chat_stream_application(scope, receive, send)
+    if export_stream_application.matches(scope):
+        return await export_stream_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -42,10 +42,58 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'api.backends.JWTAuth',
-    ]
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.CompactJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    # Reverse proxies in front of the app, whose X-Forwarded-For entries the login throttle
+    # trusts; with None it keys on REMOTE_ADDR only.
+    'NUM_PROXIES': None,
+}
+
+# Rendered /api/home responses, see api.cache.ResponseCache.
+# Swap the backend for 'django.core.cache.backends.filebased.FileBasedCache' with a LOCATION
+# directory to share entries between worker processes on one host.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ecofoods-responses',
+    },
 }
 
+RESPONSE_CACHE_ALIAS = 'responses'
+RESPONSE_CACHE_TIMEOUT = 300  # seconds
+
+# In-process cache of verified JWTs, see api.backends.JWTCache
+JWT_AUTH_CACHE_SIZE = 10000
+JWT_AUTH_CACHE_TTL = 300  # seconds, capped by the token's own ``exp``
+
+# Issue tokens carrying is_merchant, is_active and token_version claims, which JWTAuth accepts
+# without reading the user row; revocations (password changes, deactivations) are then checked
+# against api.backends.TokenRevocations, refreshed from the database every
+# JWT_REVOCATION_REFRESH seconds. Each refresh re-reads the last JWT_REVOCATION_OVERLAP seconds
+# as well, for transactions that committed after the previous one started.
+JWT_CLAIMS_TOKENS = False
+JWT_REVOCATION_REFRESH = 5  # seconds
+JWT_REVOCATION_OVERLAP = 60  # seconds
+
+# Upper bound on how long an open chat stream waits before re-checking the database
+# for messages written by other processes, see api.streams.ChatStreamApplication
+CHAT_STREAM_POLL_INTERVAL = 15  # seconds
+
+# Fraction of requests timed by api.middleware.PerformanceMiddleware (Server-Timing header,
+# 'api.performance' log records and the /api/metrics histograms)
+PERFORMANCE_SAMPLE_RATE = 0.05
+# Same SQL repeated this many times in one request is logged as a likely N+1
+PERFORMANCE_DUPLICATE_QUERY_THRESHOLD = 5
+
 MIDDLEWARE = [
+    'api.middleware.PerformanceMiddleware',
+    'api.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -54,6 +102,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.middleware.ReplicaRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'EcoFoods.urls'
@@ -88,9 +137,27 @@ DATABASES = {
         'PASSWORD': 'ecofoods_pass',
         'HOST': '127.0.0.1',
         'PORT': '5432',
+        # Keep connections open between requests instead of reconnecting every time
+        'CONN_MAX_AGE': 60,
     }
 }
 
+# Aliases in DATABASES of read replicas of 'default'. GET/HEAD/OPTIONS requests read from
+# one of them, round-robin over the ones that are up; see api.routers and
+# EcoFoods.settings_replica for a local setup with two SQLite databases.
+DATABASE_ROUTERS = ['api.routers.PrimaryReplicaRouter']
+DATABASE_REPLICAS = []
+# Seconds a user reads from the primary after a write of theirs, to cover the replication lag
+DATABASE_REPLICA_PIN_SECONDS = 5
+# Cache holding those pins; must be shared by all worker processes (not locmem) to hold there
+DATABASE_REPLICA_PIN_CACHE = 'default'
+# Seconds an unreachable replica is skipped before it is tried again
+DATABASE_REPLICA_RETRY_INTERVAL = 30
+
+# Worker threads, and so persistent connections, used by the async views and chat
+# streams for database access, see api.asyncdb
+DATABASE_POOL_SIZE = 20
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -111,6 +178,42 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Password hashing
+# New hashes use the first hasher; hashes from the others (or made with older parameters)
+# are upgraded on the user's next successful login. Argon2 needs argon2-cffi, bcrypt needs bcrypt.
+
+try:
+    import argon2  # noqa: F401
+    _PREFERRED_HASHERS = ['api.hashers.TunedArgon2PasswordHasher']
+except ImportError:
+    _PREFERRED_HASHERS = []
+
+PASSWORD_HASHERS = _PREFERRED_HASHERS + [
+    'api.hashers.TunedPBKDF2PasswordHasher',
+    'api.hashers.TunedBCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+]
+
+PASSWORD_HASHER_PARAMS = {
+    'argon2': {'time_cost': 2, 'memory_cost': 19456, 'parallelism': 1},
+    'bcrypt_sha256': {'rounds': 12},
+    'pbkdf2_sha256': {'iterations': 216000},
+}
+
+# Hashes computed at once, and seconds a login waits for a free worker before a 503
+PASSWORD_HASHING_WORKERS = 4
+PASSWORD_HASHING_TIMEOUT = 5
+
+# Login token buckets as (burst size, seconds to refill completely)
+LOGIN_THROTTLE_RATES = {
+    'ip': (30, 60),
+    'email': (5, 60),
+}
+LOGIN_THROTTLE_MAX_KEYS = 100000
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.1/topics/i18n/
 
@@ -129,3 +232,62 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Responses of at least this many bytes are compressed, see api.middleware.CompressionMiddleware
+RESPONSE_COMPRESSION_MIN_LENGTH = 512
+RESPONSE_COMPRESSION_GZIP_LEVEL = 5
+RESPONSE_COMPRESSION_BROTLI_QUALITY = 4
+
+
+# Uploaded files and generated image variants
+
+MEDIA_ROOT = BASE_DIR / 'media'
+MEDIA_URL = '/media/'
+
+# Variant name to bounding box; variants keep the aspect ratio of the original
+IMAGE_VARIANTS = {
+    'thumbnail': (200, 200),
+    'medium': (800, 800),
+}
+IMAGE_PIPELINE_ENABLED = True
+# Processes resizing the originals fetched by the task workers (0 resizes on the worker thread)
+IMAGE_PROCESS_WORKERS = 2
+IMAGE_FETCH_TIMEOUT = 10
+IMAGE_MAX_BYTES = 10 * 1024 * 1024
+# Image URLs come from merchants: hosts resolving to loopback, private or link-local addresses
+# are refused unless this is set (local development against a private image server only)
+IMAGE_FETCH_PRIVATE_NETWORKS = False
+
+
+# Merchant addresses are geocoded in the background, see api.geo. api.geo.OfflineGeocoder
+# looks them up in GEOCODER_PLACES instead, for development without network access.
+GEOCODER = 'api.geo.NominatimGeocoder'
+GEOCODER_URL = 'https://nominatim.openstreetmap.org/search'
+GEOCODER_USER_AGENT = 'EcoFoods merchant geocoding'
+GEOCODER_TIMEOUT = 10
+GEOCODER_MIN_INTERVAL = 1.0  # seconds between requests, the public Nominatim allows one per second
+GEOCODER_PLACES = {}
+GEOCODING_ENABLED = True
+# Radius of the nearby feed, in km
+GEO_DEFAULT_RADIUS_KM = 25
+GEO_MAX_RADIUS_KM = 200
+
+
+# Background tasks, queued in the database and run by `manage.py run_tasks`, see api.tasks
+TASK_MAX_ATTEMPTS = 5
+TASK_RETRY_BACKOFF = 5  # seconds before the first retry, doubling with every attempt
+TASK_RETRY_BACKOFF_MAX = 3600
+TASK_LEASE = 300  # seconds a claimed task is left to its worker before another may take it over
+TASK_POLL_INTERVAL = 1
+TASK_RETENTION = 7 * 24 * 3600  # seconds finished tasks, and so their idempotency keys, are kept
+
+
+# Recommendations stored per user by the compute_recommendations command, and the similar
+# products kept per product while computing them
+RECOMMENDATIONS_TOP_N = 20
+RECOMMENDATIONS_NEIGHBOURS = 50
+
+
+# Rows fetched from the database cursor per chunk by the streaming exports, see api.exports
+EXPORT_CHUNK_SIZE = 2000
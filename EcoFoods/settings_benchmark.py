@@ -0,0 +1,23 @@
+from .settings import *  # noqa: F401,F403
+
+# Self-contained database for `manage.py benchmark`, no Postgres needed.
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'benchmark.sqlite3',
+    }
+}
+
+DEBUG = False
+
+# The login endpoint is timed repeatedly with one account; keep the throttle out of the measurement
+LOGIN_THROTTLE_RATES = {
+    'ip': (1000000, 1),
+    'email': (1000000, 1),
+}
+
+# Synthetic image URLs do not resolve
+IMAGE_PIPELINE_ENABLED = False
+
+# Nor do the synthetic merchant addresses
+GEOCODING_ENABLED = False
@@ -0,0 +1,23 @@
+from .settings import *  # noqa: F401,F403
+
+# Two SQLite databases standing in for a primary and its read replica, to try out the routing
+# (api.routers) locally. Nothing replicates between them; create both, then copy the primary
+# over the replica whenever it should catch up:
+#
+#   python manage.py migrate --settings=EcoFoods.settings_replica
+#   cp primary.sqlite3 replica.sqlite3
+#
+# In tests the replica mirrors the primary's test database.
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'primary.sqlite3',
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'replica.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+DATABASE_REPLICAS = ['replica']
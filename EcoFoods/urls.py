@@ -1,8 +1,13 @@
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include, re_path
 
+from api.asyncdb import as_async_view
 from api.views import RegistrationAPIView, LoginAPIView, ProductAPIView, UpdateUserAPIView, HomePageAPIView, \
-    MerchantProductsAPIView
+    MerchantProductsAPIView, ProductImportAPIView, ChatMessagesAPIView, OrderAPIView, \
+    CategoryAPIView, ProductSearchAPIView, MetricsAPIView, ImageUploadAPIView, MerchantDashboardAPIView, \
+    ExportAPIView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -10,8 +15,34 @@ urlpatterns = [
     re_path(r'^api/registration/?$', RegistrationAPIView.as_view(), name='user_registration'),
     re_path(r'^api/login/?$', LoginAPIView.as_view(), name='user_login'),
     re_path(r'^api/merchant/add_product/?$', ProductAPIView.as_view(), name='merchant_add_product'),
+    re_path(r'^api/merchant/import_products/?$', ProductImportAPIView.as_view(), name='merchant_import_products'),
+    re_path(r'^api/images/?$', ImageUploadAPIView.as_view(), name='image_upload'),
     re_path(r'^api/update/?$', UpdateUserAPIView.as_view(), name='update_user'),
     re_path(r'^api/home/?$', HomePageAPIView.as_view({'get': 'retrieve'}), name='homepage'),
+    re_path(r'^api/home/recommended/?$', HomePageAPIView.as_view({'get': 'recommended'}),
+            name='recommended_products'),
+    re_path(r'^api/home/nearby/?$', HomePageAPIView.as_view({'get': 'nearby'}), name='nearby_products'),
     re_path(r'^api/merchant/get_products', MerchantProductsAPIView.as_view({'get': 'retrieve'}),
             name='merchant_products'),
+    re_path(r'^api/merchant/dashboard/?$', MerchantDashboardAPIView.as_view(), name='merchant_dashboard'),
+    re_path(r'^api/orders/?$', OrderAPIView.as_view(), name='orders'),
+    re_path(r'^api/metrics/?$', MetricsAPIView.as_view(), name='metrics'),
+    re_path(r'^api/exports/(?P<dataset>products|orders|reviews)\.(?P<export_format>csv|ndjson)$',
+            ExportAPIView.as_view(), name='export'),
+    re_path(r'^api/search/?$', ProductSearchAPIView.as_view(), name='product_search'),
+    re_path(r'^api/categories/?$', CategoryAPIView.as_view({'get': 'list'}), name='categories'),
+    re_path(r'^api/categories/(?P<category_uuid>[0-9a-fA-F-]{32,36})/products/?$',
+            CategoryAPIView.as_view({'get': 'products'}), name='category_products'),
+    re_path(r'^api/chats/(?P<chat_uuid>[0-9a-fA-F-]{32,36})/messages/?$', ChatMessagesAPIView.as_view(),
+            name='chat_messages'),
+    # Async (ASGI) versions of the read endpoints
+    re_path(r'^api/async/home/?$', as_async_view(HomePageAPIView, {'get': 'retrieve'}), name='async_homepage'),
+    re_path(r'^api/async/merchant/get_products/?$', as_async_view(MerchantProductsAPIView, {'get': 'retrieve'}),
+            name='async_merchant_products'),
+    re_path(r'^api/async/chats/(?P<chat_uuid>[0-9a-fA-F-]{32,36})/messages/?$',
+            as_async_view(ChatMessagesAPIView, http_method_names=['get', 'head', 'options']),
+            name='async_chat_messages'),
 ]
+
+# Uploaded originals and generated variants; served by the web server in production
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
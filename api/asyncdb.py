@@ -0,0 +1,71 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from .instrumentation import current_metrics
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    # Every worker keeps its own persistent connection (CONN_MAX_AGE), so the pool size
+    # bounds the number of open database connections per process.
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'DATABASE_POOL_SIZE', 10),
+                    thread_name_prefix='db',
+                )
+    return _executor
+
+
+def _run(func, args, kwargs):
+    close_old_connections()
+    try:
+        with ExitStack() as stack:
+            metrics = current_metrics.get()
+            if metrics is not None:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics.execute_wrapper))
+            return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def database_sync_to_async(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(get_executor(), context.run, _run, func, args, kwargs)
+
+    return wrapper
+
+
+def as_async_view(view_class, actions=None, **initkwargs):
+    # Serves a DRF view from an ``async def`` view: authentication, queries, serialization and
+    # rendering run on the bounded database pool, the event loop only waits for the result.
+    view = view_class.as_view(actions, **initkwargs) if actions else view_class.as_view(**initkwargs)
+
+    def handle(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if hasattr(response, 'render') and not response.is_rendered:
+            response.render()
+        return response
+
+    handle = database_sync_to_async(handle)
+
+    @functools.wraps(view)
+    async def async_view(request, *args, **kwargs):
+        return await handle(request, *args, **kwargs)
+
+    return async_view
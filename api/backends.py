@@ -1,9 +1,124 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import timedelta
+from uuid import UUID
+
 from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
 from rest_framework import authentication, exceptions
 
 import jwt
 
-from .models import User
+from .models import User, UserDeletion, TOKEN_LIFETIME
+from .routers import identify_reader, read_from_replica
+from .utils import LRUCache
+
+
+class JWTCache:
+    # Fields kept for a cached user. Everything else (notably ``password``) is deferred,
+    # so reading it hits the database and ``save()`` only writes the loaded fields.
+    snapshot_fields = ('uuid', 'email', 'first_name', 'last_name', 'address', 'phone_number',
+                       'is_merchant', 'is_active', 'is_superuser', 'date_modified', 'token_version')
+
+    def __init__(self, max_size, ttl):
+        self._cache = LRUCache(max_size, ttl)
+        # ``Model.from_db`` expects values in concrete field order.
+        self._field_names = [f.attname for f in User._meta.concrete_fields if f.attname in self.snapshot_fields]
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        entry = self._cache.get(self._key(token))
+        if entry is None:
+            return None
+
+        payload, values = entry
+        return payload, User.from_db(DEFAULT_DB_ALIAS, self._field_names, values)
+
+    def set(self, token, payload, user):
+        ttl = payload['exp'] - time.time()
+        if ttl <= 0:
+            return
+
+        values = tuple(getattr(user, field) for field in self._field_names)
+        self._cache.set(self._key(token), (payload, values), ttl=ttl, tag=UUID(str(payload['id'])))
+
+    def invalidate_user(self, user_id):
+        self._cache.delete_tag(UUID(str(user_id)))
+
+    def clear(self):
+        self._cache.clear()
+
+
+jwt_cache = JWTCache(
+    max_size=getattr(settings, 'JWT_AUTH_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'JWT_AUTH_CACHE_TTL', 300),
+)
+
+
+class TokenRevocations:
+    # User id -> token_version, for the users whose version was bumped within TOKEN_LIFETIME
+    # (older tokens have expired anyway), infinity for deleted users. Tokens with claims are
+    # checked against it instead of the user row. Changes made in this process are added on
+    # commit; the ones made by other processes are read every JWT_REVOCATION_REFRESH seconds,
+    # from the users modified and the UserDeletion rows recorded since.
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._synced_at = None
+        self._next_refresh = 0.0
+
+    def revoke(self, user_id, version):
+        user_id = UUID(str(user_id))
+        with self._lock:
+            self._versions[user_id] = max(version, self._versions.get(user_id, 0))
+
+    def is_revoked(self, user_id, version):
+        self.refresh()
+        return self._versions.get(UUID(str(user_id)), 0) > version
+
+    def refresh(self):
+        if time.monotonic() < self._next_refresh:
+            return
+        # Until the first load every check waits for it, after that the others go on meanwhile.
+        if not self._lock.acquire(blocking=self._synced_at is None):
+            return
+        try:
+            if time.monotonic() < self._next_refresh:
+                return
+            now = timezone.now()
+            if self._synced_at is None:
+                since = now - TOKEN_LIFETIME
+            else:
+                # Overlapping, for transactions that committed after the last refresh
+                since = self._synced_at - timedelta(seconds=getattr(settings, 'JWT_REVOCATION_OVERLAP', 60))
+            changed = User.objects.using(DEFAULT_DB_ALIAS)\
+                .filter(date_modified__gte=since, token_version__gt=0).values_list('uuid', 'token_version')
+            for user_id, version in changed:
+                self._versions[user_id] = max(version, self._versions.get(user_id, 0))
+            deleted = UserDeletion.objects.using(DEFAULT_DB_ALIAS)\
+                .filter(deleted_at__gte=since).values_list('user_id', flat=True)
+            for user_id in deleted:
+                self._versions[user_id] = math.inf
+            self._synced_at = now
+            self._next_refresh = time.monotonic() + getattr(settings, 'JWT_REVOCATION_REFRESH', 5)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        with self._lock:
+            self._versions.clear()
+            self._synced_at = None
+            self._next_refresh = 0.0
+
+
+token_revocations = TokenRevocations()
 
 
 class JWTAuth(authentication.BaseAuthentication):
@@ -37,6 +152,13 @@ class JWTAuth(authentication.BaseAuthentication):
         return self._authenticate_credentials(request, token)
 
     def _authenticate_credentials(self, request, token):
+        cached = jwt_cache.get(token)
+        if cached is not None:
+            payload, user = cached
+            identify_reader(payload['id'])
+            self._check_version(payload, user.token_version)
+            return user, token
+
         try:
             payload = jwt.decode(token, settings.SECRET_KEY)
 
@@ -44,15 +166,48 @@ class JWTAuth(authentication.BaseAuthentication):
             msg = 'Invalid authentication. Could not decode token.'
             raise exceptions.AuthenticationFailed(msg)
 
+        identify_reader(payload['id'])
+        if getattr(settings, 'JWT_CLAIMS_TOKENS', False) and 'merchant' in payload:
+            return self._user_from_claims(payload), token
+
         try:
             user = User.objects.get(uuid=payload['id'])
         except User.DoesNotExist:
-            msg = "No user matching this token was found"
-            raise exceptions.AuthenticationFailed(msg)
+            # A user who registered moments ago may not have reached the replica yet
+            user = User.objects.using(DEFAULT_DB_ALIAS).filter(uuid=payload['id']).first() \
+                if read_from_replica() else None
+            if user is None:
+                msg = "No user matching this token was found"
+                raise exceptions.AuthenticationFailed(msg)
 
         if not user.is_active:
             msg = "User were deactivated or deleted"
             raise exceptions.AuthenticationFailed(msg)
+        self._check_version(payload, user.token_version)
+
+        jwt_cache.set(token, payload, user)
 
         return user, token
 
+    def _check_version(self, payload, token_version):
+        # Tokens from before versions count as version 0
+        if payload.get('ver', 0) < token_version:
+            msg = "Token was revoked"
+            raise exceptions.AuthenticationFailed(msg)
+
+    def _user_from_claims(self, payload):
+        # A User with only the claimed fields loaded: permission checks and filtering on the user
+        # need no query, the first other field read loads the row (see User.refresh_from_db).
+        if not payload['active']:
+            msg = "User were deactivated or deleted"
+            raise exceptions.AuthenticationFailed(msg)
+        if token_revocations.is_revoked(payload['id'], payload['ver']):
+            msg = "Token was revoked"
+            raise exceptions.AuthenticationFailed(msg)
+
+        claims = {'uuid': UUID(payload['id']), 'is_merchant': payload['merchant'], 'is_active': True,
+                  'token_version': payload['ver']}
+        field_names = [f.attname for f in User._meta.concrete_fields if f.attname in claims]
+        user = User.from_db(DEFAULT_DB_ALIAS, field_names, [claims[name] for name in field_names])
+        user._from_claims = True
+        return user
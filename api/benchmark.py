@@ -0,0 +1,233 @@
+import json
+import random
+import statistics
+import time
+from collections import defaultdict
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from .backends import jwt_cache
+from .cache import home_feed_cache
+from .models import User, Image, Product, ProductImage, Review, Chat, Message, Category, ProductCategory
+from .search import get_product_search
+
+WORDS = ('apple', 'pear', 'plum', 'honey', 'cheese', 'goat', 'milk', 'bread', 'rye', 'oat', 'tea', 'herbal',
+         'wild', 'organic', 'fresh', 'smoked', 'salmon', 'berry', 'jam', 'butter', 'kale', 'leek', 'walnut')
+
+
+class SyntheticDataset:
+    password = 'benchmark-pass'
+
+    def __init__(self, users=100, merchants=10, products=1000, images_per_product=2, reviews=2000, chats=50,
+                 messages_per_chat=50, categories=10, seed=0, batch_size=1000):
+        self.sizes = {
+            'users': users,
+            'merchants': merchants,
+            'products': products,
+            'images_per_product': images_per_product,
+            'reviews': reviews,
+            'chats': chats,
+            'messages_per_chat': messages_per_chat,
+            'categories': categories,
+        }
+        self.random = random.Random(seed)
+        self.batch_size = batch_size
+        self.buyers = []
+        self.merchants = []
+        self.products = []
+        self.chats = []
+
+    def _words(self, count):
+        return ' '.join(self.random.choice(WORDS) for _ in range(count))
+
+    def load(self):
+        sizes = self.sizes
+        # Hashing once keeps seeding fast; every synthetic user shares the same password.
+        password = make_password(self.password)
+
+        self.merchants = [
+            User(email=f'merchant{i}@bench.test', password=password, is_merchant=True, address=f'Market street {i}')
+            for i in range(sizes['merchants'])
+        ]
+        self.buyers = [User(email=f'buyer{i}@bench.test', password=password) for i in range(sizes['users'])]
+        User.objects.bulk_create(self.merchants + self.buyers, batch_size=self.batch_size)
+
+        self.products = [
+            Product(merchant=self.random.choice(self.merchants), name=self._words(2).title(),
+                    description=self._words(12), price=Decimal(self.random.randint(50, 5000)) / 100, units='kg',
+                    is_featured=self.random.random() < 0.05)
+            for _ in range(sizes['products'])
+        ]
+
+        reviews = []
+        for _ in range(sizes['reviews']):
+            product = self.random.choice(self.products)
+            rating = Decimal(self.random.randint(10, 50)) / 10
+            # Review.save() maintains these; bulk_create does not, so they are precomputed here.
+            product.rating_count += 1
+            product.rating_sum += rating
+            reviews.append(Review(product=product, merchant=self.random.choice(self.buyers), rating=rating,
+                                  review_text=self._words(8)))
+
+        images = []
+        product_images = []
+        for product in self.products:
+            for i in range(sizes['images_per_product']):
+                image = Image(url=f'https://cdn.bench.test/{product.uuid.hex}/{i}.jpg')
+                images.append(image)
+                product_images.append(ProductImage(product=product, image=image))
+
+        categories = []
+        for i in range(sizes['categories']):
+            image = Image(url=f'https://cdn.bench.test/categories/{i}.jpg')
+            images.append(image)
+            categories.append(Category(name=f'Category {i}', image=image))
+
+        Image.objects.bulk_create(images, batch_size=self.batch_size)
+        Product.objects.bulk_create(self.products, batch_size=self.batch_size)
+        get_product_search().index_products(self.products, created=True)
+        ProductImage.objects.bulk_create(product_images, batch_size=self.batch_size)
+        Review.objects.bulk_create(reviews, batch_size=self.batch_size)
+        Category.objects.bulk_create(categories, batch_size=self.batch_size)
+        if categories:
+            ProductCategory.objects.create_links([
+                (product, self.random.choice(categories).pk) for product in self.products
+            ], new_products=True)
+
+        self.chats = [
+            Chat(user=self.random.choice(self.buyers), merchant=self.random.choice(self.merchants))
+            for _ in range(sizes['chats'])
+        ]
+        Chat.objects.bulk_create(self.chats, batch_size=self.batch_size)
+        Message.objects.bulk_create([
+            Message(chat=chat, sender=chat.user if i % 2 else chat.merchant, text=self._words(6))
+            for chat in self.chats for i in range(sizes['messages_per_chat'])
+        ], batch_size=self.batch_size)
+
+        return self
+
+
+class Endpoint:
+
+    def __init__(self, name, method, path, data=None, before=None, user=None, data_format='json'):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data
+        self.before = before
+        self.user = user
+        self.data_format = data_format
+
+    def request(self, client, iteration):
+        if self.before is not None:
+            self.before()
+        path = self.path() if callable(self.path) else self.path
+        data = self.data(iteration) if callable(self.data) else self.data
+        return getattr(client, self.method)(path, data, format=self.data_format)
+
+
+def default_endpoints(dataset):
+    merchant = dataset.merchants[0]
+    chat = dataset.chats[0] if dataset.chats else None
+
+    endpoints = [
+        Endpoint('home (uncached)', 'get', reverse('homepage'), before=home_feed_cache.invalidate),
+        Endpoint('home (cached)', 'get', reverse('homepage')),
+        Endpoint('merchant products', 'get', reverse('merchant_products')),
+        Endpoint('login', 'post', reverse('user_login'),
+                 data={'email': merchant.email, 'password': SyntheticDataset.password}),
+        Endpoint('add product', 'post', reverse('merchant_add_product'), data=lambda i: {
+            'name': f'Benchmark product {i}', 'price': '1.99', 'units': 'kg', 'img': f'https://cdn.bench.test/{i}.jpg',
+        }),
+        Endpoint('search', 'get', reverse('product_search'), data={'q': 'honey'}),
+        Endpoint('categories', 'get', reverse('categories')),
+    ]
+    if chat is not None:
+        endpoints.append(Endpoint('chat history', 'get', reverse('chat_messages', kwargs={'chat_uuid': chat.uuid}),
+                                  user=chat.merchant))
+
+    return endpoints
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def run_benchmarks(dataset, iterations=50, warmup=5, endpoints=None):
+    if endpoints is None:
+        endpoints = default_endpoints(dataset)
+
+    results = {}
+    for endpoint in endpoints:
+        jwt_cache.clear()
+        user = endpoint.user or dataset.merchants[0]
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {user.token}')
+
+        for i in range(warmup):
+            endpoint.request(client, -i - 1)
+
+        timings = []
+        queries = []
+        sizes = []
+        statuses = defaultdict(int)
+        started = time.perf_counter()
+        for i in range(iterations):
+            with CaptureQueriesContext(connection) as captured:
+                request_started = time.perf_counter()
+                response = endpoint.request(client, i)
+                timings.append((time.perf_counter() - request_started) * 1000)
+            queries.append(len(captured))
+            sizes.append(len(response.content))
+            statuses[response.status_code] += 1
+        elapsed = time.perf_counter() - started
+
+        results[endpoint.name] = {
+            'p50_ms': round(percentile(timings, 0.50), 3),
+            'p95_ms': round(percentile(timings, 0.95), 3),
+            'p99_ms': round(percentile(timings, 0.99), 3),
+            'mean_ms': round(statistics.mean(timings), 3),
+            'rps': round(iterations / elapsed, 1),
+            'queries': max(queries),
+            'bytes': max(sizes),
+            'statuses': dict(statuses),
+        }
+
+    return results
+
+
+def check_budgets(results, budgets, latency_tolerance=1.5, latency_floor_ms=5.0):
+    # Returns (query regressions, latency regressions). Query counts are deterministic and fail
+    # the run; latencies depend on the machine, so a p95 only counts as slower once it is over
+    # both ``latency_tolerance`` times and ``latency_floor_ms`` more than its budget.
+    query_regressions, latency_regressions = [], []
+    for name, budget in budgets.items():
+        result = results.get(name)
+        if result is None:
+            continue
+        if 'queries' in budget and result['queries'] > budget['queries']:
+            query_regressions.append(f"{name}: {result['queries']} queries, budget {budget['queries']}")
+        if 'p95_ms' in budget:
+            limit = max(budget['p95_ms'] * latency_tolerance, budget['p95_ms'] + latency_floor_ms)
+            if result['p95_ms'] > limit:
+                latency_regressions.append(f"{name}: p95 {result['p95_ms']} ms, budget {budget['p95_ms']} ms")
+    return query_regressions, latency_regressions
+
+
+def load_budgets(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def dump_budgets(results, path):
+    budgets = {name: {'queries': result['queries'], 'p95_ms': result['p95_ms']} for name, result in results.items()}
+    with open(path, 'w') as f:
+        json.dump(budgets, f, indent=2, sort_keys=True)
+        f.write('\n')
@@ -0,0 +1,63 @@
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .routers import read_from_replica, write_pins
+
+
+class ResponseCache:
+    def __init__(self, prefix, alias=None, timeout=None):
+        self.prefix = prefix
+        self.alias = alias or getattr(settings, 'RESPONSE_CACHE_ALIAS', 'default')
+        self.timeout = timeout if timeout is not None else getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 300)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _generation(self):
+        key = f'{self.prefix}:generation'
+        generation = self.cache.get(key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.cache.add(key, generation, None)
+            generation = self.cache.get(key, generation)
+        return generation
+
+    def _key(self, request):
+        path = hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()
+        return f'{self.prefix}:{self._generation()}:{request.accepted_media_type}:{path}'
+
+    def get(self, request):
+        return self.cache.get(self._key(request))
+
+    def set(self, request, response):
+        entry = {
+            'content': response.content,
+            'content_type': response['Content-Type'],
+            'etag': '"%s"' % hashlib.md5(response.content).hexdigest(),
+        }
+        if not self._replica_may_lag():
+            self.cache.set(self._key(request), entry, self.timeout)
+        return entry
+
+    def _replica_may_lag(self):
+        # A response read from a replica just after an invalidation may predate the write that
+        # caused it; caching it would keep the stale feed for the whole timeout.
+        if not read_from_replica():
+            return False
+        invalidated = self.cache.get(f'{self.prefix}:invalidated', 0)
+        return time.time() - invalidated < write_pins.seconds
+
+    def invalidate(self):
+        # Old entries become unreachable and age out on their own timeout.
+        self.cache.set_many({
+            f'{self.prefix}:generation': uuid.uuid4().hex,
+            f'{self.prefix}:invalidated': time.time(),
+        }, None)
+
+
+home_feed_cache = ResponseCache('home_feed')
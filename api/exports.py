@@ -0,0 +1,209 @@
+import csv
+import io
+import json
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from itertools import islice
+from uuid import UUID
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Product, ProductCategory, ProductImage, OrderItem, Review
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def format_value(value):
+    # The text forms of the matching DRF fields, so exported values read like the API's JSON.
+    if isinstance(value, datetime):
+        value = value.isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    if isinstance(value, (Decimal, UUID)):
+        return str(value)
+    return value
+
+
+def csv_lines(columns, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for chunk in chunks:
+        writer.writerows([
+            ['|'.join(value) if isinstance(value, list) else value for value in row.values()] for row in chunk
+        ])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only, for an empty export
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def ndjson_lines(columns, chunks):
+    for chunk in chunks:
+        if orjson is not None:
+            yield (b'\n'.join(map(orjson.dumps, chunk)) + b'\n').decode('utf-8')
+        else:
+            yield ''.join(json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n' for row in chunk)
+
+
+EXPORT_FORMATS = {
+    'csv': (csv_lines, 'text/csv; charset=utf-8'),
+    'ndjson': (ndjson_lines, 'application/x-ndjson; charset=utf-8'),
+}
+
+
+class Export:
+    # A table streamed ``chunk_size`` rows at a time. Rows come from ``.values_list()`` through
+    # ``.iterator()`` (a server-side cursor on PostgreSQL), so memory stays flat whatever the table
+    # size, and to-many columns are filled in by add_related() with one query per chunk.
+    model = None
+    columns = {}  # output column -> lookup, including the watermark
+    related_columns = ()
+    watermark = 'created_at'
+    ordering = ()  # tie-breakers after the watermark
+
+    def __init__(self, since=None, chunk_size=None):
+        self.since = since
+        self.chunk_size = chunk_size or getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+        self.count = 0
+        self.last_watermark = None
+
+    def get_queryset(self):
+        queryset = self.model.objects.all()
+        if self.since is not None:
+            # Inclusive, so rows sharing the previous export's last watermark are not lost;
+            # consumers key rows by their uuid.
+            queryset = queryset.filter(**{f'{self.watermark}__gte': self.since})
+        return queryset.order_by(self.watermark, *self.ordering, 'pk')
+
+    def add_related(self, rows):
+        pass
+
+    @property
+    def keys(self):
+        # The export order, unique per row
+        return [self.watermark, *self.ordering, 'pk']
+
+    def prepare(self, chunk):
+        watermark_index = list(self.columns.values()).index(self.watermark)
+        self.count += len(chunk)
+        self.last_watermark = chunk[-1][watermark_index]
+        chunk = [dict(zip(self.columns, map(format_value, row[:len(self.columns)]))) for row in chunk]
+        self.add_related(chunk)
+        return chunk
+
+    def iter_chunks(self):
+        rows = self.get_queryset().values_list(*self.columns.values()).iterator(chunk_size=self.chunk_size)
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                return
+            yield self.prepare(chunk)
+
+    def iter_keyset_chunks(self):
+        # The same chunks, each read by a query of its own that starts after the last row of the
+        # previous one. No cursor stays open between chunks, so they can be read on different
+        # threads and connections, as the ASGI export stream does (see api.streams).
+        keys = self.keys
+        queryset = self.get_queryset().values_list(*self.columns.values(), *keys)
+        position = None
+        while True:
+            chunk = list((queryset if position is None else self.after(queryset, position))[:self.chunk_size])
+            if not chunk:
+                return
+            position = chunk[-1][-len(keys):]
+            yield self.prepare(chunk)
+            if len(chunk) < self.chunk_size:
+                return
+
+    def after(self, queryset, position):
+        condition = Q()
+        for i, key in enumerate(self.keys):
+            condition |= Q(**dict(zip(self.keys[:i], position)), **{f'{key}__gt': position[i]})
+        return queryset.filter(condition)
+
+    def stream(self, export_format, chunks=None):
+        # str pieces, one per chunk
+        lines, _ = EXPORT_FORMATS[export_format]
+        return lines([*self.columns, *self.related_columns], chunks if chunks is not None else self.iter_chunks())
+
+
+class ProductExport(Export):
+    model = Product
+    columns = {
+        'uuid': 'uuid',
+        'name': 'name',
+        'merchant': 'merchant_id',
+        'description': 'description',
+        'price': 'price',
+        'units': 'units',
+        'stock': 'stock',
+        'is_featured': 'is_featured',
+        'rating_count': 'rating_count',
+        'rating_sum': 'rating_sum',
+        'created_at': 'created_at',
+        'date_modified': 'date_modified',
+    }
+    related_columns = ('categories', 'images')
+    watermark = 'date_modified'
+
+    def add_related(self, rows):
+        pks = [row['uuid'] for row in rows]
+        categories = defaultdict(list)
+        for product_id, name in ProductCategory.objects.filter(product__in=pks)\
+                .order_by('category__name').values_list('product_id', 'category__name'):
+            categories[str(product_id)].append(name)
+        images = defaultdict(list)
+        for product_id, url in ProductImage.objects.filter(product__in=pks)\
+                .order_by('pk').values_list('product_id', 'image__url'):
+            images[str(product_id)].append(url)
+
+        for row in rows:
+            row['categories'] = categories.get(row['uuid'], [])
+            row['images'] = images.get(row['uuid'], [])
+
+
+class OrderExport(Export):
+    # One row per order item, the items of an order together
+    model = OrderItem
+    columns = {
+        'order': 'order_id',
+        'user': 'order__user_id',
+        'status': 'order__status',
+        'created_at': 'order__created_at',
+        'item': 'uuid',
+        'product': 'product_id',
+        'product_name': 'product__name',
+        'merchant': 'product__merchant_id',
+        'quantity': 'quantity',
+        'price': 'price',
+    }
+    watermark = 'order__created_at'
+    ordering = ('order_id',)
+
+
+class ReviewExport(Export):
+    model = Review
+    columns = {
+        'uuid': 'uuid',
+        'product': 'product_id',
+        'product_name': 'product__name',
+        'merchant': 'product__merchant_id',
+        'reviewer': 'merchant_id',
+        'rating': 'rating',
+        'review_text': 'review_text',
+        'created_at': 'created_at',
+    }
+
+
+exports = {
+    'products': ProductExport,
+    'orders': OrderExport,
+    'reviews': ReviewExport,
+}
@@ -0,0 +1,181 @@
+import threading
+from collections import defaultdict
+
+from django.core.files.storage import default_storage
+
+from .instrumentation import timed
+from .models import Product, ProductImage
+
+
+# Value formatting of the matching DRF fields, None passing through as in Serializer.to_representation.
+# Fields without a formatter are NOT NULL text, boolean or integer columns, which the database driver
+# already returns as the str, bool or int the DRF field would produce.
+
+def to_str(value):
+    return None if value is None else str(value)
+
+
+# Decimal columns come back from the database already quantized to their decimal_places, and for
+# exponents from -1 to -6 str() gives the same plain notation as DecimalField's '{:f}', only faster.
+format_db_decimal = str
+
+
+def format_rating(rating_count, rating_sum):
+    # Product.rating is already quantized to the two places of the serializers' rating field.
+    return format_db_decimal(Product.average_rating(rating_count, rating_sum)) if rating_count else None
+
+
+def thumbnail_url(url, variants):
+    path = variants.get('thumbnail') if variants else None
+    return default_storage.url(path) if path else url
+
+
+class FlatSerializer:
+    # Read-only stand-ins for the list serializers: rows come from ``.values(*serializer.columns)`` and
+    # each output field is built by a function of the columns it lists in ``fields`` (or is the column
+    # itself when the function is None). The loop is compiled once per field selection, so a row costs
+    # one dict display and no DRF field lookups.
+    fields = {}
+
+    _compiled = {}
+    _compiled_lock = threading.Lock()
+
+    def __init__(self, fields=None):
+        self.selected = tuple(name for name in self.fields if fields is None or name in fields)
+        columns = []
+        for name in self.selected:
+            columns.extend(column for column in self.fields[name][0] if column not in columns)
+        self.columns = tuple(columns)
+
+    def values(self, queryset, *extra_columns):
+        return queryset.values(*self.columns, *(column for column in extra_columns if column not in self.columns))
+
+    @classmethod
+    def compile(cls, selected):
+        # Returns factory(*builders) -> serialize_rows(rows), taking the builders of the selected
+        # fields that have one, in order.
+        key = (cls, selected)
+        factory = cls._compiled.get(key)
+        if factory is None:
+            items = []
+            builders = []
+            for name in selected:
+                columns, build = cls.fields[name]
+                arguments = ', '.join(f'row[{column!r}]' for column in columns)
+                if build is None:
+                    items.append(f'{name!r}: {arguments}')
+                else:
+                    builders.append(f'build_{len(builders)}')
+                    items.append(f'{name!r}: {builders[-1]}({arguments})')
+            source = (f'def factory({", ".join(builders)}):\n'
+                      f'    def serialize_rows(rows):\n'
+                      f'        return [{{{", ".join(items)}}} for row in rows]\n'
+                      f'    return serialize_rows\n')
+            namespace = {}
+            exec(compile(source, f'<flat {cls.__name__}>', 'exec'), namespace)
+            factory = namespace['factory']
+            with cls._compiled_lock:
+                cls._compiled[key] = factory
+        return factory
+
+    def get_builders(self):
+        builders = [self.fields[name][1] for name in self.selected]
+        # Strings name methods, for fields that need state loaded by prepare()
+        return [getattr(self, build) if isinstance(build, str) else build for build in builders if build is not None]
+
+    def prepare(self, rows):
+        pass
+
+    def to_representation(self, rows):
+        rows = list(rows)
+        self.prepare(rows)
+        return self.compile(self.selected)(*self.get_builders())(rows)
+
+    def serialize(self, rows):
+        with timed('serializer_ms'):
+            return self.to_representation(rows)
+
+
+def image_thumbnail(uuid, url, variants):
+    return {'uuid': str(uuid), 'url': url, 'thumbnail': thumbnail_url(url, variants)}
+
+
+class FlatImageSerializer(FlatSerializer):
+    # ImageSerializer
+    fields = {
+        'uuid': (('uuid',), str),
+        'url': (('url',), None),
+        'status': (('status',), None),
+        'variants': (('variants',), lambda variants: {
+            name: default_storage.url(path) for name, path in variants.items()
+        }),
+    }
+
+
+class FlatImageThumbnailSerializer(FlatSerializer):
+    # ImageThumbnailSerializer
+    fields = {
+        'uuid': (('uuid',), str),
+        'url': (('url',), None),
+        'thumbnail': (('url', 'variants'), thumbnail_url),
+    }
+
+
+class FlatProductImageSerializer(FlatSerializer):
+    # ProductImageSerializer
+    fields = {
+        'image': (('image__uuid', 'image__url', 'image__variants'), image_thumbnail),
+    }
+
+
+class FlatProductSerializer(FlatSerializer):
+    # HomeViewSerializer
+    fields = {
+        'uuid': (('uuid',), str),
+        'name': (('name',), None),
+        'is_featured': (('is_featured',), None),
+        'price': (('price',), format_db_decimal),
+        'units': (('units',), None),
+        'rating': (('rating_count', 'rating_sum'), format_rating),
+        'rating_count': (('rating_count',), None),
+        'merchant': (('merchant__address',), lambda address: {'address': to_str(address)}),
+    }
+
+
+class FlatNearbyProductSerializer(FlatSerializer):
+    # NearbyProductSerializer
+    fields = dict(FlatProductSerializer.fields, distance=(('distance',), lambda distance: round(distance, 3)))
+
+
+class FlatMerchantProductSerializer(FlatSerializer):
+    # ProductSerializerForMerchant
+    fields = {
+        'uuid': FlatProductSerializer.fields['uuid'],
+        'name': FlatProductSerializer.fields['name'],
+        'is_featured': FlatProductSerializer.fields['is_featured'],
+        'price': FlatProductSerializer.fields['price'],
+        'units': FlatProductSerializer.fields['units'],
+        'description': (('description',), None),
+        'rating': FlatProductSerializer.fields['rating'],
+        'rating_count': FlatProductSerializer.fields['rating_count'],
+        'images': (('uuid',), 'get_images'),
+    }
+    image_serializer_class = FlatProductImageSerializer
+
+    def __init__(self, fields=None):
+        super().__init__(fields)
+        self.images = {}
+
+    def prepare(self, rows):
+        if 'images' not in self.selected:
+            return
+
+        image_serializer = self.image_serializer_class()
+        links = ProductImage.objects.filter(product__in=[row['uuid'] for row in rows])
+        links = list(image_serializer.values(links, 'product_id'))
+        self.images = defaultdict(list)
+        for link, data in zip(links, image_serializer.to_representation(links)):
+            self.images[link['product_id']].append(data)
+
+    def get_images(self, uuid):
+        return self.images.get(uuid, [])
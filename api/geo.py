@@ -0,0 +1,208 @@
+import json
+import logging
+import math
+import threading
+import time
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.db.models import ExpressionWrapper, F, FloatField, Q, Value
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+from django.utils.module_loading import import_string
+
+from .tasks import task
+
+logger = logging.getLogger(__name__)
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_LENGTH = 12
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def geohash_encode(latitude, longitude, length=GEOHASH_LENGTH):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bit = value = 0
+    even = True
+    while len(chars) < length:
+        # Bits alternate between longitude and latitude, longitude first.
+        bounds, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (bounds[0] + bounds[1]) / 2
+        if coordinate >= middle:
+            value = value << 1 | 1
+            bounds[0] = middle
+        else:
+            value <<= 1
+            bounds[1] = middle
+        even = not even
+        bit += 1
+        if bit == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bit = value = 0
+    return ''.join(chars)
+
+
+def geohash_cell_size(length):
+    # (latitude, longitude) degrees covered by a cell of ``length`` characters
+    bits = 5 * length
+    return 180 / 2 ** (bits // 2), 360 / 2 ** (bits - bits // 2)
+
+
+def covering_prefixes(latitude, longitude, radius_km, max_cells=16):
+    # The geohash cells, as few and as small as possible, whose union covers the bounding box
+    # of the circle. Every point within radius_km then has a geohash starting with one of them.
+    lat_delta = radius_km / KM_PER_DEGREE
+    min_lat, max_lat = max(latitude - lat_delta, -90.0), min(latitude + lat_delta, 90.0)
+    cos_lat = min(math.cos(math.radians(min_lat)), math.cos(math.radians(max_lat)))
+    lon_delta = radius_km / (KM_PER_DEGREE * cos_lat) if cos_lat > 1e-9 else 360.0
+
+    for length in range(GEOHASH_LENGTH, 0, -1):
+        height, width = geohash_cell_size(length)
+        rows, columns = round(180 / height), round(360 / width)
+        first_row = max(int((min_lat + 90) // height), 0)
+        last_row = min(int((max_lat + 90) // height), rows - 1)
+        if lon_delta >= 180:
+            column_range = range(columns)
+        else:
+            # Indexes past either end wrap around the antimeridian.
+            column_range = range(int((longitude - lon_delta + 180) // width),
+                                 int((longitude + lon_delta + 180) // width) + 1)
+        if (last_row - first_row + 1) * min(len(column_range), columns) > max_cells and length > 1:
+            continue
+
+        return sorted({
+            geohash_encode(-90 + (row + 0.5) * height, -180 + (column % columns + 0.5) * width, length)
+            for row in range(first_row, last_row + 1)
+            for column in column_range
+        })
+
+
+def geohash_prefix_filter(field, prefixes):
+    # Ranges rather than LIKE 'prefix%', so a plain btree index on the (fixed length) geohash
+    # column serves them on every backend.
+    query = Q()
+    for prefix in prefixes:
+        padding = GEOHASH_LENGTH - len(prefix)
+        query |= Q(**{f'{field}__range': (prefix + '0' * padding, prefix + 'z' * padding)})
+    return query
+
+
+def within_radius(queryset, latitude, longitude, radius_km, location='merchant__'):
+    # Rows whose ``location`` (a User with coordinates) lies within radius_km, annotated with
+    # their ``distance`` in km. The geohash ranges come first, so the index narrows the rows
+    # down to the covering cells and only those get the exact distance computed.
+    prefixes = covering_prefixes(latitude, longitude, radius_km)
+    return queryset.filter(geohash_prefix_filter(f'{location}geohash', prefixes))\
+        .annotate(distance=distance_expression(f'{location}latitude', f'{location}longitude', latitude, longitude))\
+        .filter(distance__lte=radius_km)
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    latitude1, longitude1, latitude2, longitude2 = map(math.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = (math.sin((latitude2 - latitude1) / 2) ** 2
+         + math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def distance_expression(latitude_field, longitude_field, latitude, longitude):
+    # haversine_km() in SQL; Django provides the math functions on SQLite too.
+    def constant(value):
+        return Value(value, output_field=FloatField())
+
+    latitude1, longitude1 = Radians(F(latitude_field)), Radians(F(longitude_field))
+    latitude0, longitude0 = math.radians(latitude), math.radians(longitude)
+    a = (Power(Sin((latitude1 - constant(latitude0)) / constant(2.0)), constant(2.0))
+         + constant(math.cos(latitude0)) * Cos(latitude1)
+         * Power(Sin((longitude1 - constant(longitude0)) / constant(2.0)), constant(2.0)))
+    return ExpressionWrapper(constant(2 * EARTH_RADIUS_KM) * ASin(Sqrt(a)), output_field=FloatField())
+
+
+def normalize_address(address):
+    return ' '.join(address.lower().replace(',', ' ').split())
+
+
+class OfflineGeocoder:
+    # Looks addresses up in GEOCODER_PLACES (address -> (latitude, longitude)), compared case and
+    # punctuation insensitively. For tests and development, where nothing may leave the machine.
+
+    def geocode(self, address):
+        places = {normalize_address(place): coordinates
+                  for place, coordinates in getattr(settings, 'GEOCODER_PLACES', {}).items()}
+        return places.get(normalize_address(address))
+
+
+class NominatimGeocoder:
+    # OpenStreetMap's Nominatim search API, or a self-hosted instance at GEOCODER_URL. Requests are
+    # spaced GEOCODER_MIN_INTERVAL seconds apart process-wide, as the public instance requires.
+    _lock = threading.Lock()
+    _last_request = 0.0
+
+    def geocode(self, address):
+        url = f"{settings.GEOCODER_URL}?{urlencode({'q': address, 'format': 'jsonv2', 'limit': 1})}"
+        request = Request(url, headers={'User-Agent': getattr(settings, 'GEOCODER_USER_AGENT', 'EcoFoods')})
+        with NominatimGeocoder._lock:
+            wait = NominatimGeocoder._last_request + getattr(settings, 'GEOCODER_MIN_INTERVAL', 1.0) - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                with urlopen(request, timeout=getattr(settings, 'GEOCODER_TIMEOUT', 10)) as response:
+                    results = json.load(response)
+            finally:
+                NominatimGeocoder._last_request = time.monotonic()
+        if not results:
+            return None
+        return float(results[0]['lat']), float(results[0]['lon'])
+
+
+def get_geocoder():
+    return import_string(getattr(settings, 'GEOCODER', 'api.geo.OfflineGeocoder'))()
+
+
+class GeocodingPipeline:
+    # Geocodes merchant addresses in the background, as geocode_merchant tasks queued with the
+    # transaction that changed them. An address is geocoded once: User.geocoded_address records
+    # the one the stored coordinates belong to.
+
+    def schedule(self, user_pk, using=None):
+        if getattr(settings, 'GEOCODING_ENABLED', True):
+            geocode_merchant.enqueue(user_pk=str(user_pk), using=using)
+
+    def process(self, pk, raise_errors=False):
+        # Returns the merchant's coordinates, None if the address could not be geocoded.
+        # raise_errors raises geocoder errors instead, for the task to retry.
+        from .models import User
+
+        user = User.objects.only('address', 'geocoded_address', 'latitude', 'longitude').get(pk=pk)
+        if user.address == user.geocoded_address:
+            return (user.latitude, user.longitude) if user.latitude is not None else None
+
+        coordinates = None
+        if user.address.strip():
+            try:
+                coordinates = get_geocoder().geocode(user.address)
+            except Exception:
+                if raise_errors:
+                    raise
+                # Left for the next change of address or a geocode_merchants run.
+                logger.warning('Could not geocode the address of merchant %s', pk, exc_info=True)
+                return None
+
+        latitude, longitude = coordinates or (None, None)
+        # Only if the address is still the one geocoded, a newer one has its own run scheduled.
+        User.objects.filter(pk=pk, address=user.address).update(
+            latitude=latitude,
+            longitude=longitude,
+            geohash=geohash_encode(latitude, longitude) if coordinates else None,
+            geocoded_address=user.address,
+        )
+        return coordinates
+
+
+geocoding_pipeline = GeocodingPipeline()
+
+
+@task()
+def geocode_merchant(user_pk):
+    geocoding_pipeline.process(user_pk, raise_errors=True)
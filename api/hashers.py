@@ -0,0 +1,70 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from rest_framework import exceptions
+
+
+def _hasher_param(algorithm, name, default):
+    return getattr(settings, 'PASSWORD_HASHER_PARAMS', {}).get(algorithm, {}).get(name, default)
+
+
+class TunedArgon2PasswordHasher(hashers.Argon2PasswordHasher):
+
+    @property
+    def time_cost(self):
+        return _hasher_param('argon2', 'time_cost', hashers.Argon2PasswordHasher.time_cost)
+
+    @property
+    def memory_cost(self):
+        return _hasher_param('argon2', 'memory_cost', hashers.Argon2PasswordHasher.memory_cost)
+
+    @property
+    def parallelism(self):
+        return _hasher_param('argon2', 'parallelism', hashers.Argon2PasswordHasher.parallelism)
+
+
+class TunedBCryptSHA256PasswordHasher(hashers.BCryptSHA256PasswordHasher):
+
+    @property
+    def rounds(self):
+        return _hasher_param('bcrypt_sha256', 'rounds', hashers.BCryptSHA256PasswordHasher.rounds)
+
+
+class TunedPBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+
+    @property
+    def iterations(self):
+        return _hasher_param('pbkdf2_sha256', 'iterations', hashers.PBKDF2PasswordHasher.iterations)
+
+
+class PasswordHashingBusy(exceptions.APIException):
+    status_code = 503
+    default_detail = 'Too many logins in progress, try again shortly.'
+    default_code = 'password_hashing_busy'
+
+
+class PasswordHashingPool:
+    # Caps how many password hashes are computed at once so a login storm cannot take every core.
+    # Callers wait up to ``timeout`` seconds for a free worker, then get PasswordHashingBusy.
+
+    def __init__(self, max_workers, timeout):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='password-hashing')
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def run(self, func, *args, **kwargs):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PasswordHashingBusy()
+        try:
+            return self._executor.submit(func, *args, **kwargs).result()
+        finally:
+            self._slots.release()
+
+
+password_hashing_pool = PasswordHashingPool(
+    max_workers=getattr(settings, 'PASSWORD_HASHING_WORKERS', 2),
+    timeout=getattr(settings, 'PASSWORD_HASHING_TIMEOUT', 5),
+)
@@ -0,0 +1,204 @@
+import hashlib
+import http.client
+import ipaddress
+import logging
+import multiprocessing
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from urllib.request import HTTPErrorProcessor, HTTPDefaultErrorHandler, HTTPHandler, HTTPRedirectHandler, \
+    HTTPSHandler, OpenerDirector, Request
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from .tasks import task
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    # Case-insensitive parts lowercased, default port and fragment dropped, query sorted.
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if ':' in host:
+        host = f'[{host}]'
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{parts.port}'
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+
+def url_key(url):
+    return hashlib.sha256(normalize_url(url).encode()).hexdigest()
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def variant_path(digest, name):
+    # Content addressed, so identical pictures behind different URLs share their variants.
+    return f'images/variants/{digest[:2]}/{digest}/{name}.jpg'
+
+
+class BlockedAddress(OSError):
+    pass
+
+
+def is_public_address(address):
+    ip = ipaddress.ip_address(address)
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def create_public_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    # socket.create_connection, refusing hosts that resolve to loopback, private, link-local (cloud
+    # metadata) and other non-public addresses. The address checked is the one connected to, so a
+    # second DNS answer cannot swap it. IMAGE_FETCH_PRIVATE_NETWORKS lifts this for development.
+    host, port = address
+    allow_private = getattr(settings, 'IMAGE_FETCH_PRIVATE_NETWORKS', False)
+    error = None
+    for family, socktype, proto, _, sockaddr in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+        if not allow_private and not is_public_address(sockaddr[0]):
+            error = BlockedAddress(f'{host} resolves to the non-public address {sockaddr[0]}')
+            continue
+        sock = socket.socket(family, socktype, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as exc:
+            sock.close()
+            error = exc
+    raise error or OSError(f'{host} did not resolve')
+
+
+class PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = create_public_connection
+
+
+class PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = create_public_connection
+
+
+class PublicHTTPHandler(HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(PublicHTTPConnection, req)
+
+
+class PublicHTTPSHandler(HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(PublicHTTPSConnection, req, context=self._context)
+
+
+def build_fetch_opener():
+    # http and https only (no ftp or file, no environment proxies), every connection, redirects
+    # included, going through create_public_connection.
+    opener = OpenerDirector()
+    for handler in (PublicHTTPHandler(), PublicHTTPSHandler(), HTTPRedirectHandler(),
+                    HTTPDefaultErrorHandler(), HTTPErrorProcessor()):
+        opener.add_handler(handler)
+    return opener
+
+
+class ImagePipeline:
+    # Fetches pending images, then renders the IMAGE_VARIANTS sizes for them in a process pool.
+    # Each image is a process_image task, queued with the transaction that created the image.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._renderers = None
+
+    def get_renderers(self):
+        workers = getattr(settings, 'IMAGE_PROCESS_WORKERS', 2)
+        if not workers:
+            return None
+        with self._lock:
+            if self._renderers is None:
+                self._renderers = ProcessPoolExecutor(max_workers=workers,
+                                                      mp_context=multiprocessing.get_context('spawn'))
+            return self._renderers
+
+    def schedule(self, image_pks, using=None):
+        image_pks = list(image_pks)
+        if image_pks and getattr(settings, 'IMAGE_PIPELINE_ENABLED', True):
+            process_image.enqueue_many([({'image_pk': str(pk)}, f'process_image:{pk}') for pk in image_pks],
+                                       using=using)
+
+    def fetch(self, url):
+        # Merchant supplied URLs, so only public http(s) hosts; see create_public_connection.
+        if urlsplit(url).scheme.lower() not in ('http', 'https'):
+            raise ValueError(f'Image URL {url} is not http or https')
+        limit = getattr(settings, 'IMAGE_MAX_BYTES', 10 * 1024 * 1024)
+        request = Request(url, headers={'User-Agent': 'EcoFoods image pipeline'})
+        with build_fetch_opener().open(request, timeout=getattr(settings, 'IMAGE_FETCH_TIMEOUT', 10)) as response:
+            data = response.read(limit + 1)
+        if len(data) > limit:
+            raise ValueError(f'Image at {url} is larger than {limit} bytes')
+        return data
+
+    def read_original(self, image):
+        if image.original:
+            with image.original.open('rb') as f:
+                return f.read()
+        return self.fetch(image.url)
+
+    def render(self, data):
+        from .thumbnails import render_variants
+
+        sizes = settings.IMAGE_VARIANTS
+        renderers = self.get_renderers()
+        if renderers is None:
+            return render_variants(data, sizes)
+        return renderers.submit(render_variants, data, sizes).result()
+
+    def process(self, pk, raise_errors=False):
+        # raise_errors leaves a failed image pending and raises instead, for the task to retry it.
+        from .models import Image
+
+        image = Image.objects.get(pk=pk)
+        try:
+            data = self.read_original(image)
+            digest = content_hash(data)
+            variants = {name: variant_path(digest, name) for name in settings.IMAGE_VARIANTS}
+            if not all(default_storage.exists(path) for path in variants.values()):
+                for name, rendered in self.render(data).items():
+                    if not default_storage.exists(variants[name]):
+                        default_storage.save(variants[name], ContentFile(rendered))
+        except Exception:
+            if raise_errors:
+                raise
+            logger.warning('Could not process image %s from %s', pk, image.url, exc_info=True)
+            Image.objects.filter(pk=pk).update(status=Image.STATUS_FAILED)
+            return None
+
+        Image.objects.filter(pk=pk).update(content_hash=digest, variants=variants, status=Image.STATUS_READY)
+        return variants
+
+
+image_pipeline = ImagePipeline()
+
+
+def mark_image_failed(image_pk):
+    from .models import Image
+
+    Image.objects.filter(pk=image_pk).update(status=Image.STATUS_FAILED)
+
+
+@task(on_failure=mark_image_failed)
+def process_image(image_pk):
+    image_pipeline.process(image_pk, raise_errors=True)
@@ -0,0 +1,158 @@
+import bisect
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from rest_framework import serializers
+
+current_metrics = ContextVar('current_metrics', default=None)
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.wall_ms = 0.0
+        self.db_ms = 0.0
+        self.serializer_ms = 0.0
+        self.render_ms = 0.0
+        self.queries = Counter()
+        self.response_bytes = 0
+
+    @property
+    def query_count(self):
+        return sum(self.queries.values())
+
+    @property
+    def duplicate_queries(self):
+        return sum(count - 1 for count in self.queries.values() if count > 1)
+
+    def repeated_queries(self, threshold):
+        return [(sql, count) for sql, count in self.queries.most_common() if count >= threshold]
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_ms += (time.perf_counter() - started) * 1000
+            self.queries[sql] += 1
+
+    def finish(self, response_bytes):
+        self.wall_ms = (time.perf_counter() - self.started) * 1000
+        self.response_bytes = response_bytes
+
+    def server_timing(self):
+        return ', '.join([
+            f'total;dur={self.wall_ms:.1f}',
+            f'db;dur={self.db_ms:.1f};desc="{self.query_count} queries, {self.duplicate_queries} duplicates"',
+            f'serializer;dur={self.serializer_ms:.1f}',
+            f'render;dur={self.render_ms:.1f}',
+        ])
+
+    def as_dict(self):
+        return {
+            'wall_ms': round(self.wall_ms, 3),
+            'db_ms': round(self.db_ms, 3),
+            'serializer_ms': round(self.serializer_ms, 3),
+            'render_ms': round(self.render_ms, 3),
+            'queries': self.query_count,
+            'duplicate_queries': self.duplicate_queries,
+            'response_bytes': self.response_bytes,
+        }
+
+
+@contextmanager
+def timed(attribute):
+    # Adds the time spent in the block, minus database time, to ``attribute`` of the current request.
+    metrics = current_metrics.get()
+    if metrics is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    db_ms = metrics.db_ms
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000 - (metrics.db_ms - db_ms)
+        setattr(metrics, attribute, getattr(metrics, attribute) + elapsed)
+
+
+class TimedListSerializer(serializers.ListSerializer):
+
+    @property
+    def data(self):
+        with timed('serializer_ms'):
+            return super().data
+
+
+class TimedSerializerMixin:
+
+    @property
+    def data(self):
+        with timed('serializer_ms'):
+            return super().data
+
+
+class Histogram:
+    buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    metrics = {
+        'wall_ms': Histogram.buckets,
+        'db_ms': Histogram.buckets,
+        'serializer_ms': Histogram.buckets,
+        'queries': (1, 2, 5, 10, 20, 50, 100, 500),
+        'response_bytes': (1024, 10240, 102400, 1048576, 10485760),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def observe(self, view, metrics):
+        values = metrics.as_dict()
+        with self._lock:
+            for name, buckets in self.metrics.items():
+                key = (name, view)
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram(buckets)
+                histogram.observe(values[name])
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self._lock:
+            for (name, view), histogram in sorted(self._histograms.items()):
+                metric = f'ecofoods_request_{name}'
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{view="{view}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{metric}_sum{{view="{view}"}} {histogram.sum}')
+                lines.append(f'{metric}_count{{view="{view}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics_registry = MetricsRegistry()
@@ -0,0 +1,24 @@
+from .models import Product
+from .pagination import HomeFeedPagination
+
+
+class HomeFeedLoader:
+    advertisings_limit = 20
+
+    def __init__(self, queryset=None, paginator=None):
+        if queryset is None:
+            queryset = Product.objects.select_related('merchant')
+        self.queryset = queryset
+        self.paginator = paginator or HomeFeedPagination()
+
+    def load(self, request, view=None):
+        announcements = self.paginator.paginate_queryset(self.queryset, request, view=view)
+
+        # Advertisings only ride along with the first page of the feed.
+        advertisings = []
+        if self.paginator.cursor is None:
+            advertisings = list(
+                self.queryset.filter(is_featured=True).order_by(*self.paginator.ordering)[:self.advertisings_limit]
+            )
+
+        return announcements, advertisings
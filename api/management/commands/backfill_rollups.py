@@ -0,0 +1,90 @@
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Min, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from api.models import Order, OrderItem, Review, ProductDailyStats, MerchantOrderStats
+
+
+class Command(BaseCommand):
+    help = "Rebuild ProductDailyStats and MerchantOrderStats from orders and reviews, a window of days at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="First day to rebuild (YYYY-MM-DD), defaults to the oldest order or review")
+        parser.add_argument('--chunk-days', type=int, default=7)
+
+    def handle(self, *args, **options):
+        if options['chunk_days'] < 1:
+            raise CommandError('--chunk-days must be at least 1')
+
+        if options['since']:
+            first_day = parse_date(options['since'])
+            if first_day is None:
+                raise CommandError('--since must be a date (YYYY-MM-DD)')
+        else:
+            oldest = [value for value in (Order.objects.aggregate(oldest=Min('created_at'))['oldest'],
+                                          Review.objects.aggregate(oldest=Min('created_at'))['oldest'])
+                      if value is not None]
+            if not oldest:
+                self.stdout.write("Nothing to backfill")
+                return
+            first_day = timezone.localdate(min(oldest))
+
+        last_day = timezone.localdate()
+        day = first_day
+        rows = 0
+        while day <= last_day:
+            end = min(day + timedelta(days=options['chunk_days'] - 1), last_day)
+            rows += self.rebuild(day, end)
+            day = end + timedelta(days=1)
+
+        self.stdout.write(f"Rebuilt {rows} rollup rows from {first_day} to {last_day}")
+
+    @staticmethod
+    def rebuild(first_day, last_day):
+        # Replaces the rows of [first_day, last_day] in one transaction, so the window is never
+        # seen half rebuilt and the command can be re-run safely.
+        start = timezone.make_aware(datetime.combine(first_day, time.min))
+        end = timezone.make_aware(datetime.combine(last_day + timedelta(days=1), time.min))
+
+        with transaction.atomic():
+            ProductDailyStats.objects.filter(day__range=(first_day, last_day)).delete()
+            MerchantOrderStats.objects.filter(day__range=(first_day, last_day)).delete()
+
+            products = {}
+            sales = OrderItem.objects.filter(order__created_at__gte=start, order__created_at__lt=end)\
+                .values('product_id', merchant_id=F('product__merchant_id'), day=TruncDate('order__created_at'))\
+                .annotate(orders=Count('order_id', distinct=True), units_sold=Sum('quantity'),
+                          revenue=Sum(F('quantity') * F('price'),
+                                  output_field=DecimalField(max_digits=14, decimal_places=2)))
+            for row in sales:
+                key = (row['merchant_id'], row['product_id'], row['day'])
+                products[key] = ProductDailyStats(
+                    merchant_id=row['merchant_id'], product_id=row['product_id'], day=row['day'],
+                    orders=row['orders'], units_sold=row['units_sold'], revenue=row['revenue'],
+                )
+
+            # Review.merchant is the reviewer, the product's merchant comes through product__merchant_id
+            reviews = Review.objects.filter(created_at__gte=start, created_at__lt=end)\
+                .values('product_id', 'product__merchant_id', day=TruncDate('created_at'))\
+                .annotate(review_count=Count('pk'), rating_sum=Sum('rating'))
+            for row in reviews:
+                key = (row['product__merchant_id'], row['product_id'], row['day'])
+                stats = products.setdefault(key, ProductDailyStats(
+                    merchant_id=row['product__merchant_id'], product_id=row['product_id'], day=row['day']))
+                stats.review_count, stats.rating_sum = row['review_count'], row['rating_sum']
+
+            statuses = OrderItem.objects.filter(order__created_at__gte=start, order__created_at__lt=end)\
+                .values(merchant_id=F('product__merchant_id'), day=TruncDate('order__created_at'),
+                        status=F('order__status'))\
+                .annotate(orders=Count('order_id', distinct=True))
+            orders = [MerchantOrderStats(**row) for row in statuses]
+
+            ProductDailyStats.objects.bulk_create(products.values(), batch_size=1000)
+            MerchantOrderStats.objects.bulk_create(orders, batch_size=1000)
+
+        return len(products) + len(orders)
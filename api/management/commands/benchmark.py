@@ -0,0 +1,79 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases, setup_test_environment, \
+    teardown_test_environment
+
+from api.benchmark import SyntheticDataset, run_benchmarks, check_budgets, load_budgets, dump_budgets
+
+DEFAULT_BUDGETS = Path(__file__).resolve().parent.parent.parent / 'benchmark_budgets.json'
+
+
+class Command(BaseCommand):
+    help = ("Seed a throwaway test database with synthetic data and benchmark the API endpoints. "
+            "Use --settings=EcoFoods.settings_benchmark to run against SQLite.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--merchants', type=int, default=10)
+        parser.add_argument('--products', type=int, default=1000)
+        parser.add_argument('--images-per-product', type=int, default=2)
+        parser.add_argument('--reviews', type=int, default=2000)
+        parser.add_argument('--chats', type=int, default=50)
+        parser.add_argument('--messages-per-chat', type=int, default=50)
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--budgets', default=str(DEFAULT_BUDGETS))
+        parser.add_argument('--latency-tolerance', type=float, default=1.5,
+                            help="Allowed p95 slowdown factor before a latency budget counts as exceeded")
+        parser.add_argument('--latency-floor', type=float, default=5.0,
+                            help="Allowed p95 slowdown in ms, whatever the factor, for the fast endpoints")
+        parser.add_argument('--strict-latency', action='store_true',
+                            help="Fail on exceeded latency budgets too, not only on query budgets. "
+                                 "Only meaningful on the machine the budgets were measured on")
+        parser.add_argument('--update-budgets', action='store_true',
+                            help="Write the measured numbers as the new budgets instead of checking them")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            dataset = SyntheticDataset(
+                users=options['users'],
+                merchants=options['merchants'],
+                products=options['products'],
+                images_per_product=options['images_per_product'],
+                reviews=options['reviews'],
+                chats=options['chats'],
+                messages_per_chat=options['messages_per_chat'],
+            ).load()
+            results = run_benchmarks(dataset, iterations=options['iterations'], warmup=options['warmup'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f"{connection.vendor}, {options['products']} products, {options['iterations']} iterations")
+        self.stdout.write(f"{'endpoint':<20}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}"
+                          f"{'queries':>9}{'bytes':>10}")
+        for name, result in results.items():
+            self.stdout.write(f"{name:<20}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}"
+                              f"{result['rps']:>10}{result['queries']:>9}{result['bytes']:>10}")
+
+        if options['update_budgets']:
+            dump_budgets(results, options['budgets'])
+            self.stdout.write(f"Budgets written to {options['budgets']}")
+            return
+
+        if not Path(options['budgets']).exists():
+            return
+
+        regressions, slowdowns = check_budgets(results, load_budgets(options['budgets']),
+                                               options['latency_tolerance'], options['latency_floor'])
+        if options['strict_latency']:
+            regressions, slowdowns = regressions + slowdowns, []
+        for slowdown in slowdowns:
+            self.stderr.write(self.style.WARNING(f"Slower than budget (not failing): {slowdown}"))
+        if regressions:
+            raise CommandError("Budgets exceeded:\n" + '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS("Query budgets met" if slowdowns else "All budgets met"))
@@ -0,0 +1,106 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.models import OrderItem, Review, Recommendation
+
+try:
+    from api import similarity
+except ImportError:
+    similarity = None
+
+
+class Command(BaseCommand):
+    help = "Precompute every user's top products from orders and reviews (item-item collaborative filtering)"
+    # Interaction weight of an ordered product, and of a review by its rating (1 to 5 stars)
+    order_weight = 1.0
+
+    @staticmethod
+    def review_weight(rating):
+        return (float(rating) - 3) / 2
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help="Processes scoring users, 1 scores them in this process")
+        parser.add_argument('--top', type=int, default=getattr(settings, 'RECOMMENDATIONS_TOP_N', 20))
+        parser.add_argument('--neighbours', type=int, default=getattr(settings, 'RECOMMENDATIONS_NEIGHBOURS', 50),
+                            help="Similar products kept per product")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Users per task and per transaction")
+
+    def handle(self, *args, **options):
+        if similarity is None:
+            raise CommandError('compute_recommendations needs numpy and scipy')
+        for name in ('workers', 'top', 'neighbours', 'chunk_size'):
+            if options[name] < 1:
+                raise CommandError(f"--{name.replace('_', '-')} must be at least 1")
+
+        users, products = {}, {}
+        user_indexes, product_indexes, weights = [], [], []
+
+        def add(user_id, product_id, weight):
+            user_indexes.append(users.setdefault(user_id, len(users)))
+            product_indexes.append(products.setdefault(product_id, len(products)))
+            weights.append(weight)
+
+        for user_id, product_id in OrderItem.objects.values_list('order__user_id', 'product_id')\
+                .iterator(chunk_size=10000):
+            add(user_id, product_id, self.order_weight)
+        for user_id, product_id, rating in Review.objects.values_list('merchant_id', 'product_id', 'rating')\
+                .iterator(chunk_size=10000):
+            add(user_id, product_id, self.review_weight(rating))
+
+        if not users:
+            Recommendation.objects.all().delete()
+            self.stdout.write("No orders or reviews to recommend from")
+            return
+
+        shape = (len(users), len(products))
+        interactions = similarity.interaction_matrix(user_indexes, product_indexes, weights, shape)
+        seen = similarity.seen_matrix(user_indexes, product_indexes, shape)
+        del user_indexes, product_indexes, weights
+        item_similarity = similarity.item_similarity(interactions, options['neighbours'])
+
+        user_ids, product_ids = list(users), list(products)
+        starts = range(0, len(user_ids), options['chunk_size'])
+        chunks = ([interactions[start:start + options['chunk_size']] for start in starts],
+                  [seen[start:start + options['chunk_size']] for start in starts],
+                  [options['top']] * len(starts))
+
+        recommended = 0
+        if options['workers'] <= 1 or len(starts) <= 1:
+            similarity.init_worker(item_similarity)
+            results = map(similarity.recommend_chunk, *chunks)
+            recommended = self.save_chunks(starts, results, user_ids, product_ids, options['chunk_size'])
+        else:
+            with ProcessPoolExecutor(max_workers=options['workers'], mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=similarity.init_worker, initargs=(item_similarity,)) as executor:
+                results = executor.map(similarity.recommend_chunk, *chunks)
+                recommended = self.save_chunks(starts, results, user_ids, product_ids, options['chunk_size'])
+
+        items, scores = similarity.popular_items(interactions, options['top'])
+        with transaction.atomic():
+            Recommendation.objects.replace([None], [
+                Recommendation(user_id=None, rank=rank, product_id=product_ids[item], score=score)
+                for rank, (item, score) in enumerate(zip(items.tolist(), scores.tolist()))
+            ])
+            # Users without orders or reviews any more get the popular products again
+            Recommendation.objects.prune(user_ids)
+
+        self.stdout.write(f"Recommended products to {recommended} of {len(user_ids)} users, "
+                          f"from {len(product_ids)} products")
+
+    @staticmethod
+    def save_chunks(starts, results, user_ids, product_ids, chunk_size):
+        # Chunks are saved as the workers finish them, each replacing the rows of its users.
+        recommended = 0
+        for start, (rows, items, ranks, scores) in zip(starts, results):
+            Recommendation.objects.replace(user_ids[start:start + chunk_size], [
+                Recommendation(user_id=user_ids[start + row], rank=rank, product_id=product_ids[item], score=score)
+                for row, item, rank, score in zip(rows.tolist(), items.tolist(), ranks.tolist(), scores.tolist())
+            ])
+            recommended += len(set(rows.tolist()))
+        return recommended
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from api.exports import exports, EXPORT_FORMATS, format_value
+
+
+class Command(BaseCommand):
+    help = "Stream a dataset as CSV or NDJSON, in full or from a watermark (--since) for incremental exports"
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(exports))
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+        parser.add_argument('--since', help="Watermark (ISO 8601) printed by the previous export")
+        parser.add_argument('--output', help="File to write, defaults to stdout")
+        parser.add_argument('--chunk-size', type=int)
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError('--since must be a date and time (ISO 8601)')
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+        if options['chunk_size'] is not None and options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        export = exports[options['dataset']](since=since, chunk_size=options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(export.stream(options['format']))
+        else:
+            for piece in export.stream(options['format']):
+                self.stdout.write(piece, ending='')
+
+        # stderr, so the watermark does not end up in a dump written to stdout
+        if export.last_watermark is None:
+            self.stderr.write("Exported 0 rows")
+        else:
+            self.stderr.write(f"Exported {export.count} rows, next --since {format_value(export.last_watermark)}")
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from api.geo import geocoding_pipeline
+from api.models import User
+
+
+class Command(BaseCommand):
+    help = "Geocode the merchant addresses that have not been, e.g. the ones that existed before geocoding"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Geocode every merchant address again")
+
+    def handle(self, *args, **options):
+        merchants = User.objects.filter(is_merchant=True)
+        if options['all']:
+            merchants.update(geocoded_address='')
+        else:
+            merchants = merchants.exclude(address=F('geocoded_address'))
+        pks = list(merchants.values_list('pk', flat=True))
+
+        # One at a time, the geocoder spaces out its own requests.
+        located = sum(geocoding_pipeline.process(pk) is not None for pk in pks)
+        self.stdout.write(f"Geocoded {len(pks)} merchants, {located} located, {len(pks) - located} not found")
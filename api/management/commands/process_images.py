@@ -0,0 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api.images import image_pipeline
+from api.models import Image
+
+
+class Command(BaseCommand):
+    help = "Generate the IMAGE_VARIANTS of pending images, e.g. the ones that existed before the pipeline"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true')
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        statuses = [Image.STATUS_PENDING]
+        if options['retry_failed']:
+            statuses.append(Image.STATUS_FAILED)
+        pks = list(Image.objects.filter(status__in=statuses).values_list('pk', flat=True))
+
+        if options['workers'] <= 1:
+            ready = sum(image_pipeline.process(pk) is not None for pk in pks)
+        else:
+            def process(pk):
+                try:
+                    return image_pipeline.process(pk) is not None
+                finally:
+                    close_old_connections()
+
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                ready = sum(executor.map(process, pks))
+
+        self.stdout.write(f"Processed {len(pks)} images, {ready} ready, {len(pks) - ready} failed")
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from api.cache import home_feed_cache
+from api.models import Product, Review
+
+
+class Command(BaseCommand):
+    help = "Recompute Product.rating_count and Product.rating_sum from Review rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        product_ids = Product.objects.order_by('pk').values_list('pk', flat=True)
+
+        last_pk = None
+        fixed = total = 0
+        while True:
+            batch = product_ids.filter(pk__gt=last_pk) if last_pk is not None else product_ids
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1]
+
+            with transaction.atomic():
+                # Locks the batch so concurrent review writes cannot interleave with the recount.
+                products = list(Product.objects.select_for_update().filter(pk__in=batch)
+                                .only('pk', 'rating_count', 'rating_sum', 'date_modified'))
+                aggregates = {
+                    row['product']: (row['count'], row['sum'])
+                    for row in Review.objects.filter(product__in=batch).values('product')
+                    .annotate(count=Count('pk'), sum=Sum('rating'))
+                }
+
+                stale = []
+                now = timezone.now()
+                for product in products:
+                    count, rating_sum = aggregates.get(product.pk, (0, 0))
+                    if product.rating_count != count or product.rating_sum != rating_sum:
+                        product.rating_count, product.rating_sum = count, rating_sum
+                        # bulk_update skips auto_now; repaired ratings have to reach the exports too
+                        product.date_modified = now
+                        stale.append(product)
+                Product.objects.bulk_update(stale, ['rating_count', 'rating_sum', 'date_modified'])
+                if stale:
+                    # The feed shows the ratings
+                    transaction.on_commit(home_feed_cache.invalidate)
+
+            fixed += len(stale)
+            total += len(batch)
+
+        self.stdout.write(f"Checked {total} products, fixed {fixed}")
@@ -0,0 +1,26 @@
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.tasks import TaskWorker
+
+
+class Command(BaseCommand):
+    help = "Run queued background tasks (image processing, geocoding) until stopped"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help="Threads running tasks")
+        parser.add_argument('--once', action='store_true', help="Exit once no task is due instead of polling")
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+
+        worker = TaskWorker(workers=options['workers'])
+        # SIGTERM (e.g. a deploy) and Ctrl-C let the running tasks finish; anything unfinished
+        # is picked up again once its lease expires.
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: worker.stop())
+
+        processed = worker.run(once=options['once'])
+        self.stdout.write(f"Ran {processed} tasks")
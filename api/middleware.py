@@ -0,0 +1,241 @@
+import asyncio
+import gzip
+import json
+import logging
+import random
+import zlib
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import OperationalError, connections
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+from .instrumentation import RequestMetrics, current_metrics, metrics_registry
+from .routers import current_read_state, read_from_replica, replica_reads, replica_set, write_pins
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger('api.performance')
+
+
+class PerformanceMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PERFORMANCE_SAMPLE_RATE', 0.0)
+        self.duplicate_threshold = getattr(settings, 'PERFORMANCE_DUPLICATE_QUERY_THRESHOLD', 5)
+        if asyncio.iscoroutinefunction(self.get_response):
+            # Marks the instance as a coroutine function for Django's handler, see the
+            # "Asynchronous support" section of the middleware docs.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        if not self.is_sampled():
+            return self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics.execute_wrapper))
+                response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+
+        return self.record(request, response, metrics)
+
+    async def __acall__(self, request):
+        if not self.is_sampled():
+            return await self.get_response(request)
+
+        # Queries run on other threads; api.asyncdb installs the execute wrapper there.
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+
+        return self.record(request, response, metrics)
+
+    def is_sampled(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def record(self, request, response, metrics):
+        metrics.finish(0 if response.streaming else len(response.content))
+        response['Server-Timing'] = metrics.server_timing()
+
+        match = request.resolver_match
+        view = match.url_name or match.view_name if match else 'unresolved'
+        metrics_registry.observe(view, metrics)
+
+        record = dict(metrics.as_dict(), view=view, method=request.method, status=response.status_code)
+        repeated = metrics.repeated_queries(self.duplicate_threshold)
+        if repeated:
+            record['repeated_queries'] = [{'sql': sql, 'count': count} for sql, count in repeated]
+            logger.warning(json.dumps(record))
+        else:
+            logger.info(json.dumps(record))
+
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    # Safe-method requests read from a replica (see api.routers.PrimaryReplicaRouter). A user who
+    # writes is pinned to the primary for DATABASE_REPLICA_PIN_SECONDS, so the next requests read
+    # their own writes.
+    sync_capable = True
+    async_capable = True
+    safe_methods = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        if request.method in self.safe_methods:
+            with replica_reads():
+                return self.get_response(request)
+
+        response = self.get_response(request)
+        self.pin_writer(request, response)
+        return response
+
+    async def __acall__(self, request):
+        if request.method in self.safe_methods:
+            with replica_reads():
+                return await self.get_response(request)
+
+        response = await self.get_response(request)
+        self.pin_writer(request, response)
+        return response
+
+    def pin_writer(self, request, response):
+        # DRF sets the authenticated user on the Django request too. Server errors roll back.
+        if not getattr(settings, 'DATABASE_REPLICAS', ()) or response.status_code >= 500:
+            return
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            write_pins.pin(user.pk)
+
+    def process_exception(self, request, exception):
+        # A replica that went away is skipped until it has had time to come back.
+        if isinstance(exception, OperationalError) and read_from_replica():
+            replica_set.mark_down(current_read_state.get().alias)
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    # Compresses responses with brotli (when installed) or gzip, whichever the client prefers.
+    # Fast settings by default: most of the size win for a fraction of the CPU of the maximum levels.
+
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        self.min_length = getattr(settings, 'RESPONSE_COMPRESSION_MIN_LENGTH', 512)
+        self.gzip_level = getattr(settings, 'RESPONSE_COMPRESSION_GZIP_LEVEL', 5)
+        self.brotli_quality = getattr(settings, 'RESPONSE_COMPRESSION_BROTLI_QUALITY', 4)
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+        self.streaming_types = ('text/', 'application/json', 'application/x-ndjson')
+
+    def negotiate(self, accept_encoding):
+        # The supported coding with the highest q-value, brotli winning ties.
+        qualities = {}
+        for part in accept_encoding.split(','):
+            coding, _, params = part.strip().partition(';')
+            quality = 1.0
+            for param in params.split(';'):
+                name, _, value = param.strip().partition('=')
+                if name == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            qualities[coding.strip().lower()] = quality
+
+        best = None
+        for encoding in self.encodings:
+            quality = qualities.get(encoding, qualities.get('*', 0.0))
+            if quality > 0 and (best is None or quality > best[1]):
+                best = (encoding, quality)
+        return best[0] if best else None
+
+    def compress(self, content, encoding):
+        if encoding == 'br':
+            return brotli.compress(content, quality=self.brotli_quality)
+        return gzip.compress(content, compresslevel=self.gzip_level, mtime=0)
+
+    def stream_compressor(self, encoding):
+        # (compress, finish) for one stream
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            return compressor.process, compressor.finish
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress, compressor.flush
+
+    def compress_stream(self, chunks, encoding):
+        # Chunks are not flushed individually, the compressor keeps its window of the stream only.
+        compress, finish = self.stream_compressor(encoding)
+        for chunk in chunks:
+            data = compress(chunk)
+            if data:
+                yield data
+        yield finish()
+
+    def process_streaming_response(self, request, response):
+        # Text streams such as the exports; streamed files (media) are mostly compressed already, and
+        # event streams need every chunk delivered as it is written.
+        content_type = response.get('Content-Type', '')
+        if (response.has_header('Content-Encoding') or not content_type.startswith(self.streaming_types)
+                or content_type.startswith('text/event-stream')):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = self.negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        response.streaming_content = self.compress_stream(response.streaming_content, encoding)
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
+        response['Content-Encoding'] = encoding
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
+
+    def process_response(self, request, response):
+        if response.streaming:
+            return self.process_streaming_response(request, response)
+        if response.has_header('Content-Encoding') or len(response.content) < self.min_length:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = self.negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        compressed = self.compress(response.content, encoding)
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        # The ETag describes the uncompressed body, as with Django's GZipMiddleware.
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
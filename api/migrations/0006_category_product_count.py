@@ -0,0 +1,31 @@
+# Generated by Django 3.1.2 on 2026-10-18 09:48
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_product_counts(apps, schema_editor):
+    Category = apps.get_model('api', 'Category')
+    ProductCategory = apps.get_model('api', 'ProductCategory')
+
+    links = ProductCategory.objects.filter(category=OuterRef('pk')).order_by().values('category')
+    Category.objects.update(
+        product_count=Coalesce(Subquery(links.annotate(count=Count('pk')).values('count')), Value(0)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_order_placement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='product_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_product_counts, migrations.RunPython.noop),
+    ]
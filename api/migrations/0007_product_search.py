@@ -0,0 +1,66 @@
+from django.db import migrations
+
+
+POSTGRES_INSTALL = [
+    "ALTER TABLE api_product ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'B')) STORED",
+    "CREATE INDEX product_search_idx ON api_product USING gin (search_vector)",
+]
+
+POSTGRES_UNINSTALL = [
+    "DROP INDEX IF EXISTS product_search_idx",
+    "ALTER TABLE api_product DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_INSTALL = [
+    "CREATE VIRTUAL TABLE api_product_search USING fts5("
+    "product_id UNINDEXED, name, description, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+]
+
+# The FTS5 rowid is the top 63 bits of the product UUID, stored as 32 hex digits (see
+# api.search.SQLiteProductSearch.rowid); product_rowid() is registered on the connection below.
+SQLITE_BACKFILL = (
+    "INSERT INTO api_product_search (rowid, product_id, name, description) "
+    "SELECT product_rowid(uuid), uuid, name, description FROM api_product"
+)
+
+SQLITE_UNINSTALL = [
+    "DROP TABLE IF EXISTS api_product_search",
+]
+
+
+def install_search(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for sql in POSTGRES_INSTALL:
+            schema_editor.execute(sql)
+    elif vendor == 'sqlite':
+        for sql in SQLITE_INSTALL:
+            schema_editor.execute(sql)
+
+        schema_editor.connection.ensure_connection()
+        schema_editor.connection.connection.create_function(
+            'product_rowid', 1, lambda value: int(value.replace('-', ''), 16) >> 65)
+        schema_editor.execute(SQLITE_BACKFILL)
+
+
+def uninstall_search(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for sql in POSTGRES_UNINSTALL:
+            schema_editor.execute(sql)
+    elif vendor == 'sqlite':
+        for sql in SQLITE_UNINSTALL:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_category_product_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search, uninstall_search),
+    ]
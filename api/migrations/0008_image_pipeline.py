@@ -0,0 +1,85 @@
+# Generated by Django 3.1.2 on 2026-10-18 10:03
+
+import hashlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from django.db import migrations, models
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def url_key(url):
+    # api.images.url_key as of this migration, copied so later changes there do not alter it
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if ':' in host:
+        host = f'[{host}]'
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{parts.port}'
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return hashlib.sha256(urlunsplit((scheme, host, parts.path or '/', query, '')).encode()).hexdigest()
+
+
+def deduplicate_image_urls(apps, schema_editor):
+    # Existing rows get their url_key; rows sharing one are folded into the first of them. Every
+    # row referencing a duplicate (product, review and category images) is repointed first, or
+    # deleting the duplicate would cascade to it.
+    Image = apps.get_model('api', 'Image')
+    references = [
+        (relation.related_model, relation.field.attname)
+        for relation in Image._meta.related_objects
+        if relation.one_to_many
+    ]
+
+    survivors = {}
+    for image in Image.objects.order_by('pk').only('pk', 'url').iterator():
+        key = url_key(image.url)
+        survivor = survivors.setdefault(key, image.pk)
+        if survivor == image.pk:
+            Image.objects.filter(pk=image.pk).update(url_key=key)
+        else:
+            for model, attname in references:
+                model.objects.filter(**{attname: image.pk}).update(**{attname: survivor})
+            Image.objects.filter(pk=image.pk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_product_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='content_hash',
+            field=models.CharField(db_index=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='original',
+            field=models.FileField(blank=True, upload_to='images/originals/'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='url_key',
+            field=models.CharField(editable=False, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.RunPython(deduplicate_image_urls, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='image',
+            name='url_key',
+            field=models.CharField(editable=False, max_length=64, null=True, unique=True),
+        ),
+    ]
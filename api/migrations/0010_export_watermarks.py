@@ -0,0 +1,37 @@
+# Generated by Django 3.1.2 on 2026-10-18 10:17
+
+from django.db import migrations, models
+
+
+def set_date_modified(apps, schema_editor):
+    # Without a history, existing products count as last modified when they were created.
+    Product = apps.get_model('api', 'Product')
+    Product.objects.update(date_modified=models.F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_merchant_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='date_modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(set_date_modified, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created_at', 'uuid'], name='order_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['date_modified', 'uuid'], name='product_modified_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['created_at', 'uuid'], name='review_created_idx'),
+        ),
+    ]
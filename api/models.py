@@ -1,30 +1,109 @@
+import os
 import uuid
+from collections import Counter
 from datetime import datetime, timedelta
+from decimal import Decimal
 
-from django.db import models
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import F
+from django.utils import timezone
 from django.core import validators
+from django.contrib.auth.hashers import check_password, make_password
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
 from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
 
 import jwt
 
+from .hashers import password_hashing_pool
+from .images import image_pipeline, url_key as image_url_key, content_hash as image_content_hash
 from .utils import UUIDEncoder
 
 
 class ImageManager(models.Manager):
 
     def create_image(self, url):
-        image = self.model(
-            url=url,
-        )
-        image.save(using=self._db)
+        # get_or_create without its transaction when there is no outer one: in autocommit an
+        # INSERT that loses a race to the unique url_key leaves nothing to roll back.
+        key = image_url_key(url)
+        image = self.filter(url_key=key).first()
+        if image is not None:
+            return image
+
+        image = self.model(url=url, url_key=key)
+        try:
+            if connections[self.db].in_atomic_block:
+                with transaction.atomic(using=self.db):
+                    image.save(force_insert=True, using=self.db)
+            else:
+                image.save(force_insert=True, using=self.db)
+        except IntegrityError:
+            return self.get(url_key=key)
+        image_pipeline.schedule([image.pk], using=self.db)
 
         return image
 
+    def get_or_create_for_urls(self, urls):
+        # Maps each distinct normalized URL to one image, inserting only the ones not seen before.
+        urls_by_key = {}
+        for url in urls:
+            urls_by_key.setdefault(image_url_key(url), url)
+
+        images = {image.url_key: image for image in self.filter(url_key__in=urls_by_key)}
+        new_images = [self.model(url=url, url_key=key) for key, url in urls_by_key.items() if key not in images]
+        if new_images:
+            # A concurrent import may insert the same URL first, so read back the rows that won.
+            self.bulk_create(new_images, ignore_conflicts=True)
+            new_keys = [image.url_key for image in new_images]
+            created = {image.url_key: image for image in self.filter(url_key__in=new_keys)}
+            images.update(created)
+            image_pipeline.schedule([image.pk for image in created.values()], using=self._db)
+
+        return {url: images[image_url_key(url)] for url in urls}
+
+    def create_from_upload(self, upload):
+        limit = getattr(settings, 'IMAGE_MAX_BYTES', 10 * 1024 * 1024)
+        if upload.size is not None and upload.size > limit:
+            raise ValueError(f'Image is larger than {limit} bytes')
+        data = upload.read(limit + 1)
+        if len(data) > limit:
+            raise ValueError(f'Image is larger than {limit} bytes')
+        digest = image_content_hash(data)
+        image = self.filter(content_hash=digest).first()
+        if image is not None:
+            return image, False
+
+        extension = os.path.splitext(upload.name)[1].lower()[:10]
+        image = self.model(content_hash=digest)
+        image.original.save(f'{digest}{extension}', ContentFile(data), save=False)
+        image.url = image.original.url
+        image.save(using=self._db)
+        image_pipeline.schedule([image.pk], using=self._db)
+
+        return image, True
+
 
 class Image(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     url = models.URLField()
+    # sha256 of the normalized URL, unset for uploads
+    url_key = models.CharField(max_length=64, unique=True, null=True, editable=False)
+    # sha256 of the original bytes, known once uploaded or fetched
+    content_hash = models.CharField(max_length=64, null=True, db_index=True, editable=False)
+    original = models.FileField(upload_to='images/originals/', blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    # Variant name to storage path, see IMAGE_VARIANTS
+    variants = models.JSONField(default=dict, blank=True)
 
     objects = ImageManager()
 
@@ -57,12 +136,20 @@ class UserManager(BaseUserManager):
         return user
 
 
+TOKEN_LIFETIME = timedelta(days=30)
+
+
 class User(AbstractBaseUser, PermissionsMixin):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     # avatar = models.ForeignKey(Image, on_delete=models.CASCADE)
     first_name = models.CharField(max_length=255, blank=True)
     last_name = models.CharField(max_length=255, blank=True)
     address = models.CharField(max_length=255, blank=True)
+    # Set from ``address`` by api.geo.geocoding_pipeline, for merchants
+    geocoded_address = models.CharField(max_length=255, blank=True, editable=False)
+    latitude = models.FloatField(null=True, blank=True, editable=False)
+    longitude = models.FloatField(null=True, blank=True, editable=False)
+    geohash = models.CharField(max_length=12, null=True, blank=True, editable=False)
     is_merchant = models.BooleanField(default=False)
     phone_number = models.CharField(max_length=255, blank=True)
     date_created = models.DateTimeField(auto_now_add=True)
@@ -76,6 +163,9 @@ class User(AbstractBaseUser, PermissionsMixin):
     )
 
     is_active = models.BooleanField(default=True)
+    # Tokens carry the version they were issued with; a password change or deactivation
+    # bumps it, which revokes the ones issued before (see api.backends.TokenRevocations).
+    token_version = models.PositiveIntegerField(default=0, editable=False)
 
     USERNAME_FIELD = 'email'
 
@@ -83,6 +173,47 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     objects = UserManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['geohash'], name='user_geohash_idx'),
+            models.Index(fields=['date_modified'], name='user_modified_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_address = instance.__dict__.get('address')
+        instance._loaded_is_active = instance.__dict__.get('is_active')
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        # A user built from token claims (see api.backends.JWTAuth) loads all of its missing
+        # fields with the first one read, rather than one query per field.
+        if fields is not None and getattr(self, '_from_claims', False):
+            deferred = self.get_deferred_fields()
+            if deferred.issuperset(fields):
+                fields = list(deferred)
+        super().refresh_from_db(using=using, fields=fields)
+        if fields is None or 'address' in fields:
+            self._loaded_address = self.address
+        if fields is None or 'is_active' in fields:
+            self._loaded_is_active = self.is_active
+
+    def save(self, *args, **kwargs):
+        # Deactivating the account revokes its tokens, as a password change does.
+        if getattr(self, '_loaded_is_active', None) and self.__dict__.get('is_active') is False:
+            self._bump_token_version()
+        if getattr(self, '_revoked_version', None) is not None and kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'token_version', 'date_modified'}
+        super().save(*args, **kwargs)
+        self._loaded_is_active = self.__dict__.get('is_active')
+
+    def _bump_token_version(self):
+        if not self._state.adding:
+            self.token_version += 1
+            # Picked up by the post_save signal once the change commits
+            self._revoked_version = self.token_version
+
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
 
@@ -90,6 +221,23 @@ class User(AbstractBaseUser, PermissionsMixin):
     def token(self):
         return self._generate_jwt_token()
 
+    def set_password(self, raw_password):
+        self.password = password_hashing_pool.run(make_password, raw_password)
+        self._password = raw_password
+        self._bump_token_version()
+
+    def check_password(self, raw_password):
+        # Only the hash runs on the pool; an upgrade to the preferred hasher or parameters
+        # is saved from the calling thread so it stays inside the caller's transaction.
+        outdated = []
+        valid = password_hashing_pool.run(check_password, raw_password, self.password,
+                                          lambda raw: outdated.append(True))
+        if valid and outdated:
+            # Same password, newer hash: the tokens stay valid.
+            self.password = password_hashing_pool.run(make_password, raw_password)
+            self.save(update_fields=['password'])
+        return valid
+
     def get_full_name(self):
         return f"{self.first_name} {self.last_name}"
 
@@ -100,12 +248,19 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.last_name
 
     def _generate_jwt_token(self):
-        dt = datetime.now() + timedelta(days=30)
+        dt = datetime.now() + TOKEN_LIFETIME
 
-        token = jwt.encode({
+        claims = {
             'id': self.uuid,
-            'exp': int(dt.strftime('%s'))
-        },
+            'exp': int(dt.strftime('%s')),
+            'ver': self.token_version,
+        }
+        if getattr(settings, 'JWT_CLAIMS_TOKENS', False):
+            # Enough for JWTAuth to authenticate without reading the user row
+            claims.update(merchant=self.is_merchant, active=self.is_active)
+
+        token = jwt.encode(
+            claims,
             settings.SECRET_KEY, algorithm='HS256',
             json_encoder=UUIDEncoder
         )
@@ -113,6 +268,23 @@ class User(AbstractBaseUser, PermissionsMixin):
         return token.decode('utf-8')
 
 
+class UserDeletionManager(models.Manager):
+
+    def record(self, user_id):
+        # Rows older than TOKEN_LIFETIME are dropped along the way, their tokens have expired.
+        self.filter(deleted_at__lt=timezone.now() - TOKEN_LIFETIME).delete()
+        self.update_or_create(user_id=user_id, defaults={'deleted_at': timezone.now()})
+
+
+class UserDeletion(models.Model):
+    # Users deleted within TOKEN_LIFETIME. Their rows are gone, so this is where other processes
+    # learn that their claims tokens are revoked, see api.backends.TokenRevocations.
+    user_id = models.UUIDField(primary_key=True)
+    deleted_at = models.DateTimeField(db_index=True)
+
+    objects = UserDeletionManager()
+
+
 class ProductManager(models.Manager):
 
     def _create_product(self, user: User, **extra_fields):
@@ -131,6 +303,39 @@ class ProductManager(models.Manager):
     def create_product_from_merchant(self, user: User, **extra_fields):
         return self._create_product(user, **extra_fields)
 
+    def adjust_rating(self, product_id, count, total):
+        # update() skips auto_now, date_modified is set here so rating changes reach the exports.
+        return self.filter(pk=product_id).update(
+            rating_count=models.F('rating_count') + count,
+            rating_sum=models.F('rating_sum') + total,
+            date_modified=timezone.now(),
+        )
+
+    def touch(self, product_ids):
+        # For changes to rows the exports show as product columns (categories), see api.exports
+        return self.filter(pk__in=product_ids).update(date_modified=timezone.now())
+
+    def bulk_create_from_merchant(self, user: User, rows, batch_size=None):
+        if not user:
+            raise ValueError('User must be provided')
+
+        images = Image.objects.db_manager(self._db).get_or_create_for_urls([image_url for image_url, _, _ in rows])
+        products = []
+        links = []
+        category_links = []
+        for image_url, category_ids, fields in rows:
+            product = self.model(merchant=user, **fields)
+            products.append(product)
+            links.append(ProductImage(product=product, image=images[image_url]))
+            category_links.extend((product, category_id) for category_id in category_ids)
+
+        self.using(self._db).bulk_create(products, batch_size=batch_size)
+        ProductImage.objects.using(self._db).bulk_create(links, batch_size=batch_size)
+        if category_links:
+            ProductCategory.objects.db_manager(self._db).create_links(category_links, new_products=True)
+
+        return products
+
 
 class ProductImageManager(models.Manager):
 
@@ -147,11 +352,19 @@ class ProductImageManager(models.Manager):
         return self._create_image_product_link(image, product)
 
 
+class ChatManager(models.Manager):
+
+    def for_participant(self, user: User):
+        return self.filter(models.Q(user=user) | models.Q(merchant=user))
+
+
 class Chat(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='customer')
     merchant = models.ForeignKey(User, on_delete=models.CASCADE, related_name='vendor')
 
+    objects = ChatManager()
+
 
 class Message(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -160,11 +373,26 @@ class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'send_date'], name='message_chat_idx'),
+        ]
+
+
+class CategoryManager(models.Manager):
+
+    def adjust_product_count(self, category_id, count):
+        return self.filter(pk=category_id).update(product_count=models.F('product_count') + count)
+
 
 class Category(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=255, blank=False)
     image = models.ForeignKey(Image, on_delete=models.CASCADE)
+    # Maintained incrementally from ProductCategory writes, see ProductCategoryManager.create_links
+    product_count = models.PositiveIntegerField(default=0)
+
+    objects = CategoryManager()
 
 
 class Product(models.Model):
@@ -175,9 +403,34 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=9, decimal_places=2)
     description = models.TextField()
     units = models.CharField(max_length=255, blank=False)  # @TODO: Make as ENUM, not CharField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    date_modified = models.DateTimeField(auto_now=True)
+    # Maintained by Review.save() and the Review post_delete handler, see also recompute_ratings
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.DecimalField(max_digits=12, decimal_places=1, default=0)
+    stock = models.PositiveIntegerField(null=True, blank=True)  # None when the merchant does not track stock
 
     objects = ProductManager()
 
+    @property
+    def rating(self):
+        return self.average_rating(self.rating_count, self.rating_sum)
+
+    @staticmethod
+    def average_rating(rating_count, rating_sum):
+        if not rating_count:
+            return None
+        return (Decimal(rating_sum) / rating_count).quantize(Decimal('0.01'))
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', 'uuid'], name='product_feed_idx'),
+            models.Index(fields=['-created_at'], name='product_featured_idx', condition=models.Q(is_featured=True)),
+            models.Index(fields=['merchant', '-created_at'], name='product_merchant_idx'),
+            # Incremental exports, see api.exports
+            models.Index(fields=['date_modified', 'uuid'], name='product_modified_idx'),
+        ]
+
 
 class Review(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -187,13 +440,152 @@ class Review(models.Model):
     merchant = models.ForeignKey(User, on_delete=models.CASCADE)
     review_text = models.TextField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'created_at'], name='review_product_idx'),
+            models.Index(fields=['created_at', 'uuid'], name='review_created_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_rating = (instance.__dict__.get('product_id'), instance.__dict__.get('rating'))
+        return instance
+
+    def save(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        rating = Decimal(str(self.rating))
+        loaded_product_id, loaded_rating = getattr(self, '_loaded_rating', (None, None))
+
+        with transaction.atomic(using=using):
+            if not self._state.adding and (loaded_product_id is None or loaded_rating is None):
+                # Loaded with the product or rating deferred: the stored values, for the deltas
+                stored = Review.objects.db_manager(using).filter(pk=self.pk)\
+                    .values_list('product_id', 'rating').first()
+                loaded_product_id, loaded_rating = stored or (None, None)
+            super().save(*args, **kwargs)
+
+            products = Product.objects.db_manager(using)
+            stats = ProductDailyStats.objects.db_manager(using)
+            day = timezone.localdate(self.created_at)
+            if loaded_product_id == self.product_id:
+                products.adjust_rating(self.product_id, 0, rating - loaded_rating)
+                stats.increment_reviews(self.product_id, day, 0, rating - loaded_rating)
+            else:
+                if loaded_product_id is not None:
+                    products.adjust_rating(loaded_product_id, -1, -loaded_rating)
+                    stats.increment_reviews(loaded_product_id, day, -1, -loaded_rating)
+                products.adjust_rating(self.product_id, 1, rating)
+                stats.increment_reviews(self.product_id, day, 1, rating)
+
+        self._loaded_rating = (self.product_id, rating)
+
+
+class OrderManager(models.Manager):
+
+    def place_order(self, user: User, quantities):
+        if not user:
+            raise ValueError('User must be provided')
+        if not quantities:
+            raise ValueError('Order must contain at least one product')
+
+        with transaction.atomic(using=self._db):
+            # Rows are locked in primary key order so concurrent checkouts cannot deadlock.
+            products = list(
+                Product.objects.db_manager(self.db).select_for_update()
+                .filter(pk__in=quantities).order_by('pk')
+                .only('pk', 'price', 'stock', 'merchant_id')
+            )
+
+            missing = set(quantities) - {product.pk for product in products}
+            if missing:
+                raise ValueError(f"Products not found: {', '.join(sorted(str(pk) for pk in missing))}")
+
+            sold_out = [product for product in products
+                        if product.stock is not None and product.stock < quantities[product.pk]]
+            if sold_out:
+                raise ValueError(f"Not enough stock: {', '.join(str(product.pk) for product in sold_out)}")
+
+            # bulk_update skips auto_now, date_modified is set here so stock changes reach the exports.
+            now = timezone.now()
+            tracked = []
+            for product in products:
+                if product.stock is not None:
+                    product.stock -= quantities[product.pk]
+                    product.date_modified = now
+                    tracked.append(product)
+            Product.objects.db_manager(self.db).bulk_update(tracked, ['stock', 'date_modified'])
+
+            order = self.model(user=user, status=self.model.STATUS_PLACED)
+            order.save(using=self._db)
+            items = OrderItem.objects.db_manager(self.db).bulk_create([
+                OrderItem(order=order, product=product, quantity=quantities[product.pk], price=product.price)
+                for product in products
+            ])
+
+            day = timezone.localdate(order.created_at)
+            ProductDailyStats.objects.db_manager(self.db).increment({
+                (product.merchant_id, product.pk, day): {
+                    'orders': 1,
+                    'units_sold': quantities[product.pk],
+                    'revenue': quantities[product.pk] * product.price,
+                }
+                for product in products
+            })
+            MerchantOrderStats.objects.db_manager(self.db).increment({
+                (merchant_id, day, order.status): {'orders': 1}
+                for merchant_id in {product.merchant_id for product in products}
+            })
+
+        order.items = items
+        return order
+
 
 class Order(models.Model):
+    STATUS_PLACED = 'placed'
+
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     status = models.CharField(max_length=255, blank=False)  # @TODO: Make as ENUM, not CharField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = OrderManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='order_user_idx'),
+            models.Index(fields=['created_at', 'uuid'], name='order_created_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+
+    def save(self, *args, **kwargs):
+        loaded_status = getattr(self, '_loaded_status', None)
+        # New orders are counted by place_order, once their items exist.
+        if loaded_status is None or loaded_status == self.status:
+            super().save(*args, **kwargs)
+            self._loaded_status = self.status
+            return
+
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+
+            day = timezone.localdate(self.created_at)
+            merchant_ids = Product.objects.db_manager(using).filter(orderitem__order=self)\
+                .values_list('merchant_id', flat=True).distinct()
+            deltas = {}
+            for merchant_id in merchant_ids:
+                deltas[(merchant_id, day, loaded_status)] = {'orders': -1}
+                deltas[(merchant_id, day, self.status)] = {'orders': 1}
+            MerchantOrderStats.objects.db_manager(using).increment(deltas)
+
+        self._loaded_status = self.status
+
 
 class ReviewImage(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -214,9 +606,230 @@ class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=0)
+    price = models.DecimalField(max_digits=9, decimal_places=2)  # unit price at the time of the order
+
+
+class ProductCategoryManager(models.Manager):
+
+    def create_links(self, links, new_products=False):
+        # ``links`` are (product, category_id) pairs. bulk_create skips post_save,
+        # so the category counters are bumped here, once per category. Products created
+        # along with their links already carry a fresh date_modified.
+        product_categories = self.bulk_create([
+            self.model(product=product, category_id=category_id) for product, category_id in links
+        ])
+        if not new_products:
+            Product.objects.db_manager(self.db).touch({product.pk for product, _ in links})
+
+        # In primary key order, so imports touching the same categories lock them in the same order
+        counts = Counter(category_id for _, category_id in links)
+        for category_id, count in sorted(counts.items()):
+            Category.objects.db_manager(self.db).adjust_product_count(category_id, count)
+
+        return product_categories
 
 
 class ProductCategory(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
+
+    objects = ProductCategoryManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['category', 'product'], name='productcategory_category_idx'),
+        ]
+
+
+class RollupManager(models.Manager):
+
+    def increment(self, deltas, create=True):
+        # ``deltas`` maps key tuples, in the order of Model.rollup_key, to {field: delta}. Missing rows
+        # are inserted first, ignoring the ones a concurrent writer inserts meanwhile, so the updates
+        # always find their row. Decrements pass ``create=False``: their rows exist unless they are
+        # being deleted along with their product or merchant.
+        if not deltas:
+            return
+
+        key_fields = self.model.rollup_key
+        if create:
+            self.bulk_create([self.model(**dict(zip(key_fields, key))) for key in deltas], ignore_conflicts=True)
+        for key, values in deltas.items():
+            changes = {name: F(name) + value for name, value in values.items() if value}
+            if changes:
+                self.filter(**dict(zip(key_fields, key))).update(**changes)
+
+
+class ProductDailyStatsManager(RollupManager):
+
+    def increment_reviews(self, product_id, day, count, rating_sum):
+        if not count and not rating_sum:
+            return
+        merchant_id = Product.objects.db_manager(self.db).filter(pk=product_id)\
+            .values_list('merchant_id', flat=True).first()
+        if merchant_id is not None:
+            self.increment({(merchant_id, product_id, day): {'review_count': count, 'rating_sum': rating_sum}},
+                           create=count >= 0)
+
+
+class ProductDailyStats(models.Model):
+    # Sales and reviews of a product per day, maintained by OrderManager.place_order and Review.save
+    # (and the Review post_delete handler); rebuilt from history by the backfill_rollups command.
+    rollup_key = ('merchant_id', 'product_id', 'day')
+
+    merchant = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    day = models.DateField()
+    orders = models.PositiveIntegerField(default=0)
+    units_sold = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    review_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.DecimalField(max_digits=12, decimal_places=1, default=0)
+
+    objects = ProductDailyStatsManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'day'], name='productdailystats_key'),
+        ]
+        indexes = [
+            models.Index(fields=['merchant', 'day'], name='productdailystats_merchant_idx'),
+        ]
+
+
+class MerchantOrderStats(models.Model):
+    # Orders with at least one of the merchant's products, per day of placement and current status
+    rollup_key = ('merchant_id', 'day', 'status')
+
+    merchant = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    day = models.DateField()
+    status = models.CharField(max_length=255)
+    orders = models.IntegerField(default=0)
+
+    objects = RollupManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['merchant', 'day', 'status'], name='merchantorderstats_key'),
+        ]
+
+
+class RecommendationManager(models.Manager):
+
+    def replace(self, user_ids, recommendations):
+        # Swaps the rows of ``user_ids`` (None for the fallback list of users without any history)
+        # for ``recommendations`` in one transaction, so readers see either the old or the new list.
+        user_ids = list(user_ids)
+        with transaction.atomic(using=self.db):
+            stale = self.filter(user__in=[pk for pk in user_ids if pk is not None])
+            if None in user_ids:
+                stale = stale | self.filter(user__isnull=True)
+            stale.delete()
+            self.bulk_create(recommendations, batch_size=1000)
+
+    def prune(self, user_ids, batch_size=500):
+        # Drops the rows of the users missing from ``user_ids``, whose orders and reviews are gone.
+        keep = set(user_ids)
+        with transaction.atomic(using=self.db):
+            stale = [pk for pk in self.filter(user__isnull=False).values_list('user_id', flat=True).distinct()
+                     if pk not in keep]
+            for start in range(0, len(stale), batch_size):
+                self.filter(user__in=stale[start:start + batch_size]).delete()
+
+
+class Recommendation(models.Model):
+    # Top products per user, precomputed by the compute_recommendations command; the rows with
+    # no user are the most popular products, shown to users without orders or reviews.
+    # Indexed by recommendation_user_rank
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, related_name='+', db_index=False)
+    rank = models.PositiveSmallIntegerField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommendations')
+    score = models.FloatField()
+
+    objects = RecommendationManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'rank'], name='recommendation_user_rank'),
+        ]
+
+
+class TaskManager(models.Manager):
+
+    def enqueue(self, name, calls, max_attempts=5, run_at=None):
+        if not name:
+            raise ValueError('Task name must be provided')
+        run_at = run_at or timezone.now()
+        # ignore_conflicts makes a repeated idempotency key a no-op, without a savepoint.
+        self.bulk_create([
+            self.model(name=name, kwargs=kwargs, idempotency_key=key, max_attempts=max_attempts, run_at=run_at)
+            for kwargs, key in calls
+        ], ignore_conflicts=True)
+
+    def claim(self, worker_id, limit, lease):
+        # Due tasks, and running ones whose worker let the lease expire, oldest first. SKIP LOCKED
+        # keeps concurrent workers from waiting on each other; the conditional update is what
+        # guarantees a task goes to one worker, also where there is no row locking (SQLite).
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            due = self.select_for_update(skip_locked=True).filter(
+                models.Q(status=Task.STATUS_PENDING, run_at__lte=now)
+                | models.Q(status=Task.STATUS_RUNNING, locked_until__lt=now)
+            ).order_by('run_at').values_list('pk', flat=True)[:limit]
+            pks = list(due)
+            if not pks:
+                return []
+            self.filter(pk__in=pks).filter(
+                models.Q(status=Task.STATUS_PENDING) | models.Q(status=Task.STATUS_RUNNING, locked_until__lt=now)
+            ).update(status=Task.STATUS_RUNNING, locked_by=worker_id, locked_until=now + lease,
+                     attempts=F('attempts') + 1)
+        return list(self.filter(pk__in=pks, locked_by=worker_id, status=Task.STATUS_RUNNING).order_by('run_at'))
+
+    def complete(self, task):
+        self.filter(pk=task.pk, locked_by=task.locked_by).update(
+            status=Task.STATUS_DONE, finished_at=timezone.now(), locked_until=None)
+
+    def fail(self, task, error, retry_in=None):
+        # Back to pending after ``retry_in``, or failed for good without it.
+        now = timezone.now()
+        if retry_in is None:
+            changes = {'status': Task.STATUS_FAILED, 'finished_at': now}
+        else:
+            changes = {'status': Task.STATUS_PENDING, 'run_at': now + retry_in}
+        self.filter(pk=task.pk, locked_by=task.locked_by).update(last_error=error, locked_until=None, **changes)
+
+
+class Task(models.Model):
+    # Background work queued with the write that needs it, see api.tasks and the run_tasks command
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    name = models.CharField(max_length=255)
+    kwargs = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    idempotency_key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    objects = TaskManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='task_due_idx'),
+        ]
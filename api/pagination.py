@@ -0,0 +1,137 @@
+from base64 import b64decode, b64encode
+from datetime import datetime
+from uuid import UUID
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class ProductCursorPagination(CursorPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    ordering = ('-created_at', 'uuid')
+
+
+class HomeFeedPagination(ProductCursorPagination):
+    pass
+
+
+class NearbyPagination(ProductCursorPagination):
+    # ``distance`` is annotated by api.geo.within_radius
+    ordering = ('distance', 'uuid')
+
+
+class MessageKeysetPagination:
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self):
+        self.request = None
+        self.next_position = None
+
+    @staticmethod
+    def encode_cursor(message):
+        position = f'{message.send_date.isoformat()}|{message.uuid.hex}'
+        return b64encode(position.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, encoded):
+        try:
+            send_date, message_uuid = b64decode(encoded.encode('ascii')).decode('ascii').split('|')
+            return datetime.fromisoformat(send_date), UUID(message_uuid)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    @staticmethod
+    def before(queryset, position):
+        send_date, message_uuid = position
+        return queryset.filter(Q(send_date__lt=send_date) | Q(send_date=send_date, uuid__lt=message_uuid))
+
+    @staticmethod
+    def after(queryset, position):
+        send_date, message_uuid = position
+        return queryset.filter(Q(send_date__gt=send_date) | Q(send_date=send_date, uuid__gt=message_uuid))
+
+    def paginate_queryset(self, queryset, request):
+        # Newest first; the cursor points at the last message of the previous page.
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            queryset = self.before(queryset, self.decode_cursor(encoded))
+
+        page = list(queryset.order_by('-send_date', '-uuid')[:page_size + 1])
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_position = self.encode_cursor(page[-1])
+        return page
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_position)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+
+class RankedPagination:
+    # Offset paging for relevance-ordered results, without the COUNT(*) of LimitOffsetPagination.
+    default_limit = 20
+    max_limit = 100
+    limit_query_param = 'limit'
+    offset_query_param = 'offset'
+
+    def __init__(self):
+        self.request = None
+        self.limit = self.default_limit
+        self.offset = 0
+        self.has_next = False
+
+    @staticmethod
+    def _get_int(request, name, default, maximum=None):
+        try:
+            value = max(0, int(request.query_params[name]))
+        except (KeyError, ValueError):
+            return default
+        return min(value, maximum) if maximum is not None else value
+
+    def paginate_queryset(self, queryset, request):
+        self.request = request
+        self.limit = self._get_int(request, self.limit_query_param, self.default_limit, self.max_limit) or 1
+        self.offset = self._get_int(request, self.offset_query_param, 0)
+
+        page = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(page) > self.limit
+        return page[:self.limit]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
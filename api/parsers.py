@@ -0,0 +1,41 @@
+import codecs
+import csv
+import json
+
+from django.conf import settings
+from rest_framework.parsers import BaseParser
+
+
+def _iter_lines(stream, encoding):
+    if stream is None:
+        return
+    for line in codecs.iterdecode(stream, encoding):
+        if line.strip():
+            yield line
+
+
+class NDJSONParser(BaseParser):
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        return self._iter_rows(stream, encoding)
+
+    @staticmethod
+    def _iter_rows(stream, encoding):
+        for line in _iter_lines(stream, encoding):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Passed through as-is so the caller reports it as an invalid row.
+                yield line
+
+
+class CSVParser(BaseParser):
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        return csv.DictReader(_iter_lines(stream, encoding))
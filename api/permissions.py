@@ -0,0 +1,7 @@
+from rest_framework.permissions import BasePermission
+
+
+class IsSuperUser(BasePermission):
+
+    def has_permission(self, request, view):
+        return bool(request.user and request.user.is_superuser)
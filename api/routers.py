@@ -0,0 +1,139 @@
+import contextvars
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from uuid import UUID
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+
+class ReadState:
+    # Where the reads of one request go. The replica is chosen on the first read and kept for
+    # the rest of the request, so its queries see one consistent snapshot.
+
+    def __init__(self):
+        self.alias = None
+        self.pinned = False
+
+
+current_read_state = contextvars.ContextVar('current_read_state', default=None)
+
+
+class ReplicaSet:
+    # DATABASE_REPLICAS, taken round-robin. A replica that fails its connection check is left
+    # out for DATABASE_REPLICA_RETRY_INTERVAL seconds; with none left, reads go to the primary.
+
+    def __init__(self):
+        self._turn = itertools.count()
+        self._down_until = {}
+
+    def choose(self):
+        aliases = list(getattr(settings, 'DATABASE_REPLICAS', ()))
+        if not aliases:
+            return DEFAULT_DB_ALIAS
+        # Starting one further each time; next() on a count is atomic under the GIL.
+        start = next(self._turn) % len(aliases)
+        now = time.monotonic()
+        for alias in aliases[start:] + aliases[:start]:
+            if self._down_until.get(alias, 0) <= now and self.check(alias):
+                return alias
+        return DEFAULT_DB_ALIAS
+
+    def check(self, alias):
+        try:
+            connections[alias].ensure_connection()
+        except DatabaseError:
+            logger.warning('Replica %s is unavailable, reading from the primary', alias, exc_info=True)
+            self.mark_down(alias)
+            return False
+        return True
+
+    def mark_down(self, alias):
+        self._down_until[alias] = time.monotonic() + getattr(settings, 'DATABASE_REPLICA_RETRY_INTERVAL', 30)
+
+    def reset(self):
+        self._down_until.clear()
+
+
+replica_set = ReplicaSet()
+
+
+class WritePins:
+    # Users who wrote in the last DATABASE_REPLICA_PIN_SECONDS read from the primary, so they see
+    # their own writes whatever the replication lag. Kept in a Django cache, which has to be
+    # shared between the worker processes (DATABASE_REPLICA_PIN_CACHE) for this to hold there.
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'DATABASE_REPLICA_PIN_CACHE', 'default')]
+
+    @property
+    def seconds(self):
+        return getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 5)
+
+    @staticmethod
+    def _key(user_id):
+        # Tokens carry the id as hex, the user's pk is a UUID
+        return f'replica-pin:{UUID(str(user_id)).hex}'
+
+    def pin(self, user_id):
+        self.cache.set(self._key(user_id), 1, self.seconds)
+
+    def is_pinned(self, user_id):
+        return self.cache.get(self._key(user_id)) is not None
+
+
+write_pins = WritePins()
+
+
+@contextmanager
+def replica_reads():
+    # Lets the reads in the block go to a replica. Everything outside such a block (writes,
+    # unsafe requests, management commands and tasks) uses the primary.
+    token = current_read_state.set(ReadState() if getattr(settings, 'DATABASE_REPLICAS', ()) else None)
+    try:
+        yield
+    finally:
+        current_read_state.reset(token)
+
+
+def identify_reader(user_id):
+    # Called by the authentication once it knows the user, before their data is read.
+    state = current_read_state.get()
+    if state is not None and write_pins.is_pinned(user_id):
+        state.pinned = True
+
+
+def read_from_replica():
+    # Whether the current reads are served by a replica
+    state = current_read_state.get()
+    return state is not None and not state.pinned and state.alias not in (None, DEFAULT_DB_ALIAS)
+
+
+class PrimaryReplicaRouter:
+    # Writes go to the primary, reads to a replica inside replica_reads() (see
+    # ReplicaRoutingMiddleware), unless the user is pinned or a transaction is open on the
+    # primary, which has to see its own uncommitted rows.
+
+    def db_for_read(self, model, **hints):
+        state = current_read_state.get()
+        if state is None or state.pinned or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        if state.alias is None:
+            state.alias = replica_set.choose()
+        return state.alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *getattr(settings, 'DATABASE_REPLICAS', ())}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -0,0 +1,108 @@
+import re
+
+from django.db import connections, router
+from django.db.models import Q
+
+from .models import Product
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(query):
+    return TOKEN_RE.findall(query.lower())
+
+
+class PostgresProductSearch:
+    # ``api_product.search_vector`` is a generated tsvector column with a GIN index
+    # (migration 0007), so Postgres keeps it current on every write.
+
+    def search(self, queryset, terms):
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        return queryset.extra(
+            select={'rank': "ts_rank(api_product.search_vector, to_tsquery('simple', %s))"},
+            select_params=[tsquery],
+            where=["api_product.search_vector @@ to_tsquery('simple', %s)"],
+            params=[tsquery],
+        ).order_by('-rank', 'uuid')
+
+    def index_products(self, products, using=None, created=False):
+        pass
+
+    def remove_products(self, product_ids, using=None):
+        pass
+
+
+class SQLiteProductSearch:
+    # ``api_product_search`` is a standalone FTS5 table (migration 0007) kept in sync from
+    # Product signals and bulk imports. Triggers would not survive SQLite table rebuilds
+    # done by later migrations.
+
+    def search(self, queryset, terms):
+        match = ' '.join(f'"{term}"*' for term in terms)
+        return queryset.extra(
+            # bm25() is lower for better matches; name hits weigh ten times description hits.
+            select={'rank': '-bm25(api_product_search, 0.0, 10.0, 1.0)'},
+            tables=['api_product_search'],
+            where=['api_product_search MATCH %s', 'api_product_search.product_id = api_product.uuid'],
+            params=[match],
+        ).order_by('-rank', 'uuid')
+
+    @staticmethod
+    def rowid(product_id):
+        # FTS5 only indexes its integer rowid, so it is derived from the product UUID (63 bits)
+        # to keep updates and deletes off a full scan of the UNINDEXED product_id column.
+        return product_id.int >> 65
+
+    # Rows per statement, within SQLite's default limit of 999 parameters
+    batch_size = 200
+
+    def index_products(self, products, using=None, created=False):
+        products = list(products)
+        if not products:
+            return
+        if not created:
+            self.remove_products([product.pk for product in products], using=using)
+        with connections[using or router.db_for_write(Product)].cursor() as cursor:
+            for start in range(0, len(products), self.batch_size):
+                batch = products[start:start + self.batch_size]
+                cursor.execute(
+                    'INSERT INTO api_product_search (rowid, product_id, name, description) VALUES %s'
+                    % ', '.join(['(%s, %s, %s, %s)'] * len(batch)),
+                    [value for product in batch
+                     for value in (self.rowid(product.pk), product.pk.hex, product.name, product.description)],
+                )
+
+    def remove_products(self, product_ids, using=None):
+        rowids = [self.rowid(product_id) for product_id in product_ids]
+        with connections[using or router.db_for_write(Product)].cursor() as cursor:
+            for start in range(0, len(rowids), self.batch_size):
+                batch = rowids[start:start + self.batch_size]
+                cursor.execute(
+                    'DELETE FROM api_product_search WHERE rowid IN (%s)' % ', '.join(['%s'] * len(batch)),
+                    batch,
+                )
+
+
+class FallbackProductSearch:
+
+    def search(self, queryset, terms):
+        for term in terms:
+            queryset = queryset.filter(Q(name__icontains=term) | Q(description__icontains=term))
+        return queryset.order_by('-created_at', 'uuid')
+
+    def index_products(self, products, using=None, created=False):
+        pass
+
+    def remove_products(self, product_ids, using=None):
+        pass
+
+
+backends = {
+    'postgresql': PostgresProductSearch(),
+    'sqlite': SQLiteProductSearch(),
+}
+
+
+def get_product_search(using=None):
+    vendor = connections[using or router.db_for_read(Product)].vendor
+    return backends.get(vendor, FallbackProductSearch())
@@ -1,51 +1,178 @@
+from django.conf import settings
 from django.contrib.auth import authenticate
+from django.core.files.storage import default_storage
 from rest_framework import serializers
 
 
-from .models import User, Product, Image, ProductImage
+from .instrumentation import TimedSerializerMixin, TimedListSerializer
+from .models import User, Product, Image, ProductImage, Message, Order, OrderItem, Category, ProductCategory
+
+
+class SparseFieldsetMixin:
+    # ``?fields=uuid,name`` renders only the named fields. Nested relations in Meta.expandable_fields are
+    # then left out unless named in ``fields`` or ``?expand=``. Without either parameter nothing changes.
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def fields_from_request(cls, request):
+        def split(param):
+            value = request.query_params.get(param)
+            return None if value is None else [name.strip() for name in value.split(',') if name.strip()]
+
+        return cls.resolve_fields(split('fields'), split('expand'))
+
+    @classmethod
+    def resolve_fields(cls, fields=None, expand=None):
+        if fields is None and expand is None:
+            return None
+
+        declared = set(cls.Meta.fields)
+        expandable = set(getattr(cls.Meta, 'expandable_fields', ()))
+        errors = {}
+        if fields is not None and set(fields) - declared:
+            errors['fields'] = [f"Unknown fields: {', '.join(sorted(set(fields) - declared))}"]
+        if expand is not None and set(expand) - expandable:
+            errors['expand'] = [f"Fields that cannot be expanded: {', '.join(sorted(set(expand) - expandable))}"]
+        if errors:
+            raise serializers.ValidationError(errors)
+
+        selected = set(fields) if fields is not None else declared - expandable
+        return selected | set(expand or ())
 
 
 class ProductSerializer(serializers.ModelSerializer):
+    categories = serializers.ListField(child=serializers.UUIDField(), write_only=True, required=False)
+    img = serializers.URLField(write_only=True, required=False)
+    # An image posted to the upload endpoint beforehand, instead of ``img``
+    image = serializers.PrimaryKeyRelatedField(queryset=Image.objects.all(), write_only=True, required=False)
 
     class Meta:
         model = Product
-        fields = ('uuid', 'name', 'is_featured', 'price', 'units')
+        fields = ('uuid', 'name', 'is_featured', 'price', 'units', 'categories', 'img', 'image')
+
+    def validate_categories(self, value):
+        value = list(dict.fromkeys(value))
+        return self.check_categories(value, set(Category.objects.filter(pk__in=value).values_list('pk', flat=True)))
+
+    @staticmethod
+    def check_categories(value, found):
+        missing = [str(pk) for pk in value if pk not in found]
+        if missing:
+            raise serializers.ValidationError(f"Unknown categories: {', '.join(missing)}")
+        return value
+
+    def validate(self, attrs):
+        if 'img' not in attrs and 'image' not in attrs:
+            raise serializers.ValidationError({'img': ['Provide an image URL or an uploaded image.']})
+        return attrs
 
     def create(self, validated_data):
         user = self.context['request'].user
-        image_url = self.context['request'].data['img']
-        image = Image.objects.create_image(image_url)
+        category_ids = validated_data.pop('categories', [])
+        image = validated_data.pop('image', None)
+        image_url = validated_data.pop('img', None)
+        if image is None:
+            image = Image.objects.create_image(image_url)
         product = Product.objects.create_product_from_merchant(user, **validated_data)
         ProductImage.objects.create_link(image, product)
+        if category_ids:
+            ProductCategory.objects.create_links([(product, category_id) for category_id in category_ids],
+                                                 new_products=True)
         return product
 
 
+class ProductImportSerializer(ProductSerializer):
+    # Categories are checked against ``known_categories`` in the context, which
+    # ProductImportAPIView loads with one query per chunk of rows.
+    img = serializers.URLField(write_only=True)
+
+    class Meta(ProductSerializer.Meta):
+        fields = ('uuid', 'name', 'is_featured', 'price', 'units', 'categories', 'description', 'img')
+
+    def validate_categories(self, value):
+        return self.check_categories(list(dict.fromkeys(value)), self.context['known_categories'])
+
+
 class ImageSerializer(serializers.ModelSerializer):
+    variants = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Image
+        fields = ('uuid', 'url', 'status', 'variants')
+
+    @staticmethod
+    def get_variants(obj):
+        return {name: default_storage.url(path) for name, path in obj.variants.items()}
+
+
+class ImageThumbnailSerializer(serializers.ModelSerializer):
+    # For list endpoints; falls back to the original until the thumbnail has been generated.
+    thumbnail = serializers.SerializerMethodField()
 
     class Meta:
         model = Image
-        fields = ('uuid', 'url')
+        fields = ('uuid', 'url', 'thumbnail')
+
+    @staticmethod
+    def get_thumbnail(obj):
+        path = obj.variants.get('thumbnail')
+        return default_storage.url(path) if path else obj.url
+
+
+class LimitedImageField(serializers.ImageField):
+    # Refuses files over IMAGE_MAX_BYTES before Pillow opens them.
+    default_error_messages = {
+        'too_large': 'Image is larger than {limit} bytes.',
+    }
+
+    def to_internal_value(self, data):
+        limit = getattr(settings, 'IMAGE_MAX_BYTES', 10 * 1024 * 1024)
+        if getattr(data, 'size', None) is not None and data.size > limit:
+            self.fail('too_large', limit=limit)
+        return super().to_internal_value(data)
+
+
+class ImageUploadSerializer(serializers.Serializer):
+    file = LimitedImageField()
+
+
+class CategorySerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    image = ImageThumbnailSerializer()
+
+    class Meta:
+        model = Category
+        list_serializer_class = TimedListSerializer
+        fields = ('uuid', 'name', 'image', 'product_count')
 
 
 class ProductImageSerializer(serializers.ModelSerializer):
-    image = ImageSerializer()
+    image = ImageThumbnailSerializer()
 
     class Meta:
         model = ProductImage
         fields = ('image',)
 
 
-class ProductSerializerForMerchant(serializers.ModelSerializer):
+class ProductSerializerForMerchant(SparseFieldsetMixin, TimedSerializerMixin, serializers.ModelSerializer):
     images = serializers.SerializerMethodField()
+    rating = serializers.DecimalField(max_digits=3, decimal_places=2, read_only=True)
 
     @staticmethod
     def get_images(obj):
-        image = ProductImage.objects.filter(product=obj)
+        # Served from the ``product__image`` prefetch cache when the queryset provides it.
+        image = obj.product.all()
         return ProductImageSerializer(image, many=True).data
 
     class Meta:
         model = Product
-        fields = ('uuid', 'name', 'is_featured', 'price', 'units', 'description', 'images')
+        list_serializer_class = TimedListSerializer
+        fields = ('uuid', 'name', 'is_featured', 'price', 'units', 'description', 'rating', 'rating_count', 'images')
+        expandable_fields = ('images',)
 
 
 class AddressSerializer(serializers.ModelSerializer):
@@ -55,12 +182,114 @@ class AddressSerializer(serializers.ModelSerializer):
         fields = ('address', )
 
 
-class HomeViewSerializer(serializers.ModelSerializer):
+class HomeViewSerializer(SparseFieldsetMixin, TimedSerializerMixin, serializers.ModelSerializer):
     merchant = AddressSerializer()
+    rating = serializers.DecimalField(max_digits=3, decimal_places=2, read_only=True)
 
     class Meta:
         model = Product
-        fields = ('uuid', 'name', 'is_featured', 'price', 'units', 'merchant')
+        list_serializer_class = TimedListSerializer
+        fields = ('uuid', 'name', 'is_featured', 'price', 'units', 'rating', 'rating_count', 'merchant')
+        expandable_fields = ('merchant',)
+
+
+class NearbyProductSerializer(HomeViewSerializer):
+    distance = serializers.FloatField(read_only=True)  # km from the buyer
+
+    class Meta(HomeViewSerializer.Meta):
+        fields = HomeViewSerializer.Meta.fields + ('distance',)
+
+
+class NearbyQuerySerializer(serializers.Serializer):
+    lat = serializers.FloatField(min_value=-90, max_value=90)
+    lng = serializers.FloatField(min_value=-180, max_value=180)
+    radius = serializers.FloatField(min_value=0.1, max_value=settings.GEO_MAX_RADIUS_KM,
+                                    default=settings.GEO_DEFAULT_RADIUS_KM)  # km
+
+
+class MessageSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+
+    class Meta:
+        model = Message
+        list_serializer_class = TimedListSerializer
+        fields = ('uuid', 'text', 'send_date', 'sender')
+        read_only_fields = ('uuid', 'send_date', 'sender')
+
+
+class OrderItemSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = OrderItem
+        fields = ('product', 'quantity', 'price')
+
+
+class OrderItemRequestSerializer(serializers.Serializer):
+    product = serializers.UUIDField()
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class OrderSerializer(serializers.ModelSerializer):
+    items = OrderItemRequestSerializer(many=True, write_only=True, allow_empty=False)
+
+    class Meta:
+        model = Order
+        fields = ('uuid', 'status', 'created_at', 'items')
+        read_only_fields = ('uuid', 'status', 'created_at')
+
+    def create(self, validated_data):
+        user = self.context['request'].user
+        quantities = {}
+        for item in validated_data['items']:
+            quantities[item['product']] = quantities.get(item['product'], 0) + item['quantity']
+
+        try:
+            return Order.objects.place_order(user, quantities)
+        except ValueError as e:
+            raise serializers.ValidationError({'items': [str(e)]})
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data['items'] = OrderItemSerializer(instance.items, many=True).data
+        return data
+
+
+class ProductSearchSerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=255)
+    price_min = serializers.DecimalField(max_digits=9, decimal_places=2, required=False)
+    price_max = serializers.DecimalField(max_digits=9, decimal_places=2, required=False)
+    is_featured = serializers.BooleanField(required=False)
+    category = serializers.UUIDField(required=False)
+
+
+class DashboardQuerySerializer(serializers.Serializer):
+    days = serializers.IntegerField(min_value=1, max_value=366, default=30)
+    top = serializers.IntegerField(min_value=1, max_value=100, default=10)
+
+
+class DashboardStatsSerializer(serializers.Serializer):
+    orders = serializers.IntegerField()
+    units_sold = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=16, decimal_places=2)
+    review_count = serializers.IntegerField()
+    average_rating = serializers.SerializerMethodField()
+
+    @staticmethod
+    def get_average_rating(obj):
+        rating = Product.average_rating(obj['review_count'], obj['rating_sum'])
+        return None if rating is None else str(rating)
+
+
+class DashboardDaySerializer(DashboardStatsSerializer):
+    day = serializers.DateField()
+
+
+class DashboardProductSerializer(DashboardStatsSerializer):
+    product = serializers.UUIDField()
+    name = serializers.CharField(source='product__name')
+
+
+class ExportQuerySerializer(serializers.Serializer):
+    since = serializers.DateTimeField(required=False)
 
 
 class UpdateUserSerializer(serializers.ModelSerializer):
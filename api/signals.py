@@ -0,0 +1,93 @@
+import math
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .backends import jwt_cache, token_revocations
+from .cache import home_feed_cache
+from .geo import geocoding_pipeline
+from .models import User, UserDeletion, Product, Message, Review, Category, ProductCategory, ProductDailyStats
+from .search import get_product_search
+from .streams import message_broker
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_tokens(sender, instance, **kwargs):
+    jwt_cache.invalidate_user(instance.pk)
+    # Deleted users' tokens are revoked whatever their version; other processes read the
+    # deletion from its UserDeletion row, committed along with it.
+    if kwargs['signal'] is post_delete:
+        UserDeletion.objects.db_manager(kwargs['using']).record(instance.pk)
+        version = math.inf
+    else:
+        version = instance.__dict__.pop('_revoked_version', None)
+    if version is not None:
+        user_id = instance.pk
+        transaction.on_commit(lambda: token_revocations.revoke(user_id, version), using=kwargs['using'])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_home_feed(sender, instance, using, **kwargs):
+    # After the commit: a request refilling the cache in between would store the old feed
+    # under the new generation. Reviews change the products' ratings through update(), which
+    # sends no Product signal.
+    transaction.on_commit(home_feed_cache.invalidate, using=using)
+
+
+@receiver(post_save, sender=User)
+def invalidate_home_feed_on_address_change(sender, instance, created, using, **kwargs):
+    # The feed embeds each product's merchant address, and the nearby feed its coordinates.
+    if instance.is_merchant and instance.address != getattr(instance, '_loaded_address', None):
+        if not created:
+            transaction.on_commit(home_feed_cache.invalidate, using=using)
+        if instance.address != instance.geocoded_address:
+            geocoding_pipeline.schedule(instance.pk, using=using)
+    instance._loaded_address = instance.address
+
+
+@receiver(post_save, sender=Message)
+def notify_chat_streams(sender, instance, created, **kwargs):
+    if created:
+        chat_id = instance.chat_id
+        transaction.on_commit(lambda: message_broker.publish(chat_id))
+
+
+@receiver(post_delete, sender=Review)
+def remove_review_rating(sender, instance, using, **kwargs):
+    # Runs inside the deletion's transaction, cascades from Product/User included.
+    product_id, rating = getattr(instance, '_loaded_rating', (instance.product_id, instance.rating))
+    if product_id is not None:
+        Product.objects.db_manager(using).adjust_rating(product_id, -1, -Decimal(str(rating)))
+        ProductDailyStats.objects.db_manager(using).increment_reviews(
+            product_id, timezone.localdate(instance.created_at), -1, -Decimal(str(rating)))
+
+
+@receiver(post_save, sender=ProductCategory)
+def add_category_product(sender, instance, created, using, **kwargs):
+    if created:
+        Category.objects.db_manager(using).adjust_product_count(instance.category_id, 1)
+    Product.objects.db_manager(using).touch([instance.product_id])
+
+
+@receiver(post_delete, sender=ProductCategory)
+def remove_category_product(sender, instance, using, **kwargs):
+    Category.objects.db_manager(using).adjust_product_count(instance.category_id, -1)
+    Product.objects.db_manager(using).touch([instance.product_id])
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, created, using, update_fields=None, **kwargs):
+    if update_fields is None or {'name', 'description'} & set(update_fields):
+        get_product_search(using).index_products([instance], using=using, created=created)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, using, **kwargs):
+    get_product_search(using).remove_products([instance.pk], using=using)
@@ -0,0 +1,96 @@
+# Item-item collaborative filtering on sparse matrices, for the compute_recommendations command.
+# Kept free of Django imports: recommend_users() runs in worker processes started with the
+# ``spawn`` method, which import this module from scratch.
+import numpy as np
+from scipy import sparse
+
+
+def interaction_matrix(users, items, weights, shape):
+    # users x items; weights of the same (user, item) are summed, then damped with log1p so a
+    # product bought every week does not drown out everything else. Non-positive sums are dropped.
+    matrix = sparse.coo_matrix((np.asarray(weights, dtype=np.float64), (users, items)), shape=shape).tocsr()
+    matrix.sum_duplicates()
+    matrix.data = np.log1p(np.maximum(matrix.data, 0))
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def seen_matrix(users, items, shape):
+    # users x items, 1 where the user interacted with the item at all, negative reviews included
+    matrix = sparse.coo_matrix((np.ones(len(users)), (users, items)), shape=shape).tocsr()
+    matrix.data[:] = 1
+    return matrix
+
+
+def top_per_row(matrix, count):
+    # Keeps the ``count`` largest values of each row of a CSR matrix.
+    matrix = matrix.tocsr()
+    keep = np.ones(matrix.nnz, dtype=bool)
+    for row in np.flatnonzero(np.diff(matrix.indptr) > count):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        smallest = np.argpartition(matrix.data[start:end], end - start - count)[:end - start - count]
+        keep[start + smallest] = False
+    matrix.data[~keep] = 0
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def item_similarity(interactions, neighbours):
+    # items x items cosine similarity of the interaction columns, each row cut down to the item's
+    # ``neighbours`` most similar items.
+    norms = np.sqrt(np.asarray(interactions.multiply(interactions).sum(axis=0)).ravel())
+    norms[norms == 0] = 1
+    normalized = interactions @ sparse.diags(1 / norms)
+    similarity = (normalized.T @ normalized).tocsr()
+    similarity.setdiag(0)
+    similarity.eliminate_zeros()
+    return top_per_row(similarity, neighbours)
+
+
+def recommend_users(interactions, seen, similarity, count):
+    # Scores every item for each user (row) as the similarity-weighted sum of the user's
+    # interactions, leaving out the items the user already knows. Returns flat arrays
+    # (rows, items, ranks, scores), best first per row.
+    scores = (interactions @ similarity).tocsr()
+    scores = scores - scores.multiply(seen)
+    scores.eliminate_zeros()
+    scores = top_per_row(scores, count)
+
+    rows, items, ranks, values = [], [], [], []
+    for row in range(scores.shape[0]):
+        start, end = scores.indptr[row], scores.indptr[row + 1]
+        if start == end:
+            continue
+        # By score, then by item index so ties come out the same in every run
+        order = np.lexsort((scores.indices[start:end], -scores.data[start:end]))
+        rows.append(np.full(end - start, row))
+        items.append(scores.indices[start:end][order])
+        ranks.append(np.arange(end - start))
+        values.append(scores.data[start:end][order])
+
+    if not rows:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty, np.array([], dtype=np.float64)
+    return np.concatenate(rows), np.concatenate(items), np.concatenate(ranks), np.concatenate(values)
+
+
+def popular_items(interactions, count):
+    # (items, scores) of the items with the most interaction weight, for users without history
+    totals = np.asarray(interactions.sum(axis=0)).ravel()
+    items = np.lexsort((np.arange(len(totals)), -totals))[:count]
+    items = items[totals[items] > 0]
+    return items, totals[items]
+
+
+# Worker process state, see init_worker
+_similarity = None
+
+
+def init_worker(similarity):
+    # Receives the item similarity matrix once per worker instead of once per chunk of users.
+    global _similarity
+    _similarity = similarity
+
+
+def recommend_chunk(interactions, seen, count):
+    return recommend_users(interactions, seen, _similarity, count)
@@ -0,0 +1,272 @@
+import asyncio
+import json
+import re
+import threading
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from rest_framework import exceptions
+from rest_framework.utils.encoders import JSONEncoder
+
+from .asyncdb import database_sync_to_async
+from .backends import JWTAuth
+from .exports import EXPORT_FORMATS, exports
+from .middleware import CompressionMiddleware
+from .models import Chat, Message
+from .pagination import MessageKeysetPagination
+from .routers import replica_reads
+from .serializers import ExportQuerySerializer, MessageSerializer
+
+
+class MessageBroker:
+    # Wakes up chat streams served by this process. Streams also re-check the database every
+    # CHAT_STREAM_POLL_INTERVAL seconds, which covers messages written by other processes.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, chat_id):
+        subscriber = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._subscribers[chat_id].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, chat_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(chat_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[chat_id]
+
+    def publish(self, chat_id):
+        with self._lock:
+            subscribers = list(self._subscribers.get(chat_id, ()))
+        for loop, event in subscribers:
+            loop.call_soon_threadsafe(event.set)
+
+
+message_broker = MessageBroker()
+
+
+@database_sync_to_async
+def _get_chat(token, chat_uuid):
+    user, _ = JWTAuth()._authenticate_credentials(None, token)
+    return Chat.objects.for_participant(user).get(uuid=chat_uuid)
+
+
+@database_sync_to_async
+def _get_latest_position(chat):
+    latest = Message.objects.filter(chat=chat).order_by('-send_date', '-uuid').only('send_date').first()
+    return (latest.send_date, latest.uuid) if latest else None
+
+
+@database_sync_to_async
+def _get_messages_after(chat, position, limit):
+    messages = Message.objects.filter(chat=chat)
+    if position is not None:
+        messages = MessageKeysetPagination.after(messages, position)
+    messages = list(messages.order_by('send_date', 'uuid')[:limit])
+    return MessageSerializer(messages, many=True).data, messages[-1] if messages else None
+
+
+class StreamApplication:
+    # An ASGI application for the long responses that would otherwise hold a worker thread. Each
+    # connection is a coroutine; threads are borrowed only for the short DB reads.
+    path_regex = None
+    authentication_header_prefix = JWTAuth.authentication_header_prefix
+
+    def matches(self, scope):
+        return scope['type'] == 'http' and self.path_regex.match(scope['path']) is not None
+
+    def _get_token(self, headers):
+        auth_header = headers.get(b'authorization', b'').split()
+        if len(auth_header) != 2 or auth_header[0].decode('latin-1').lower() != self.authentication_header_prefix.lower():
+            return None
+        return auth_header[1].decode('utf-8')
+
+    @staticmethod
+    async def _wait_for_disconnect(receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    @staticmethod
+    async def _send_json(send, status, data):
+        body = json.dumps(data, cls=JSONEncoder).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json')],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _send_error(self, send, status, detail):
+        await self._send_json(send, status, {'detail': detail})
+
+
+class ChatStreamApplication(StreamApplication):
+    # Server-sent events for /api/chats/<uuid>/stream.
+    path_regex = re.compile(r'^/api/chats/(?P<chat_uuid>[0-9a-fA-F-]{32,36})/stream/?$')
+    batch_size = 100
+
+    def __init__(self, broker=None):
+        self.broker = broker or message_broker
+        self.poll_interval = getattr(settings, 'CHAT_STREAM_POLL_INTERVAL', 15)
+
+    async def __call__(self, scope, receive, send):
+        chat_uuid = self.path_regex.match(scope['path']).group('chat_uuid')
+        headers = dict(scope['headers'])
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+
+        token = self._get_token(headers)
+        if token is None:
+            return await self._send_error(send, 401, 'Authentication credentials were not provided.')
+
+        try:
+            chat = await _get_chat(token, chat_uuid)
+        except exceptions.AuthenticationFailed as e:
+            return await self._send_error(send, 401, str(e.detail))
+        except (Chat.DoesNotExist, ValueError):
+            return await self._send_error(send, 404, 'Not found.')
+
+        cursor = headers.get(b'last-event-id', b'').decode('latin-1') or query.get('cursor', [None])[0]
+        try:
+            position = MessageKeysetPagination().decode_cursor(cursor) if cursor else None
+        except exceptions.NotFound as e:
+            return await self._send_error(send, 404, str(e.detail))
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+            ],
+        })
+
+        subscriber = self.broker.subscribe(chat.pk)
+        disconnected = asyncio.ensure_future(self._wait_for_disconnect(receive))
+        try:
+            # Without a cursor the stream starts from the chat's latest message.
+            if position is None:
+                position = await _get_latest_position(chat)
+
+            loop, event = subscriber
+            while not disconnected.done():
+                event.clear()
+
+                messages, last = await _get_messages_after(chat, position, self.batch_size)
+                if messages:
+                    position = (last.send_date, last.uuid)
+                    await send({'type': 'http.response.body', 'body': self._encode(messages, last), 'more_body': True})
+                    if len(messages) == self.batch_size:
+                        continue
+                else:
+                    await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+
+                waiter = asyncio.ensure_future(event.wait())
+                await asyncio.wait([disconnected, waiter], timeout=self.poll_interval,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+        finally:
+            self.broker.unsubscribe(chat.pk, subscriber)
+            disconnected.cancel()
+
+        await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    def _encode(messages, last):
+        cursor = MessageKeysetPagination.encode_cursor(last)
+        data = json.dumps(messages, cls=JSONEncoder)
+        return f'id: {cursor}\nevent: messages\ndata: {data}\n\n'.encode('utf-8')
+
+
+@database_sync_to_async
+def _may_export(token):
+    # On the pool: with claims tokens, is_superuser is a deferred field and reading it queries
+    user, _ = JWTAuth()._authenticate_credentials(None, token)
+    return bool(user.is_superuser)
+
+
+@database_sync_to_async
+def _next_piece(pieces):
+    return next(pieces, None)
+
+
+class ExportStreamApplication(StreamApplication):
+    # /api/exports/<dataset>.<format> under ASGI, where Django 3.1 would iterate the
+    # StreamingHttpResponse of api.views.ExportAPIView on the event loop and fail on its first
+    # query. Each chunk is read on the database pool by a query of its own (see
+    # Export.iter_keyset_chunks), so the loop only waits and sends.
+    path_regex = re.compile(
+        r'^/api/exports/(?P<dataset>%s)\.(?P<export_format>%s)$' % ('|'.join(exports), '|'.join(EXPORT_FORMATS))
+    )
+
+    def __init__(self):
+        # Only its negotiation and stream compressor are used
+        self.compression = CompressionMiddleware(lambda request: None)
+
+    def matches(self, scope):
+        return super().matches(scope) and scope['method'] == 'GET'
+
+    async def __call__(self, scope, receive, send):
+        with replica_reads():
+            await self.handle(scope, receive, send)
+
+    async def handle(self, scope, receive, send):
+        match = self.path_regex.match(scope['path'])
+        dataset, export_format = match.group('dataset'), match.group('export_format')
+        headers = dict(scope['headers'])
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+
+        # 403 like the view, JWTAuth sends no WWW-Authenticate challenge
+        token = self._get_token(headers)
+        if token is None:
+            return await self._send_error(send, 403, str(exceptions.NotAuthenticated.default_detail))
+        try:
+            allowed = await _may_export(token)
+        except exceptions.AuthenticationFailed as e:
+            return await self._send_error(send, 403, str(e.detail))
+        if not allowed:
+            return await self._send_error(send, 403, str(exceptions.PermissionDenied.default_detail))
+
+        query_serializer = ExportQuerySerializer(data={name: values[-1] for name, values in query.items()})
+        if not query_serializer.is_valid():
+            return await self._send_json(send, 400, query_serializer.errors)
+
+        export = exports[dataset](since=query_serializer.validated_data.get('since'))
+        _, content_type = EXPORT_FORMATS[export_format]
+        response_headers = [
+            (b'content-type', content_type.encode('latin-1')),
+            (b'content-disposition', f'attachment; filename="{dataset}.{export_format}"'.encode('latin-1')),
+            (b'vary', b'Accept-Encoding'),
+        ]
+        encoding = self.compression.negotiate(headers.get(b'accept-encoding', b'').decode('latin-1'))
+        if encoding is not None:
+            compress, finish = self.compression.stream_compressor(encoding)
+            response_headers.append((b'content-encoding', encoding.encode('latin-1')))
+        else:
+            compress, finish = (lambda data: data), (lambda: b'')
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers})
+
+        pieces = export.stream(export_format, export.iter_keyset_chunks())
+        disconnected = asyncio.ensure_future(self._wait_for_disconnect(receive))
+        try:
+            while True:
+                piece = await _next_piece(pieces)
+                if piece is None or disconnected.done():
+                    break
+                data = compress(piece.encode('utf-8'))
+                if data:
+                    await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            if disconnected.done():
+                return
+        finally:
+            disconnected.cancel()
+
+        await send({'type': 'http.response.body', 'body': finish()})
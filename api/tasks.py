@@ -0,0 +1,162 @@
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+class RegisteredTask:
+    # A function that can run off the request path. enqueue() stores a Task row with the calling
+    # transaction, so the work exists if and only if the write that asked for it commits, and
+    # survives restarts until a run_tasks worker has done it. Tasks may run more than once (a
+    # retry after a partial run, an expired lease) and must be idempotent.
+
+    def __init__(self, func, name, max_attempts, on_failure):
+        self.func = func
+        self.name = name
+        self.max_attempts = max_attempts
+        self.on_failure = on_failure
+
+    def __call__(self, **kwargs):
+        return self.func(**kwargs)
+
+    def enqueue(self, key=None, using=None, **kwargs):
+        # ``key`` is an idempotency key: while a task with the same key is kept, enqueueing
+        # it again does nothing.
+        self.enqueue_many([(kwargs, key)], using=using)
+
+    def enqueue_many(self, calls, using=None):
+        # ``calls`` are (kwargs, key) pairs, stored with one query
+        from .models import Task
+
+        Task.objects.db_manager(using).enqueue(self.name, calls, max_attempts=self.max_attempts)
+
+
+def task(name=None, max_attempts=None, on_failure=None):
+    # Registers a function of JSON-serializable keyword arguments as a task. on_failure is called
+    # with the same arguments once the last attempt has failed.
+    def decorator(func):
+        registered = RegisteredTask(
+            func,
+            name or f'{func.__module__}.{func.__name__}',
+            max_attempts or getattr(settings, 'TASK_MAX_ATTEMPTS', 5),
+            on_failure,
+        )
+        registry[registered.name] = registered
+        return registered
+    return decorator
+
+
+def retry_delay(attempts):
+    # Exponential backoff with jitter, so tasks failing together do not retry together.
+    base = getattr(settings, 'TASK_RETRY_BACKOFF', 5)
+    delay = min(base * 2 ** (attempts - 1), getattr(settings, 'TASK_RETRY_BACKOFF_MAX', 3600))
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+class TaskWorker:
+    # Claims due tasks and runs them on a thread pool; with one worker, on the calling thread.
+
+    def __init__(self, workers=4, poll_interval=None, lease=None):
+        self.workers = workers
+        self.poll_interval = poll_interval if poll_interval is not None else getattr(settings, 'TASK_POLL_INTERVAL', 1)
+        self.lease = timedelta(seconds=lease if lease is not None else getattr(settings, 'TASK_LEASE', 300))
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.stopping = threading.Event()
+        self.processed = 0
+        self._next_purge = 0.0
+
+    def stop(self):
+        # Finishes the running tasks, claims no more.
+        self.stopping.set()
+
+    def claim(self, limit):
+        from .models import Task
+
+        return Task.objects.claim(self.worker_id, limit, self.lease)
+
+    def run(self, once=False):
+        # ``once`` returns when no task is due instead of polling for more.
+        if self.workers <= 1:
+            return self._run_inline(once)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='task') as executor:
+            running = set()
+            while not self.stopping.is_set():
+                claimed = self.claim(self.workers - len(running)) if len(running) < self.workers else []
+                running.update(executor.submit(self.execute, task) for task in claimed)
+                if claimed:
+                    continue
+                if not running:
+                    if once:
+                        break
+                    self.purge()
+                    self.stopping.wait(self.poll_interval)
+                    continue
+                _, running = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+            wait(running)
+        return self.processed
+
+    def _run_inline(self, once):
+        while not self.stopping.is_set():
+            claimed = self.claim(1)
+            for task in claimed:
+                self.execute(task, close_connections=False)
+            if not claimed:
+                if once:
+                    break
+                self.purge()
+                self.stopping.wait(self.poll_interval)
+        return self.processed
+
+    def execute(self, task, close_connections=True):
+        from .models import Task
+
+        if close_connections:
+            close_old_connections()
+        try:
+            registered = registry.get(task.name)
+            try:
+                if registered is None:
+                    raise LookupError(f'No task is registered as {task.name}')
+                registered(**task.kwargs)
+            except Exception:
+                error = traceback.format_exc()
+                final = registered is None or task.attempts >= task.max_attempts
+                logger.warning('Task %s %s failed (attempt %s of %s)', task.name, task.pk, task.attempts,
+                               task.max_attempts, exc_info=True)
+                Task.objects.fail(task, error, None if final else retry_delay(task.attempts))
+                if final and registered is not None and registered.on_failure is not None:
+                    registered.on_failure(**task.kwargs)
+            else:
+                Task.objects.complete(task)
+            self.processed += 1
+        except Exception:
+            logger.exception('Task %s %s could not be recorded', task.name, task.pk)
+        finally:
+            if close_connections:
+                close_old_connections()
+
+    def purge(self):
+        # Drops finished tasks after TASK_RETENTION seconds, at most once a minute. Their
+        # idempotency keys are free again from then on.
+        from .models import Task
+
+        if time.monotonic() < self._next_purge:
+            return
+        self._next_purge = time.monotonic() + 60
+        retention = timedelta(seconds=getattr(settings, 'TASK_RETENTION', 7 * 24 * 3600))
+        Task.objects.filter(status=Task.STATUS_DONE, finished_at__lt=timezone.now() - retention).delete()
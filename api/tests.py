@@ -1,3 +1,1793 @@
-from django.test import TestCase
+import gzip
+import json
+import math
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+from io import BytesIO, StringIO
+from unittest import mock, skipIf, skipUnless
 
-# Create your tests here.
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.conf import settings
+from django.db import connection, connections, transaction, DatabaseError, OperationalError
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import numpy
+    import scipy
+except ImportError:
+    numpy = scipy = None
+
+from .backends import jwt_cache, token_revocations, JWTAuth
+from .benchmark import SyntheticDataset, run_benchmarks, check_budgets
+from .cache import home_feed_cache
+from .hashers import password_hashing_pool, PasswordHashingBusy
+from .images import image_pipeline, is_public_address
+from .models import User, UserDeletion, Product, Image, ProductImage, Chat, Message, Review, Order, OrderItem, \
+    ProductCategory, Category, ProductDailyStats, MerchantOrderStats, Recommendation, Task
+from .streams import ChatStreamApplication
+from .tasks import task, TaskWorker
+from .instrumentation import metrics_registry
+from .throttling import LoginIPThrottle, LoginEmailThrottle
+from .utils import LRUCache
+from .exports import exports, OrderExport
+from .geo import geocoding_pipeline, geohash_encode, covering_prefixes, haversine_km, within_radius, KM_PER_DEGREE
+from .flat import FlatProductSerializer, FlatMerchantProductSerializer, FlatImageSerializer, \
+    FlatImageThumbnailSerializer
+from .renderers import CompactJSONRenderer
+from .routers import PrimaryReplicaRouter, replica_set, replica_reads, identify_reader, write_pins
+from .serializers import HomeViewSerializer, ProductSerializerForMerchant, ImageSerializer, ImageThumbnailSerializer
+from .views import ProductImportAPIView, MerchantProductsAPIView
+
+
+@contextmanager
+def run_on_commit_callbacks(using='default'):
+    # TestCase never commits; runs the on_commit callbacks registered in the block as the
+    # commit would (captureOnCommitCallbacks(execute=True) from Django 3.2 on).
+    connection = connections[using]
+    start = len(connection.run_on_commit)
+    yield
+    callbacks = connection.run_on_commit[start:]
+    del connection.run_on_commit[start:]
+    for _, callback in callbacks:
+        callback()
+
+
+class APITestCase(TestCase):
+
+    def setUp(self):
+        jwt_cache.clear()
+        home_feed_cache.cache.clear()
+        LoginIPThrottle.clear()
+        LoginEmailThrottle.clear()
+        self.merchant = User.objects.create_user('merchant@ecofoods.test', 'merchant-pass', is_merchant=True,
+                                                 address='Green street 1')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {self.merchant.token}')
+
+    def create_products(self, count, **extra_fields):
+        return [
+            Product.objects.create_product_from_merchant(
+                self.merchant, name=f'Product {i}', price='9.99', units='kg', description='Fresh', **extra_fields
+            )
+            for i in range(count)
+        ]
+
+
+class HomePageAPIViewTests(APITestCase):
+
+    def test_feed_is_cursor_paginated(self):
+        self.create_products(3)
+        self.create_products(2, is_featured=True)
+
+        response = self.client.get(reverse('homepage'), {'page_size': 2})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['announcements']), 2)
+        self.assertEqual(len(response.json()['advertisings']), 2)
+        self.assertEqual(response.json()['announcements'][0]['merchant'], {'address': 'Green street 1'})
+        self.assertIsNotNone(response.json()['next'])
+
+        seen = [p['uuid'] for p in response.json()['announcements']]
+        next_page = self.client.get(response.json()['next'])
+        self.assertEqual(next_page.json()['advertisings'], [])
+        seen += [p['uuid'] for p in next_page.json()['announcements']]
+        self.assertEqual(len(set(seen)), 4)
+
+    def test_query_count_does_not_grow_with_catalogue(self):
+        self.create_products(30, is_featured=True)
+
+        # auth user lookup, announcements page, advertisings
+        with self.assertNumQueries(3):
+            self.client.get(reverse('homepage'))
+
+
+class HomeFeedCacheTests(APITestCase):
+
+    def test_repeat_requests_are_served_from_cache(self):
+        self.create_products(3)
+        first = self.client.get(reverse('homepage'))
+
+        with self.assertNumQueries(0):
+            second = self.client.get(reverse('homepage'))
+
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first['ETag'], second['ETag'])
+
+    def test_if_none_match_returns_not_modified(self):
+        self.create_products(1)
+        etag = self.client.get(reverse('homepage'))['ETag']
+
+        response = self.client.get(reverse('homepage'), HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_product_changes_invalidate_cache(self):
+        product = self.create_products(1)[0]
+        self.client.get(reverse('homepage'))
+
+        with run_on_commit_callbacks():
+            product.name = 'Renamed'
+            product.save()
+            # Not until the change commits
+            response = self.client.get(reverse('homepage'))
+            self.assertNotEqual(response.json()['announcements'][0]['name'], 'Renamed')
+
+        response = self.client.get(reverse('homepage'))
+        self.assertEqual(response.json()['announcements'][0]['name'], 'Renamed')
+
+        with run_on_commit_callbacks():
+            product.delete()
+        self.assertEqual(self.client.get(reverse('homepage')).json()['announcements'], [])
+
+    def test_merchant_address_change_invalidates_cache(self):
+        self.create_products(1)
+        self.client.get(reverse('homepage'))
+
+        with run_on_commit_callbacks():
+            self.client.patch(reverse('update_user'), {'address': 'Orchard lane 5'}, format='json')
+
+        response = self.client.get(reverse('homepage'))
+        self.assertEqual(response.json()['announcements'][0]['merchant'], {'address': 'Orchard lane 5'})
+
+
+class SparseFieldsetTests(APITestCase):
+
+    def test_home_feed_selects_only_requested_columns(self):
+        self.create_products(3, is_featured=True)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('homepage'), {'fields': 'uuid,name,price'})
+
+        self.assertEqual(response.status_code, 200)
+        for product in response.json()['announcements'] + response.json()['advertisings']:
+            self.assertEqual(set(product), {'uuid', 'name', 'price'})
+        # auth user lookup, announcements page, advertisings
+        self.assertEqual(len(queries), 3)
+        for query in queries.captured_queries[1:]:
+            self.assertNotIn('api_user', query['sql'])
+            self.assertNotIn('description', query['sql'])
+
+        response = self.client.get(reverse('homepage'), {'fields': 'uuid,rating', 'expand': 'merchant'})
+        product = response.json()['announcements'][0]
+        self.assertEqual(product['merchant'], {'address': 'Green street 1'})
+        self.assertEqual(set(product), {'uuid', 'rating', 'merchant'})
+
+    def test_merchant_products_skip_images_unless_expanded(self):
+        product = self.create_products(1)[0]
+        ProductImage.objects.create_link(Image.objects.create_image('https://cdn.ecofoods.test/a.jpg'), product)
+
+        # auth user lookup, products
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('merchant_products'), {'fields': 'uuid,name'})
+        self.assertEqual(response.data, [{'uuid': str(product.uuid), 'name': 'Product 0'}])
+
+        response = self.client.get(reverse('merchant_products'), {'fields': 'uuid', 'expand': 'images'})
+        self.assertEqual(set(response.data[0]), {'uuid', 'images'})
+        self.assertEqual(len(response.data[0]['images']), 1)
+
+    def test_unknown_fields_are_rejected(self):
+        response = self.client.get(reverse('merchant_products'), {'fields': 'uuid,password', 'expand': 'name'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('fields', response.data)
+        self.assertIn('expand', response.data)
+
+
+class FlatSerializerTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create_user('other@ecofoods.test', 'other-pass', is_merchant=True)
+        products = self.create_products(4, is_featured=True) + [
+            Product.objects.create_product_from_merchant(self.other, name='Odd', price='1234567.5', units='l',
+                                                         description='')
+        ]
+        buyer = User.objects.create_user('buyer@ecofoods.test', 'buyer-pass')
+        for product, ratings in zip(products, [[], ['5.0'], ['4.0', '3.5', '1.0'], ['2.5', '2.5']]):
+            for rating in ratings:
+                Review.objects.create(product=product, merchant=buyer, rating=Decimal(rating), review_text='ok')
+        for i, product in enumerate(products[:3]):
+            for j in range(i):
+                image = Image.objects.create_image(f'https://cdn.ecofoods.test/{product.uuid}/{j}.jpg')
+                ProductImage.objects.create_link(image, product)
+        Image.objects.filter(url__endswith='/0.jpg').update(variants={'thumbnail': 'images/t.jpg'},
+                                                             status=Image.STATUS_READY)
+
+    def test_output_matches_drf_serializers(self):
+        products = Product.objects.order_by('created_at', 'uuid')
+        for fields in [None, {'uuid', 'price'}, {'rating', 'merchant'}]:
+            flat = FlatProductSerializer(fields=fields)
+            self.assertEqual(flat.serialize(flat.values(products)),
+                             HomeViewSerializer(products.select_related('merchant'), many=True, fields=fields).data)
+
+        for fields in [None, {'name', 'images'}]:
+            flat = FlatMerchantProductSerializer(fields=fields)
+            expected = ProductSerializerForMerchant(products.prefetch_related('product__image'), many=True,
+                                                    fields=fields).data
+            self.assertEqual(flat.serialize(flat.values(products)), expected)
+
+        images = Image.objects.order_by('url')
+        for flat, serializer_class in [(FlatImageSerializer(), ImageSerializer),
+                                       (FlatImageThumbnailSerializer(), ImageThumbnailSerializer)]:
+            self.assertEqual(flat.serialize(flat.values(images)), serializer_class(images, many=True).data)
+
+    def test_throughput_on_large_lists(self):
+        merchant = User(email='bulk@ecofoods.test', address='Bulk lane 3')
+        products = [
+            Product(name=f'Item {i}', price=Decimal(f'{i % 100}.{i % 10}5'), units='kg', is_featured=i % 3 == 0,
+                    merchant=merchant, rating_count=i % 4, rating_sum=Decimal(i % 4 * 3))
+            for i in range(10000)
+        ]
+        rows = [
+            {'uuid': p.uuid, 'name': p.name, 'is_featured': p.is_featured, 'price': p.price, 'units': p.units,
+             'rating_count': p.rating_count, 'rating_sum': p.rating_sum, 'merchant__address': merchant.address}
+            for p in products
+        ]
+
+        def best_of(func, repeat=3):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                result = func()
+                timings.append(time.perf_counter() - started)
+            return min(timings), result
+
+        drf_seconds, expected = best_of(lambda: HomeViewSerializer(products, many=True).data)
+        flat_seconds, data = best_of(lambda: FlatProductSerializer().serialize(rows))
+        self.assertEqual(data, expected)
+        self.assertGreaterEqual(drf_seconds / flat_seconds, 5)
+
+
+class CompactResponseTests(APITestCase):
+
+    def test_compact_renderer_matches_json_renderer(self):
+        data = {
+            'uuid': uuid.uuid4(), 'price': Decimal('1.50'), 'when': timezone.now(), 'day': date(2026, 1, 2),
+            'text': 'caf\u00e9 \u2028 line', 'lazy': gettext_lazy('Not found.'), 'nested': [{1: None, 'b': 2.5}],
+        }
+        self.assertEqual(CompactJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_responses_are_compressed_as_negotiated(self):
+        self.create_products(20)
+        plain = self.client.get(reverse('merchant_products'))
+        self.assertFalse(plain.has_header('Content-Encoding'))
+
+        response = self.client.get(reverse('merchant_products'), HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+
+        response = self.client.get(reverse('merchant_products'), HTTP_ACCEPT_ENCODING='br;q=0, gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    @skipIf(brotli is None, 'brotli is not installed')
+    def test_brotli_is_preferred_when_accepted(self):
+        self.create_products(20)
+        plain = self.client.get(reverse('merchant_products'))
+
+        response = self.client.get(reverse('merchant_products'), HTTP_ACCEPT_ENCODING='gzip;q=0.5, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.content), plain.content)
+        response = self.client.get(reverse('merchant_products'), HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+
+    def test_cached_home_feed_keeps_conditional_requests(self):
+        self.create_products(20)
+        response = self.client.get(reverse('homepage'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(response['ETag'].startswith('W/"'))
+
+        response = self.client.get(reverse('homepage'), HTTP_ACCEPT_ENCODING='gzip',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class MerchantProductsAPIViewTests(APITestCase):
+
+    def create_product_with_images(self, image_count):
+        product = self.create_products(1)[0]
+        for i in range(image_count):
+            image = Image.objects.create_image(f'https://cdn.ecofoods.test/{product.uuid}/{i}.jpg')
+            ProductImage.objects.create_link(image, product)
+        return product
+
+    def test_images_are_serialized(self):
+        product = self.create_product_with_images(2)
+
+        response = self.client.get(reverse('merchant_products'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0]['uuid'], str(product.uuid))
+        self.assertEqual(len(response.data[0]['images']), 2)
+        self.assertTrue(response.data[0]['images'][0]['image']['url'].startswith('https://cdn.ecofoods.test/'))
+
+    def test_query_count_is_constant(self):
+        for _ in range(20):
+            self.create_product_with_images(3)
+
+        # auth user lookup, products, product images joined with their images
+        with self.assertNumQueries(3):
+            self.client.get(reverse('merchant_products'))
+
+
+class JWTAuthCacheTests(APITestCase):
+
+    def test_repeat_requests_skip_user_lookup(self):
+        self.client.get(reverse('merchant_products'))
+
+        # products only
+        with self.assertNumQueries(1):
+            self.client.get(reverse('merchant_products'))
+
+    def test_update_through_cached_user_keeps_password(self):
+        self.client.get(reverse('merchant_products'))
+
+        response = self.client.patch(reverse('update_user'), {'first_name': 'Anna'}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.merchant.refresh_from_db()
+        self.assertEqual(self.merchant.first_name, 'Anna')
+        self.assertTrue(self.merchant.check_password('merchant-pass'))
+
+    def test_deactivation_invalidates_cached_token(self):
+        self.client.get(reverse('merchant_products'))
+
+        self.merchant.is_active = False
+        self.merchant.save()
+
+        response = self.client.get(reverse('merchant_products'))
+        self.assertEqual(response.status_code, 403)
+
+    def test_tag_index_follows_evictions(self):
+        cache = LRUCache(max_size=3, ttl=60)
+        cache.set('a1', 1, tag='a')
+        cache.set('b1', 2, tag='b')
+        cache.set('a2', 3, tag='a')
+        cache.set('b2', 4, tag='b')  # evicts a1
+        cache.set('c1', 5, ttl=-1, tag='c')  # expired, evicts b1
+        self.assertIsNone(cache.get('c1'))
+        self.assertEqual(cache._tagged, {'a': {'a2'}, 'b': {'b2'}})
+
+        cache.delete_tag('a')
+        self.assertEqual(cache.items(), [('b2', 4)])
+        self.assertEqual(cache._tagged, {'b': {'b2'}})
+
+    def test_user_changes_drop_only_their_tokens(self):
+        buyer = User.objects.create_user('buyer@ecofoods.test', 'buyer-pass')
+        tokens = {user: user.token for user in (self.merchant, buyer)}
+        for token in tokens.values():
+            self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {token}')
+            self.client.get(reverse('merchant_products'))
+
+        buyer.first_name = 'Ben'
+        buyer.save()
+        # The merchant's token stays cached, the buyer's is looked up again
+        self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {tokens[self.merchant]}')
+        with self.assertNumQueries(1):
+            self.client.get(reverse('merchant_products'))
+        self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {tokens[buyer]}')
+        with self.assertNumQueries(2):
+            self.client.get(reverse('merchant_products'))
+
+
+@override_settings(JWT_CLAIMS_TOKENS=True)
+class ClaimsTokenTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        token_revocations.clear()
+        self.addCleanup(token_revocations.clear)
+        self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {self.merchant.token}')
+
+    def test_requests_skip_user_row(self):
+        # The first check loads the revocations
+        self.client.get(reverse('merchant_products'))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('merchant_products'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([query['sql'] for query in queries if '"api_user"' in query['sql']], [])
+
+    def test_other_fields_load_the_row_once(self):
+        user, _ = JWTAuth()._authenticate_credentials(None, self.merchant.token)
+        with self.assertNumQueries(0):
+            self.assertEqual((user.pk, user.is_merchant, user.is_authenticated), (self.merchant.pk, True, True))
+        with self.assertNumQueries(1):
+            self.assertEqual((user.email, user.address, user.is_superuser), ('merchant@ecofoods.test', 'Green street 1', False))
+
+        response = self.client.patch(reverse('update_user'), {'first_name': 'Anna'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.merchant.refresh_from_db()
+        self.assertEqual(self.merchant.first_name, 'Anna')
+        self.assertTrue(self.merchant.check_password('merchant-pass'))
+
+    @override_settings(JWT_REVOCATION_REFRESH=0)
+    def test_password_change_and_deactivation_revoke_tokens(self):
+        old_token = self.merchant.token
+        self.merchant.set_password('new-merchant-pass')
+        self.merchant.save(update_fields=['password'])
+
+        self.assertEqual(self.client.get(reverse('merchant_products')).status_code, 403)
+        new_token = self.merchant.token
+        self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {new_token}')
+        self.assertEqual(self.client.get(reverse('merchant_products')).status_code, 200)
+        # Checked against the row for tokens without claims
+        with override_settings(JWT_CLAIMS_TOKENS=False):
+            self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {old_token}')
+            self.assertEqual(self.client.get(reverse('merchant_products')).status_code, 403)
+
+        self.merchant.is_active = False
+        self.merchant.save()
+        self.assertEqual(User.objects.get(pk=self.merchant.pk).token_version, 2)
+        self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {new_token}')
+        self.assertEqual(self.client.get(reverse('merchant_products')).status_code, 403)
+
+    @override_settings(JWT_REVOCATION_REFRESH=0)
+    def test_deletion_revokes_tokens_in_every_process(self):
+        token, user_id = self.merchant.token, self.merchant.pk
+        self.assertEqual(self.client.get(reverse('merchant_products')).status_code, 200)
+
+        # The deleting process revokes on commit, which TestCase never reaches: like any other
+        # process, this one learns about the deletion from the database.
+        self.merchant.delete()
+        self.assertTrue(UserDeletion.objects.filter(user_id=user_id).exists())
+        self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {token}')
+        self.assertEqual(self.client.get(reverse('merchant_products')).status_code, 403)
+        self.assertTrue(token_revocations.is_revoked(user_id, 10 ** 6))
+
+
+class LoginAPIViewTests(APITestCase):
+
+    def login(self, email='merchant@ecofoods.test', password='merchant-pass', **extra):
+        return APIClient().post(reverse('user_login'), {'email': email, 'password': password}, format='json',
+                                **extra)
+
+    @override_settings(PASSWORD_HASHERS=['api.hashers.TunedPBKDF2PasswordHasher',
+                                         'django.contrib.auth.hashers.MD5PasswordHasher'],
+                       PASSWORD_HASHER_PARAMS={'pbkdf2_sha256': {'iterations': 1000}})
+    def test_login_rehashes_outdated_password(self):
+        User.objects.filter(pk=self.merchant.pk).update(password=make_password('merchant-pass', hasher='md5'))
+
+        self.assertEqual(self.login().status_code, 200)
+        self.merchant.refresh_from_db()
+        self.assertTrue(self.merchant.password.startswith('pbkdf2_sha256$1000$'))
+
+        with override_settings(PASSWORD_HASHER_PARAMS={'pbkdf2_sha256': {'iterations': 1200}}):
+            self.assertEqual(self.login().status_code, 200)
+        self.merchant.refresh_from_db()
+        self.assertTrue(self.merchant.password.startswith('pbkdf2_sha256$1200$'))
+        self.assertEqual(self.login(password='wrong').status_code, 400)
+
+    @override_settings(LOGIN_THROTTLE_RATES={'ip': (100, 60), 'email': (3, 60)})
+    def test_attempts_per_email_are_throttled(self):
+        for _ in range(3):
+            self.assertEqual(self.login(password='wrong').status_code, 400)
+        response = self.login()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(self.login('customer@ecofoods.test').status_code, 400)
+
+    @override_settings(LOGIN_THROTTLE_RATES={'ip': (2, 60), 'email': (100, 60)})
+    def test_attempts_per_ip_are_throttled(self):
+        self.assertEqual(self.login('a@ecofoods.test').status_code, 400)
+        self.assertEqual(self.login('b@ecofoods.test').status_code, 400)
+        self.assertEqual(self.login('c@ecofoods.test').status_code, 429)
+        self.assertEqual(self.login('c@ecofoods.test', REMOTE_ADDR='10.0.0.2').status_code, 400)
+
+    @override_settings(LOGIN_THROTTLE_RATES={'ip': (2, 60), 'email': (100, 60)})
+    def test_forwarded_for_does_not_reset_ip_throttle(self):
+        for i, email in enumerate(['a@ecofoods.test', 'b@ecofoods.test']):
+            self.assertEqual(self.login(email, HTTP_X_FORWARDED_FOR=f'203.0.113.{i}').status_code, 400)
+        self.assertEqual(self.login('c@ecofoods.test', HTTP_X_FORWARDED_FOR='203.0.113.9').status_code, 429)
+
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            self.assertEqual(self.login('c@ecofoods.test', HTTP_X_FORWARDED_FOR='203.0.113.9').status_code, 400)
+
+    def test_busy_hashing_pool_returns_503(self):
+        with mock.patch.object(password_hashing_pool, 'run', side_effect=PasswordHashingBusy):
+            self.assertEqual(self.login().status_code, 503)
+
+
+@override_settings(IMAGE_PIPELINE_ENABLED=True)
+class ProductImportAPIViewTests(APITestCase):
+
+    def test_json_import_reports_row_errors(self):
+        rows = [
+            {'name': 'Apples', 'price': '1.50', 'units': 'kg', 'description': 'Red', 'img': 'https://cdn.test/a.jpg'},
+            {'name': 'Pears', 'units': 'kg', 'description': 'Green', 'img': 'https://cdn.test/p.jpg'},
+            {'name': 'Plums', 'price': '2.00', 'units': 'kg', 'description': 'Blue', 'img': 'https://cdn.test/b.jpg'},
+        ]
+
+        response = self.client.post(reverse('merchant_import_products'), rows, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual([error['row'] for error in response.data['errors']], [1])
+        self.assertIn('price', response.data['errors'][0]['errors'])
+        self.assertEqual(ProductImage.objects.filter(product__merchant=self.merchant).count(), 2)
+
+    def test_body_that_is_not_rows_is_rejected(self):
+        for body in ('null', '42', '"Apples"'):
+            response = self.client.post(reverse('merchant_import_products'), body, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_ndjson_and_csv_import(self):
+        ndjson = (
+            '{"name": "Milk", "price": "0.99", "units": "l", "description": "Fresh", "img": "https://cdn.test/m.jpg"}\n'
+            'not json\n'
+        )
+        response = self.client.post(reverse('merchant_import_products'), ndjson,
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(response.data['errors'][0]['row'], 1)
+
+        csv_body = (
+            'name,price,units,description,is_featured,img\n'
+            'Eggs,3.10,pcs,Free range,true,https://cdn.test/e.jpg\n'
+        )
+        response = self.client.post(reverse('merchant_import_products'), csv_body, content_type='text/csv')
+        self.assertEqual(response.data, {'created': 1, 'errors': []})
+        self.assertTrue(Product.objects.get(name='Eggs').is_featured)
+
+    def test_rows_are_inserted_in_chunks(self):
+        rows = [
+            {'name': f'Item {i}', 'price': '1.00', 'units': 'kg', 'description': 'Fresh', 'img': 'https://cdn.test/i.jpg'}
+            for i in range(10)
+        ]
+
+        # auth user lookup, then for each of the 3 chunks: savepoint, image lookup, 2 inserts, search index
+        # and release; the shared image URL is inserted (and read back, and its processing queued) by the
+        # first chunk only
+        with mock.patch.object(ProductImportAPIView, 'chunk_size', 4), self.assertNumQueries(22):
+            response = self.client.post(reverse('merchant_import_products'), rows, format='json')
+
+        self.assertEqual(response.data['created'], 10)
+        self.assertEqual(Product.objects.count(), 10)
+        self.assertEqual(Image.objects.count(), 1)
+
+    def test_categories_are_checked_once_per_chunk(self):
+        image = Image.objects.create_image('https://cdn.test/c.jpg')
+        fruit = Category.objects.create(name='Fruit', image=image)
+        dairy = Category.objects.create(name='Dairy', image=image)
+        rows = [
+            {'name': f'Item {i}', 'price': '1.00', 'units': 'kg', 'description': 'Fresh', 'img': 'https://cdn.test/i.jpg',
+             'categories': [str(fruit.pk), str(dairy.pk)] if i % 2 else [str(fruit.pk)]}
+            for i in range(10)
+        ]
+        rows[5]['categories'] = [str(uuid.uuid4())]
+
+        # auth user lookup, then for each of the 3 chunks: the chunk's categories, savepoint, image lookup,
+        # 2 inserts, category links, a counter update per category, search index and release; the image is
+        # inserted (and read back, and its processing queued) by the first chunk only
+        with mock.patch.object(ProductImportAPIView, 'chunk_size', 4), self.assertNumQueries(34):
+            response = self.client.post(reverse('merchant_import_products'), rows, format='json')
+
+        self.assertEqual(response.data['created'], 9)
+        self.assertEqual([error['row'] for error in response.data['errors']], [5])
+        self.assertIn('Unknown categories', str(response.data['errors'][0]['errors']['categories']))
+        self.assertEqual(ProductCategory.objects.filter(category=dairy).count(), 4)
+
+
+def make_png(size=(640, 480), color=(120, 200, 80)):
+    from PIL import Image as PILImage
+
+    buffer = BytesIO()
+    PILImage.new('RGB', size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@override_settings(IMAGE_PIPELINE_ENABLED=True)
+class ImagePipelineTests(APITestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        png = make_png()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/missing'):
+                    self.send_error(404)
+                    return
+                if self.path.startswith('/redirect'):
+                    self.send_response(302)
+                    self.send_header('Location', self.path.split('?to=', 1)[1])
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(png)))
+                self.end_headers()
+                self.wfile.write(png)
+
+            def log_message(self, *args):
+                pass
+
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        # The test server is on loopback
+        settings_override = override_settings(MEDIA_ROOT=media_root, IMAGE_PROCESS_WORKERS=0,
+                                              IMAGE_FETCH_PRIVATE_NETWORKS=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    @override_settings(IMAGE_FETCH_PRIVATE_NETWORKS=False)
+    def test_only_public_http_hosts_are_fetched(self):
+        for address in ('127.0.0.1', '10.1.2.3', '169.254.169.254', '::1', '::ffff:192.168.0.1', 'fd00::1'):
+            self.assertFalse(is_public_address(address), address)
+        self.assertTrue(is_public_address('93.184.216.34'))
+
+        port = self.server.server_port
+        # Loopback as if it were public, to reach the test server; other hosts stay blocked
+        with mock.patch('api.images.is_public_address', side_effect=lambda address: address == '127.0.0.1'):
+            self.assertTrue(image_pipeline.fetch(f'{self.base_url}/apples.png'))
+            for url in (f'http://127.0.0.2:{port}/apples.png',
+                        f'{self.base_url}/redirect?to=http://127.0.0.2:{port}/apples.png',
+                        f'{self.base_url}/redirect?to=file:///etc/passwd',
+                        'ftp://127.0.0.1/apples.png'):
+                with self.assertRaises((OSError, ValueError), msg=url):
+                    image_pipeline.fetch(url)
+
+    def test_equivalent_urls_share_one_image(self):
+        image = Image.objects.create_image('HTTPS://CDN.ecofoods.test:443/a.jpg?size=l&v=2#top')
+        self.assertEqual(Image.objects.create_image('https://cdn.ecofoods.test/a.jpg?v=2&size=l'), image)
+        self.assertNotEqual(Image.objects.create_image('https://cdn.ecofoods.test/b.jpg'), image)
+
+        # Another request inserting the same URL between the lookup and the insert
+        with mock.patch('django.db.models.query.QuerySet.first', return_value=None):
+            self.assertEqual(Image.objects.create_image('https://cdn.ecofoods.test/a.jpg?size=l&v=2'), image)
+
+    def test_fetched_image_gets_thumbnail_variants(self):
+        product = self.create_products(1)[0]
+        image = Image.objects.create_image(f'{self.base_url}/apples.png')
+        ProductImage.objects.create_link(image, product)
+
+        image_pipeline.process(image.pk)
+        image.refresh_from_db()
+        self.assertEqual(image.status, Image.STATUS_READY)
+        self.assertEqual(set(image.variants), {'thumbnail', 'medium'})
+        from PIL import Image as PILImage
+        with default_storage.open(image.variants['thumbnail']) as f:
+            self.assertEqual(PILImage.open(f).size, (200, 150))
+
+        response = self.client.get(reverse('merchant_products'))
+        listed = response.data[0]['images'][0]['image']
+        self.assertEqual(listed['url'], image.url)
+        self.assertEqual(listed['thumbnail'], default_storage.url(image.variants['thumbnail']))
+
+    def test_unreachable_image_is_marked_failed(self):
+        image = Image.objects.create_image(f'{self.base_url}/missing.png')
+        with self.assertLogs('api.images', 'WARNING'):
+            image_pipeline.process(image.pk)
+        image.refresh_from_db()
+        self.assertEqual(image.status, Image.STATUS_FAILED)
+
+    def test_queued_processing_runs_in_task_worker(self):
+        image = Image.objects.create_image(f'{self.base_url}/apples.png')
+        Image.objects.create_image(f'{self.base_url}/apples.png')
+        missing = Image.objects.create_image(f'{self.base_url}/missing.png')
+        self.assertEqual(Task.objects.filter(name='api.images.process_image').count(), 2)
+
+        with override_settings(TASK_MAX_ATTEMPTS=1), self.assertLogs('api.tasks', 'WARNING'):
+            Task.objects.update(max_attempts=1)
+            call_command('run_tasks', '--workers=1', '--once', stdout=StringIO())
+        image.refresh_from_db()
+        missing.refresh_from_db()
+        self.assertEqual((image.status, missing.status), (Image.STATUS_READY, Image.STATUS_FAILED))
+
+    def test_process_images_command(self):
+        Image.objects.create_image(f'{self.base_url}/apples.png')
+        Image.objects.create_image(f'{self.base_url}/pears.png')
+
+        out = StringIO()
+        call_command('process_images', '--workers=1', stdout=out)
+        self.assertIn('Processed 2 images, 2 ready', out.getvalue())
+        self.assertFalse(Image.objects.exclude(status=Image.STATUS_READY).exists())
+
+    @override_settings(IMAGE_PROCESS_WORKERS=1)
+    def test_uploads_are_deduplicated_by_content(self):
+        upload = {'file': SimpleUploadedFile('apples.png', make_png(), content_type='image/png')}
+        response = self.client.post(reverse('image_upload'), upload, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        upload = {'file': SimpleUploadedFile('copy.png', make_png(), content_type='image/png')}
+        again = self.client.post(reverse('image_upload'), upload, format='multipart')
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.data['uuid'], response.data['uuid'])
+
+        # Rendered in the process pool
+        self.assertIn('thumbnail', image_pipeline.process(response.data['uuid']))
+
+        response = self.client.post(reverse('merchant_add_product'), {
+            'name': 'Apples', 'price': '1.50', 'units': 'kg', 'image': response.data['uuid'],
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(ProductImage.objects.get(product__name='Apples').image_id, uuid.UUID(again.data['uuid']))
+
+        response = self.client.post(reverse('image_upload'), {
+            'file': SimpleUploadedFile('notes.png', b'not an image', content_type='image/png'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 400)
+
+        with override_settings(IMAGE_MAX_BYTES=len(make_png()) - 1):
+            upload = {'file': SimpleUploadedFile('large.png', make_png(), content_type='image/png')}
+            response = self.client.post(reverse('image_upload'), upload, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('larger than', response.data['file'][0])
+        with override_settings(IMAGE_MAX_BYTES=10), self.assertRaises(ValueError):
+            Image.objects.create_from_upload(SimpleUploadedFile('large.png', make_png()))
+
+
+class ChatMessagesAPIViewTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.buyer = User.objects.create_user('buyer@ecofoods.test', 'buyer-pass')
+        self.chat = Chat.objects.create(user=self.buyer, merchant=self.merchant)
+
+    def test_history_is_keyset_paginated(self):
+        for i in range(5):
+            Message.objects.create(chat=self.chat, sender=self.buyer, text=f'Message {i}')
+        url = reverse('chat_messages', kwargs={'chat_uuid': self.chat.uuid})
+
+        first = self.client.get(url, {'page_size': 3}).json()
+        second = self.client.get(first['next']).json()
+
+        self.assertEqual([m['text'] for m in first['results']], ['Message 4', 'Message 3', 'Message 2'])
+        self.assertEqual([m['text'] for m in second['results']], ['Message 1', 'Message 0'])
+        self.assertIsNone(second['next'])
+
+    def test_post_message(self):
+        url = reverse('chat_messages', kwargs={'chat_uuid': self.chat.uuid})
+
+        response = self.client.post(url, {'text': 'Still fresh?'}, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Message.objects.get(chat=self.chat).sender, self.merchant)
+
+    def test_only_participants_can_read_chat(self):
+        stranger = User.objects.create_user('stranger@ecofoods.test', 'stranger-pass')
+        self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {stranger.token}')
+
+        response = self.client.get(reverse('chat_messages', kwargs={'chat_uuid': self.chat.uuid}))
+
+        self.assertEqual(response.status_code, 404)
+
+
+class ChatStreamApplicationTests(TransactionTestCase):
+
+    def setUp(self):
+        jwt_cache.clear()
+        self.merchant = User.objects.create_user('merchant@ecofoods.test', 'merchant-pass', is_merchant=True)
+        self.buyer = User.objects.create_user('buyer@ecofoods.test', 'buyer-pass')
+        self.chat = Chat.objects.create(user=self.buyer, merchant=self.merchant)
+
+    def open_stream(self, token, query_string=b''):
+        return ApplicationCommunicator(ChatStreamApplication(), {
+            'type': 'http',
+            'path': f'/api/chats/{self.chat.uuid}/stream',
+            'query_string': query_string,
+            'headers': [(b'authorization', f'EcoFoods {token}'.encode())],
+        })
+
+    @async_to_sync
+    async def test_stream_pushes_new_messages(self):
+        communicator = self.open_stream(self.buyer.token)
+        await communicator.send_input({'type': 'http.request'})
+
+        start = await communicator.receive_output(timeout=5)
+        self.assertEqual(start['status'], 200)
+        self.assertEqual((await communicator.receive_output(timeout=5))['body'], b': keep-alive\n\n')
+
+        await sync_to_async(Message.objects.create)(chat=self.chat, sender=self.merchant, text='Hello')
+
+        body = (await communicator.receive_output(timeout=5))['body'].decode()
+        self.assertIn('event: messages', body)
+        self.assertIn('"text": "Hello"', body)
+
+        await communicator.send_input({'type': 'http.disconnect'})
+        await communicator.wait(timeout=5)
+
+    @async_to_sync
+    async def test_stream_rejects_non_participants(self):
+        stranger = await sync_to_async(User.objects.create_user)('stranger@ecofoods.test', 'stranger-pass')
+        communicator = self.open_stream(stranger.token)
+        await communicator.send_input({'type': 'http.request'})
+
+        start = await communicator.receive_output(timeout=5)
+        self.assertEqual(start['status'], 404)
+
+
+class ProductRatingTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.product, self.other = self.create_products(2)
+
+    def review(self, product, rating):
+        return Review.objects.create(product=product, merchant=self.merchant, rating=rating, review_text='Nice')
+
+    def assertRating(self, product, count, rating_sum):
+        product.refresh_from_db()
+        self.assertEqual((product.rating_count, product.rating_sum), (count, Decimal(rating_sum)))
+
+    def test_rating_follows_review_writes(self):
+        first = self.review(self.product, '4.0')
+        self.review(self.product, '5.0')
+        self.assertRating(self.product, 2, '9.0')
+        self.assertEqual(self.product.rating, Decimal('4.50'))
+
+        first.rating = '2.5'
+        first.save()
+        self.assertRating(self.product, 2, '7.5')
+
+        first = Review.objects.get(pk=first.pk)
+        first.product = self.other
+        first.save()
+        self.assertRating(self.product, 1, '5.0')
+        self.assertRating(self.other, 1, '2.5')
+
+        first.delete()
+        self.assertRating(self.other, 0, '0')
+
+    def test_reviews_loaded_with_deferred_rating(self):
+        review = self.review(self.product, '4.0')
+
+        deferred = Review.objects.defer('rating').get(pk=review.pk)
+        deferred.review_text = 'Still nice'
+        deferred.save()
+        self.assertRating(self.product, 1, '4.0')
+
+        deferred = Review.objects.only('uuid').get(pk=review.pk)
+        deferred.rating = '3.0'
+        deferred.save()
+        self.assertRating(self.product, 1, '3.0')
+
+    def test_recompute_ratings_repairs_drift(self):
+        self.review(self.product, '3.0')
+        Product.objects.update(rating_count=7, rating_sum=1, date_modified=timezone.now() - timedelta(hours=1))
+        self.client.get(reverse('homepage'))
+        since = timezone.now() - timedelta(minutes=1)
+
+        with run_on_commit_callbacks():
+            call_command('recompute_ratings', batch_size=1, stdout=StringIO())
+
+        self.assertRating(self.product, 1, '3.0')
+        self.assertRating(self.other, 0, '0')
+        # Both were repaired, so incremental exports pick them up
+        export = exports['products'](since=since)
+        self.assertEqual(sum(len(chunk) for chunk in export.iter_chunks()), 2)
+        feed = self.client.get(reverse('homepage')).json()['announcements']
+        self.assertEqual(sorted(product['rating_count'] for product in feed), [0, 1])
+
+    def test_review_writes_refresh_cached_feed(self):
+        def served_rating():
+            feed = self.client.get(reverse('homepage')).json()['announcements']
+            return next((product['rating_count'], product['rating'])
+                        for product in feed if product['uuid'] == str(self.product.pk))
+
+        self.assertEqual(served_rating(), (0, None))
+        with run_on_commit_callbacks():
+            review = self.review(self.product, '4.0')
+            # Not until the review commits
+            self.assertEqual(served_rating(), (0, None))
+        self.assertEqual(served_rating(), (1, '4.00'))
+
+        with run_on_commit_callbacks():
+            review.delete()
+        self.assertEqual(served_rating(), (0, None))
+
+
+class OrderAPIViewTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.apples, self.pears = self.create_products(2, stock=5)
+        self.honey = self.create_products(1)[0]
+
+    def test_place_order(self):
+        items = [
+            {'product': str(self.apples.uuid), 'quantity': 2},
+            {'product': str(self.honey.uuid), 'quantity': 1},
+            {'product': str(self.apples.uuid), 'quantity': 1},
+        ]
+
+        # auth user lookup, savepoint, products, stock update, order, items, then the rollups (insert missing
+        # product rows, an update per product, insert missing status row, its update) and release
+        with self.assertNumQueries(12):
+            response = self.client.post(reverse('orders'), {'items': items}, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['status'], Order.STATUS_PLACED)
+        self.assertEqual(sorted(item['quantity'] for item in response.data['items']), [1, 3])
+        self.apples.refresh_from_db()
+        self.assertEqual(self.apples.stock, 2)
+        self.assertEqual(OrderItem.objects.get(product=self.honey).price, Decimal('9.99'))
+
+    def test_order_is_rejected_as_a_whole(self):
+        items = [
+            {'product': str(self.apples.uuid), 'quantity': 1},
+            {'product': str(self.pears.uuid), 'quantity': 6},
+        ]
+
+        response = self.client.post(reverse('orders'), {'items': items}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(self.pears.uuid), response.data['items'][0])
+        self.apples.refresh_from_db()
+        self.assertEqual(self.apples.stock, 5)
+        self.assertFalse(Order.objects.exists())
+
+    def test_unknown_product(self):
+        response = self.client.post(reverse('orders'), {'items': [{'product': str(uuid.uuid4()), 'quantity': 1}]},
+                                    format='json')
+
+        self.assertEqual(response.status_code, 400)
+
+
+class MerchantDashboardTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.buyer = User.objects.create_user('buyer@ecofoods.test', 'buyer-pass')
+        self.other = User.objects.create_user('other@ecofoods.test', 'other-pass', is_merchant=True)
+        self.apples, self.honey = self.create_products(2)
+        self.plums = Product.objects.create_product_from_merchant(self.other, name='Plums', price='3.00', units='kg',
+                                                                  description='Blue')
+
+    def rollups(self):
+        return (
+            sorted(ProductDailyStats.objects.values_list('product', 'day', 'orders', 'units_sold', 'revenue',
+                                                        'review_count', 'rating_sum')),
+            sorted(MerchantOrderStats.objects.filter(orders__gt=0).values_list('merchant', 'day', 'status', 'orders')),
+        )
+
+    def test_dashboard_reads_rollups(self):
+        Order.objects.place_order(self.buyer, {self.apples.pk: 2, self.honey.pk: 1, self.plums.pk: 5})
+        shipped = Order.objects.place_order(self.buyer, {self.apples.pk: 1})
+        shipped = Order.objects.get(pk=shipped.pk)
+        shipped.status = 'shipped'
+        shipped.save()
+        Review.objects.create(product=self.apples, merchant=self.buyer, rating=Decimal('4.0'), review_text='ok')
+        Review.objects.create(product=self.apples, merchant=self.buyer, rating=Decimal('5.0'), review_text='ok')
+
+        # auth user lookup, daily sales, daily order statuses, top products
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('merchant_dashboard'), {'days': 7})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['days']), 7)
+        self.assertEqual(response.data['totals'], {
+            'orders': 2, 'units_sold': 4, 'revenue': '39.96', 'review_count': 2, 'average_rating': '4.50',
+        })
+        self.assertEqual(response.data['days'][-1]['orders'], 2)
+        self.assertEqual(response.data['days'][0]['revenue'], '0.00')
+        self.assertEqual(response.data['order_statuses'], {'placed': 1, 'shipped': 1})
+        self.assertEqual([(p['name'], p['orders'], p['units_sold']) for p in response.data['products']],
+                         [(self.apples.name, 2, 3), (self.honey.name, 1, 1)])
+
+        response = self.client.get(reverse('merchant_dashboard'), {'days': 0})
+        self.assertEqual(response.status_code, 400)
+
+    def test_review_changes_update_rollups(self):
+        review = Review.objects.create(product=self.apples, merchant=self.buyer, rating=Decimal('4.0'),
+                                       review_text='ok')
+        review = Review.objects.get(pk=review.pk)
+        review.rating = Decimal('2.5')
+        review.save()
+        stats = ProductDailyStats.objects.get(product=self.apples)
+        self.assertEqual((stats.review_count, stats.rating_sum), (1, Decimal('2.5')))
+
+        review.delete()
+        stats.refresh_from_db()
+        self.assertEqual((stats.review_count, stats.rating_sum), (0, Decimal('0')))
+
+    def test_backfill_rebuilds_incremental_rollups(self):
+        Order.objects.place_order(self.buyer, {self.apples.pk: 2, self.plums.pk: 1})
+        old = Order.objects.place_order(self.buyer, {self.honey.pk: 3, self.apples.pk: 1})
+        Review.objects.create(product=self.honey, merchant=self.buyer, rating=Decimal('3.0'), review_text='ok')
+        incremental = self.rollups()
+
+        ProductDailyStats.objects.all().delete()
+        MerchantOrderStats.objects.all().delete()
+        call_command('backfill_rollups', '--chunk-days=1', stdout=StringIO())
+        self.assertEqual(self.rollups(), incremental)
+
+        # History edited behind the rollups' back is picked up by the next backfill
+        Order.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=10))
+        out = StringIO()
+        call_command('backfill_rollups', '--chunk-days=3', stdout=out)
+        self.assertIn('Rebuilt 8 rollup rows', out.getvalue())
+        ten_days_ago = timezone.localdate() - timedelta(days=10)
+        self.assertEqual(ProductDailyStats.objects.get(product=self.honey, day=ten_days_ago).units_sold, 3)
+        self.assertEqual(MerchantOrderStats.objects.get(merchant=self.merchant, day=ten_days_ago).orders, 1)
+
+
+class ExportTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        User.objects.filter(pk=self.merchant.pk).update(is_superuser=True)
+        jwt_cache.clear()
+        self.buyer = User.objects.create_user('buyer@ecofoods.test', 'buyer-pass')
+
+    def test_products_stream_with_related_columns_per_chunk(self):
+        products = self.create_products(5)
+        fruit = Category.objects.create(name='Fruit', image=Image.objects.create_image('https://cdn.test/f.jpg'))
+        ProductCategory.objects.create_links([(products[0], fruit.pk), (products[3], fruit.pk)])
+        ProductImage.objects.create_link(Image.objects.create_image('https://cdn.test/p.jpg'), products[3])
+
+        export = exports['products'](chunk_size=2)
+        stream = export.stream('ndjson')
+        # One cursor for the products, then categories and images for each of the three chunks
+        with self.assertNumQueries(7):
+            rows = [json.loads(line) for piece in stream for line in piece.splitlines()]
+        # Linking the categories moved products 0 and 3 to the end of the watermark order
+        self.assertEqual([row['uuid'] for row in rows], [
+            str(pk) for pk in Product.objects.order_by('date_modified', 'pk').values_list('pk', flat=True)
+        ])
+        by_uuid = {row['uuid']: row for row in rows}
+        linked, plain = by_uuid[str(products[3].pk)], by_uuid[str(products[1].pk)]
+        self.assertEqual(linked['categories'], ['Fruit'])
+        self.assertEqual(linked['images'], ['https://cdn.test/p.jpg'])
+        self.assertEqual((linked['price'], linked['stock'], plain['categories']), ('9.99', None, []))
+        self.assertEqual(export.count, 5)
+
+        response = self.client.get(reverse('export', args=['products', 'ndjson']))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], rows)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {self.buyer.token}')
+        response = self.client.get(reverse('export', args=['products', 'csv']))
+        self.assertEqual(response.status_code, 403)
+
+    def test_orders_export_incrementally_from_watermark(self):
+        apples, honey = self.create_products(2)
+        first = Order.objects.place_order(self.buyer, {apples.pk: 2, honey.pk: 1})
+        Order.objects.filter(pk=first.pk).update(created_at=timezone.now() - timedelta(days=1))
+        second = Order.objects.place_order(self.buyer, {honey.pk: 3})
+
+        response = self.client.get(reverse('export', args=['orders', 'csv']))
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], ','.join(OrderExport.columns))
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], [str(first.pk)] * 2 + [str(second.pk)])
+
+        out, err = StringIO(), StringIO()
+        call_command('export_data', 'orders', stdout=out, stderr=err)
+        self.assertEqual(out.getvalue().splitlines(), lines)
+        watermark = err.getvalue().split('--since ')[1].strip()
+
+        third = Order.objects.place_order(self.buyer, {apples.pk: 1})
+        out = StringIO()
+        call_command('export_data', 'orders', '--format=ndjson', f'--since={watermark}', stdout=out,
+                     stderr=StringIO())
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(row['order'], row['quantity']) for row in rows], [(str(second.pk), 3), (str(third.pk), 1)])
+
+        response = self.client.get(reverse('export', args=['reviews', 'csv']), {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rating_and_category_changes_reach_incremental_product_exports(self):
+        rated, linked, unchanged = self.create_products(3)
+        fruit = Category.objects.create(name='Fruit', image=Image.objects.create_image('https://cdn.test/f.jpg'))
+        Product.objects.update(date_modified=timezone.now() - timedelta(hours=1))
+        since = timezone.now() - timedelta(minutes=1)
+
+        def changed():
+            return [row['uuid'] for chunk in exports['products'](since=since).iter_chunks() for row in chunk]
+
+        self.assertEqual(changed(), [])
+        Review.objects.create(product=rated, merchant=self.buyer, rating=4, review_text='Good')
+        ProductCategory.objects.create_links([(linked, fruit.pk)])
+        self.assertEqual(sorted(changed()), sorted([str(rated.pk), str(linked.pk)]))
+
+        Product.objects.update(date_modified=timezone.now() - timedelta(hours=1))
+        ProductCategory.objects.filter(product=linked).delete()
+        self.assertEqual(changed(), [str(linked.pk)])
+
+    def test_streamed_exports_are_compressed(self):
+        self.create_products(30)
+        plain = b''.join(self.client.get(reverse('export', args=['products', 'csv'])).streaming_content)
+
+        response = self.client.get(reverse('export', args=['products', 'csv']), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), plain)
+
+
+
+@override_settings(EXPORT_CHUNK_SIZE=2)
+class ExportStreamApplicationTests(TransactionTestCase):
+    # GET requests read from the replica when one is configured
+    databases = '__all__'
+
+    def setUp(self):
+        jwt_cache.clear()
+        self.merchant = User.objects.create_user('merchant@ecofoods.test', 'merchant-pass', is_merchant=True)
+        User.objects.filter(pk=self.merchant.pk).update(is_superuser=True)
+        self.buyer = User.objects.create_user('buyer@ecofoods.test', 'buyer-pass')
+        self.products = [
+            Product.objects.create_product_from_merchant(
+                self.merchant, name=f'Product {i}', price='9.99', units='kg', description='Fresh'
+            )
+            for i in range(5)
+        ]
+        # Rows sharing a watermark are told apart by the tie-breakers
+        Product.objects.filter(pk__in=[product.pk for product in self.products[1:4]])\
+            .update(date_modified=timezone.now())
+        fruit = Category.objects.create(name='Fruit', image=Image.objects.create_image('https://cdn.test/f.jpg'))
+        ProductCategory.objects.create_links([(self.products[2], fruit.pk)])
+
+    def get(self, path, token, query_string=b'', headers=()):
+        # Through the project's ASGI application, as served in production
+        from EcoFoods.asgi import application
+
+        async def request():
+            communicator = ApplicationCommunicator(application, {
+                'type': 'http',
+                'method': 'GET',
+                'path': path,
+                'query_string': query_string,
+                'headers': [(b'authorization', f'EcoFoods {token}'.encode()), *headers],
+            })
+            await communicator.send_input({'type': 'http.request'})
+            start = await communicator.receive_output(timeout=5)
+            body = b''
+            while True:
+                message = await communicator.receive_output(timeout=5)
+                body += message['body']
+                if not message.get('more_body'):
+                    break
+            await communicator.wait(timeout=5)
+            return start, body
+
+        return async_to_sync(request)()
+
+    def test_exports_stream_through_asgi(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {self.merchant.token}')
+        expected = b''.join(client.get(reverse('export', args=['products', 'ndjson'])).streaming_content)
+
+        start, body = self.get('/api/exports/products.ndjson', self.merchant.token)
+        self.assertEqual(start['status'], 200)
+        headers = dict(start['headers'])
+        self.assertEqual(headers[b'content-type'], b'application/x-ndjson; charset=utf-8')
+        self.assertEqual(body, expected)
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual(len({row['uuid'] for row in rows}), 5)
+        self.assertEqual([row['categories'] for row in rows if row['uuid'] == str(self.products[2].pk)], [['Fruit']])
+
+        start, body = self.get('/api/exports/products.csv', self.merchant.token, headers=[(b'accept-encoding', b'gzip')])
+        self.assertEqual(dict(start['headers'])[b'content-encoding'], b'gzip')
+        self.assertEqual(gzip.decompress(body).decode().splitlines()[0].split(',')[:2], ['uuid', 'name'])
+        self.assertEqual(len(gzip.decompress(body).decode().splitlines()), 6)
+
+    @override_settings(JWT_CLAIMS_TOKENS=True)
+    def test_exports_stream_through_asgi_with_claims_tokens(self):
+        start, body = self.get('/api/exports/products.csv', self.merchant.token)
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(len(body.decode().splitlines()), 6)
+        start, _ = self.get('/api/exports/products.csv', self.buyer.token)
+        self.assertEqual(start['status'], 403)
+
+    def test_export_stream_checks_user_and_query(self):
+        start, _ = self.get('/api/exports/orders.csv', self.buyer.token)
+        self.assertEqual(start['status'], 403)
+        start, body = self.get('/api/exports/orders.csv', 'not-a-token')
+        self.assertEqual(start['status'], 403)
+        self.assertEqual(json.loads(body), APIClient().get(reverse('export', args=['orders', 'csv']),
+                                                           HTTP_AUTHORIZATION='EcoFoods not-a-token').json())
+        start, body = self.get('/api/exports/orders.csv', self.merchant.token, query_string=b'since=yesterday')
+        self.assertEqual(start['status'], 400)
+        self.assertIn('since', json.loads(body))
+
+PLACES = {
+    'Alexanderplatz 1, Berlin': (52.5219, 13.4132),
+    'Brandenburger Tor, Berlin': (52.5163, 13.3777),
+    'Am Neuen Markt 1, Potsdam': (52.3989, 13.0657),
+    'Rathausmarkt 1, Hamburg': (53.5503, 9.9920),
+}
+
+
+@override_settings(GEOCODER='api.geo.OfflineGeocoder', GEOCODER_PLACES=PLACES)
+class NearbyFeedTests(APITestCase):
+
+    def create_merchant(self, name, address):
+        merchant = User.objects.create_user(f'{name}@ecofoods.test', 'merchant-pass', is_merchant=True,
+                                            address=address)
+        geocoding_pipeline.process(merchant.pk)
+        Product.objects.create_product_from_merchant(merchant, name=name, price='2.00', units='kg', description='Local')
+        return merchant
+
+    def test_covering_prefixes_contain_every_point_within_radius(self):
+        self.assertEqual(geohash_encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        for latitude, longitude, radius in [(52.52, 13.405, 25), (0.0, 179.99, 50), (-33.9, 151.2, 1)]:
+            prefixes = covering_prefixes(latitude, longitude, radius)
+            self.assertLessEqual(len(prefixes), 16)
+            for step in range(-10, 11):
+                # Points just inside the radius, north-south and east-west (wrapping the antimeridian)
+                offset = step / 10 * radius * 0.999 / KM_PER_DEGREE
+                for point in [(latitude + offset, longitude),
+                              (latitude, (longitude + offset / math.cos(math.radians(latitude)) + 540) % 360 - 180)]:
+                    self.assertLessEqual(haversine_km(latitude, longitude, *point), radius)
+                    self.assertTrue(geohash_encode(*point).startswith(tuple(prefixes)), (point, prefixes))
+
+    def test_addresses_are_geocoded_once(self):
+        merchant = self.create_merchant('alex', 'alexanderplatz 1 berlin')
+        merchant.refresh_from_db()
+        self.assertEqual((merchant.latitude, merchant.longitude), PLACES['Alexanderplatz 1, Berlin'])
+        self.assertEqual(merchant.geohash, geohash_encode(*PLACES['Alexanderplatz 1, Berlin']))
+
+        out = StringIO()
+        call_command('geocode_merchants', stdout=out)
+        # Only self.merchant had not been geocoded, and its street is unknown
+        self.assertIn('Geocoded 1 merchants, 0 located', out.getvalue())
+
+        with mock.patch('api.geo.OfflineGeocoder.geocode') as geocode:
+            self.assertEqual(geocoding_pipeline.process(merchant.pk), PLACES['Alexanderplatz 1, Berlin'])
+            out = StringIO()
+            call_command('geocode_merchants', stdout=out)
+            geocode.assert_not_called()
+        self.assertIn('Geocoded 0 merchants', out.getvalue())
+
+        merchant.address = 'Nowhere 1'
+        merchant.save()
+        self.assertIsNone(geocoding_pipeline.process(merchant.pk))
+        merchant.refresh_from_db()
+        self.assertEqual((merchant.geocoded_address, merchant.geohash, merchant.latitude), ('Nowhere 1', None, None))
+
+    def test_nearby_feed_orders_products_by_distance(self):
+        self.create_merchant('potsdam', 'Am Neuen Markt 1, Potsdam')
+        self.create_merchant('hamburg', 'Rathausmarkt 1, Hamburg')
+        self.create_merchant('tor', 'Brandenburger Tor, Berlin')
+        self.create_merchant('alex', 'Alexanderplatz 1, Berlin')
+
+        response = self.client.get(reverse('nearby_products'), {'lat': 52.5200, 'lng': 13.4050, 'radius': 30})
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([product['name'] for product in results], ['alex', 'tor', 'potsdam'])
+        self.assertAlmostEqual(results[0]['distance'], haversine_km(52.52, 13.405, *PLACES['Alexanderplatz 1, Berlin']),
+                               places=2)
+        self.assertLess(results[2]['distance'], 30)
+
+        response = self.client.get(reverse('nearby_products'),
+                                   {'lat': 52.5200, 'lng': 13.4050, 'radius': 30, 'page_size': 2, 'fields': 'name'})
+        self.assertEqual(response.data['results'], [{'name': 'alex'}, {'name': 'tor'}])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'], [{'name': 'potsdam'}])
+
+        response = self.client.get(reverse('nearby_products'), {'lat': 95, 'lng': 13.4})
+        self.assertEqual(response.status_code, 400)
+
+    def test_nearby_query_narrows_merchants_through_geohash_index(self):
+        plan = within_radius(Product.objects.all(), 52.52, 13.405, 10).explain()
+        self.assertIn('user_geohash_idx', plan)
+
+
+@skipIf(numpy is None or scipy is None, 'numpy and scipy are not installed')
+class RecommendationTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.products = self.create_products(5)
+        self.buyers = [User.objects.create_user(f'buyer{i}@ecofoods.test', 'buyer-pass') for i in range(4)]
+        p = self.products
+        Order.objects.place_order(self.buyers[0], {p[0].pk: 1, p[1].pk: 1})
+        Order.objects.place_order(self.buyers[1], {p[0].pk: 1, p[1].pk: 1, p[2].pk: 4})
+        Order.objects.place_order(self.buyers[2], {p[0].pk: 1})
+        # Disliked products are known to the user, and weigh nothing
+        Review.objects.create(product=p[3], merchant=self.buyers[2], rating=Decimal('1.0'), review_text='meh')
+
+    def recommendations(self):
+        return sorted(Recommendation.objects.values_list('user', 'rank', 'product', 'score'),
+                      key=lambda row: (str(row[0]), row[1]))
+
+    def get_recommended(self, user):
+        self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {user.token}')
+        return [row['name'] for row in self.client.get(reverse('recommended_products')).data['results']]
+
+    def test_recommendations_come_from_co_occurring_products(self):
+        out = StringIO()
+        call_command('compute_recommendations', '--workers=1', stdout=out)
+        self.assertIn('Recommended products to 2 of 3 users, from 4 products', out.getvalue())
+
+        names = [product.name for product in self.products]
+        self.assertEqual(self.get_recommended(self.buyers[2]), [names[1], names[2]])
+        self.assertEqual(self.get_recommended(self.buyers[0]), [names[2]])
+        # Nothing left to recommend, or no history at all: the most ordered products
+        self.assertEqual(self.get_recommended(self.buyers[1]), [names[0], names[1], names[2]])
+        self.assertEqual(self.get_recommended(self.buyers[3]), [names[0], names[1], names[2]])
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {self.buyers[2].token}')
+        self.client.get(reverse('recommended_products'))
+        # The user is in the JWT cache by now, which leaves the one lookup of the recommendations
+        with self.assertNumQueries(1):
+            self.client.get(reverse('recommended_products'), {'fields': 'uuid,name'})
+
+    def test_parallel_run_matches_single_process(self):
+        call_command('compute_recommendations', '--workers=1', stdout=StringIO())
+        single = self.recommendations()
+
+        Order.objects.place_order(self.buyers[0], {self.products[4].pk: 1})
+        Recommendation.objects.all().delete()
+        call_command('compute_recommendations', '--workers=1', stdout=StringIO())
+        expected = self.recommendations()
+        self.assertNotEqual(expected, single)
+
+        # Every run replaces the rows of the users it scores
+        call_command('compute_recommendations', '--workers=2', '--chunk-size=1', stdout=StringIO())
+        self.assertEqual(self.recommendations(), expected)
+
+    def test_users_without_history_lose_their_rows(self):
+        call_command('compute_recommendations', '--workers=1', stdout=StringIO())
+        self.assertTrue(Recommendation.objects.filter(user=self.buyers[2]).exists())
+
+        Order.objects.filter(user=self.buyers[2]).delete()
+        Review.objects.filter(merchant=self.buyers[2]).delete()
+        call_command('compute_recommendations', '--workers=1', stdout=StringIO())
+        self.assertFalse(Recommendation.objects.filter(user=self.buyers[2]).exists())
+        self.assertTrue(Recommendation.objects.filter(user=self.buyers[0]).exists())
+
+        Order.objects.all().delete()
+        call_command('compute_recommendations', '--workers=1', stdout=StringIO())
+        self.assertFalse(Recommendation.objects.exists())
+
+
+flaky_calls = []
+
+
+def record_flaky_failure(**kwargs):
+    flaky_calls.append(('gave up', kwargs))
+
+
+@task(name='tests.flaky', max_attempts=2, on_failure=record_flaky_failure)
+def flaky_task(fail, value):
+    flaky_calls.append(('ran', value))
+    if fail:
+        raise RuntimeError('temporarily unavailable')
+
+
+@override_settings(IMAGE_PIPELINE_ENABLED=True, GEOCODING_ENABLED=True)
+class TaskQueueTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        flaky_calls.clear()
+        # Leaves out the geocoding of the merchant's address from setUp
+        Task.objects.all().delete()
+
+    def run_tasks(self):
+        out = StringIO()
+        call_command('run_tasks', '--workers=1', '--once', stdout=out)
+        return out.getvalue()
+
+    def test_tasks_are_queued_with_the_write_and_deduplicated_by_key(self):
+        flaky_task.enqueue(key='once', fail=False, value=1)
+        flaky_task.enqueue(key='once', fail=False, value=2)
+        try:
+            with transaction.atomic():
+                flaky_task.enqueue(fail=False, value=3)
+                raise DatabaseError('rolled back')
+        except DatabaseError:
+            pass
+
+        self.assertIn('Ran 1 tasks', self.run_tasks())
+        self.assertEqual(flaky_calls, [('ran', 1)])
+        self.assertEqual(Task.objects.get().status, Task.STATUS_DONE)
+        # A done task keeps its key until it is purged
+        flaky_task.enqueue(key='once', fail=False, value=4)
+        self.assertIn('Ran 0 tasks', self.run_tasks())
+
+    def test_failed_tasks_are_retried_with_backoff(self):
+        flaky_task.enqueue(fail=True, value=1)
+        with self.assertLogs('api.tasks', 'WARNING'):
+            self.run_tasks()
+        queued = Task.objects.get()
+        self.assertEqual((queued.status, queued.attempts), (Task.STATUS_PENDING, 1))
+        self.assertIn('temporarily unavailable', queued.last_error)
+        self.assertGreater(queued.run_at, timezone.now())
+        self.assertIn('Ran 0 tasks', self.run_tasks())
+
+        Task.objects.update(run_at=timezone.now())
+        with self.assertLogs('api.tasks', 'WARNING'):
+            self.run_tasks()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Task.STATUS_FAILED, 2))
+        self.assertEqual(flaky_calls, [('ran', 1), ('ran', 1), ('gave up', {'fail': True, 'value': 1})])
+
+    def test_expired_leases_are_taken_over(self):
+        flaky_task.enqueue(fail=False, value=1)
+        worker = TaskWorker(workers=1, lease=60)
+        claimed = worker.claim(10)
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(TaskWorker(workers=1).claim(10), [])
+
+        Task.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertIn('Ran 1 tasks', self.run_tasks())
+        # The first worker's late result does not overwrite the second's
+        Task.objects.fail(claimed[0], 'late')
+        self.assertEqual(Task.objects.get().status, Task.STATUS_DONE)
+
+    @override_settings(GEOCODER='api.geo.OfflineGeocoder', GEOCODER_PLACES=PLACES)
+    def test_merchant_geocoding_runs_off_the_request_path(self):
+        response = self.client.patch(reverse('update_user'), {'address': 'Alexanderplatz 1, Berlin'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(User.objects.get(pk=self.merchant.pk).latitude)
+        self.assertEqual(Task.objects.get().name, 'api.geo.geocode_merchant')
+
+        self.run_tasks()
+        self.assertEqual(User.objects.get(pk=self.merchant.pk).latitude, PLACES['Alexanderplatz 1, Berlin'][0])
+
+
+@override_settings(DATABASE_REPLICAS=['replica_a', 'replica_b'])
+class ReplicaRouterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.router = PrimaryReplicaRouter()
+        replica_set.reset()
+        self.addCleanup(replica_set.reset)
+
+    def read(self):
+        with replica_reads():
+            alias = self.router.db_for_read(Product)
+            self.assertEqual(self.router.db_for_read(User), alias)
+            self.assertEqual(self.router.db_for_write(Product), 'default')
+            return alias
+
+    def test_requests_take_replicas_in_turn(self):
+        with mock.patch.object(replica_set, 'check', return_value=True):
+            self.assertEqual({self.read(), self.read()}, {'replica_a', 'replica_b'})
+        self.assertEqual(self.router.db_for_read(Product), 'default')
+        with override_settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(self.read(), 'default')
+
+    def test_unavailable_replicas_are_skipped(self):
+        databases = {alias: mock.Mock(in_atomic_block=False) for alias in ('default', 'replica_a', 'replica_b')}
+        databases['replica_a'].ensure_connection.side_effect = OperationalError('could not connect')
+        with mock.patch('api.routers.connections', databases), self.assertLogs('api.routers', 'WARNING'):
+            self.assertEqual([self.read() for _ in range(4)], ['replica_b'] * 4)
+            self.assertEqual(databases['replica_a'].ensure_connection.call_count, 1)
+
+            databases['replica_b'].ensure_connection.side_effect = OperationalError('could not connect')
+            self.assertEqual(self.read(), 'default')
+
+    def test_users_are_pinned_to_the_primary_after_writing(self):
+        writer = uuid.uuid4()
+        write_pins.pin(writer)
+        self.addCleanup(write_pins.cache.clear)
+        with mock.patch.object(replica_set, 'check', return_value=True), replica_reads():
+            identify_reader(uuid.uuid4().hex)
+            self.assertNotEqual(self.router.db_for_read(Product), 'default')
+            # As the token carries it
+            identify_reader(writer.hex)
+            self.assertEqual(self.router.db_for_read(Product), 'default')
+
+
+@skipUnless('replica' in settings.DATABASES, 'Run with --settings=EcoFoods.settings_replica')
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        jwt_cache.clear()
+        home_feed_cache.cache.clear()
+        write_pins.cache.clear()
+        self.merchant = User.objects.create_user('merchant@ecofoods.test', 'merchant-pass', is_merchant=True)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'EcoFoods {self.merchant.token}')
+
+    def replica_queries(self, method, path, data=None):
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = getattr(self.client, method)(path, data, format='json')
+        self.assertLess(response.status_code, 400)
+        return len(queries)
+
+    def test_reads_go_to_the_replica_until_the_user_writes(self):
+        self.assertGreater(self.replica_queries('get', reverse('merchant_products')), 0)
+        self.assertEqual(self.replica_queries('patch', reverse('update_user'), {'first_name': 'Anna'}), 0)
+        self.assertEqual(self.replica_queries('get', reverse('merchant_products')), 0)
+
+        write_pins.cache.clear()
+        self.assertGreater(self.replica_queries('get', reverse('merchant_products')), 0)
+
+    def test_feed_read_from_replica_right_after_a_write_is_not_cached(self):
+        home_feed_cache.invalidate()
+        self.assertGreater(self.replica_queries('get', reverse('homepage')), 0)
+        self.assertGreater(self.replica_queries('get', reverse('homepage')), 0)
+
+        with override_settings(DATABASE_REPLICA_PIN_SECONDS=0):
+            self.replica_queries('get', reverse('homepage'))
+        self.assertEqual(self.replica_queries('get', reverse('homepage')), 0)
+
+
+class CategoryAPIViewTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.fruit = Category.objects.create(name='Fruit', image=Image.objects.create_image('https://cdn.test/f.jpg'))
+        self.dairy = Category.objects.create(name='Dairy', image=Image.objects.create_image('https://cdn.test/d.jpg'))
+
+    def test_product_links_are_created_with_the_product(self):
+        response = self.client.post(reverse('merchant_add_product'), {
+            'name': 'Apples', 'price': '1.50', 'units': 'kg', 'img': 'https://cdn.test/a.jpg',
+            'categories': [str(self.fruit.uuid), str(self.dairy.uuid)],
+        }, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(ProductCategory.objects.filter(product__name='Apples').count(), 2)
+
+        response = self.client.post(reverse('merchant_add_product'), {
+            'name': 'Pears', 'price': '1.50', 'units': 'kg', 'img': 'https://cdn.test/p.jpg',
+            'categories': [str(uuid.uuid4())],
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_category_list_uses_stored_counts(self):
+        rows = [
+            {'name': f'Fruit {i}', 'price': '1.00', 'units': 'kg', 'description': 'Fresh',
+             'img': 'https://cdn.test/i.jpg', 'categories': [str(self.fruit.uuid)]}
+            for i in range(3)
+        ]
+        self.client.post(reverse('merchant_import_products'), rows, format='json')
+        ProductCategory.objects.create(product=Product.objects.get(name='Fruit 1'), category=self.dairy)
+        Product.objects.filter(name='Fruit 0').delete()
+
+        # auth user lookup, categories joined with their images
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('categories'))
+
+        self.assertEqual([(c['name'], c['product_count']) for c in response.data], [('Dairy', 1), ('Fruit', 2)])
+        self.assertEqual(response.data[0]['image']['url'], 'https://cdn.test/d.jpg')
+
+    def test_category_products(self):
+        apples, pears = self.create_products(2)
+        ProductCategory.objects.create_links([(apples, self.fruit.pk), (pears, self.dairy.pk)])
+
+        response = self.client.get(reverse('category_products', kwargs={'category_uuid': self.fruit.uuid}))
+
+        self.assertEqual([p['uuid'] for p in response.data['results']], [str(apples.uuid)])
+
+
+class ProductSearchAPIViewTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.honey = Product.objects.create_product_from_merchant(
+            self.merchant, name='Wildflower honey', price='8.00', units='jar', description='Raw and unfiltered')
+        self.tea = Product.objects.create_product_from_merchant(
+            self.merchant, name='Herbal tea', price='4.00', units='box', description='Best with honey',
+            is_featured=True)
+        self.cheese = Product.objects.create_product_from_merchant(
+            self.merchant, name='Goat cheese', price='6.00', units='kg', description='Soft')
+
+    def search(self, **params):
+        response = self.client.get(reverse('product_search'), params)
+        self.assertEqual(response.status_code, 200)
+        return [p['name'] for p in response.data['results']]
+
+    def test_name_matches_rank_first_and_prefixes_match(self):
+        self.assertEqual(self.search(q='honey'), ['Wildflower honey', 'Herbal tea'])
+        self.assertEqual(self.search(q='hon'), ['Wildflower honey', 'Herbal tea'])
+        self.assertEqual(self.search(q='goat soft'), ['Goat cheese'])
+
+    def test_filters(self):
+        self.assertEqual(self.search(q='honey', price_max='5'), ['Herbal tea'])
+        self.assertEqual(self.search(q='honey', is_featured='false'), ['Wildflower honey'])
+
+        fruit = Category.objects.create(name='Sweet', image=Image.objects.create_image('https://cdn.test/s.jpg'))
+        ProductCategory.objects.create(product=self.honey, category=fruit)
+        self.assertEqual(self.search(q='honey', category=str(fruit.uuid)), ['Wildflower honey'])
+
+    def test_index_follows_writes(self):
+        self.cheese.name = 'Sheep cheese'
+        self.cheese.save()
+        self.honey.delete()
+
+        self.assertEqual(self.search(q='goat'), [])
+        self.assertEqual(self.search(q='sheep'), ['Sheep cheese'])
+        self.assertEqual(self.search(q='honey'), ['Herbal tea'])
+
+        self.client.post(reverse('merchant_import_products'), [{
+            'name': 'Acacia honey', 'price': '9.00', 'units': 'jar', 'description': 'Clear',
+            'img': 'https://cdn.test/h.jpg',
+        }], format='json')
+        self.assertEqual(self.search(q='acacia'), ['Acacia honey'])
+
+
+@override_settings(PERFORMANCE_SAMPLE_RATE=1.0, PERFORMANCE_DUPLICATE_QUERY_THRESHOLD=3)
+class PerformanceMiddlewareTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics_registry.clear()
+
+    def test_server_timing_and_log_record(self):
+        self.create_products(2)
+
+        with self.assertLogs('api.performance', level='INFO') as logs:
+            response = self.client.get(reverse('merchant_products'))
+
+        self.assertIn('total;dur=', response['Server-Timing'])
+        self.assertIn('db;dur=', response['Server-Timing'])
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['view'], 'merchant_products')
+        # auth user lookup, products, product images (none, so no image query)
+        self.assertEqual(record['queries'], 3)
+        self.assertGreater(record['serializer_ms'], 0)
+        self.assertEqual(record['response_bytes'], len(response.content))
+
+    def test_repeated_queries_are_flagged(self):
+        products = self.create_products(3)
+
+        def lookup_each_product(request):
+            for product in products:
+                Product.objects.get(pk=product.pk)
+            return HttpResponse()
+
+        with mock.patch.object(MerchantProductsAPIView, 'retrieve', lambda self, request: lookup_each_product(request)),\
+                self.assertLogs('api.performance', level='WARNING') as logs:
+            self.client.get(reverse('merchant_products'))
+
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['duplicate_queries'], 2)
+        self.assertEqual(record['repeated_queries'][0]['count'], 3)
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('categories'))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+
+        User.objects.filter(pk=self.merchant.pk).update(is_superuser=True)
+        jwt_cache.clear()
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ecofoods_request_wall_ms_count{view="categories"} 1', response.content.decode())
+
+
+class BenchmarkTests(TestCase):
+
+    def test_benchmark_runs_against_synthetic_dataset(self):
+        dataset = SyntheticDataset(users=3, merchants=2, products=20, reviews=10, chats=2, messages_per_chat=3).load()
+
+        results = run_benchmarks(dataset, iterations=2, warmup=1)
+
+        self.assertEqual(Product.objects.count(), 20 + 3)  # warmup + iterations of 'add product'
+        for name, result in results.items():
+            self.assertEqual(set(result['statuses']) - {200, 201}, set(), name)
+        self.assertEqual(results['home (cached)']['queries'], 0)
+
+    def test_check_budgets(self):
+        results = {'home': {'queries': 3, 'p95_ms': 12.0}, 'login': {'queries': 1, 'p95_ms': 190.0},
+                   'cached': {'queries': 0, 'p95_ms': 4.0}}
+        budgets = {'home': {'queries': 2, 'p95_ms': 10.0}, 'login': {'queries': 1, 'p95_ms': 100.0},
+                   'cached': {'queries': 0, 'p95_ms': 0.5}}
+
+        # 8x slower, but within the floor
+        self.assertEqual(check_budgets(results, budgets),
+                         (['home: 3 queries, budget 2'], ['login: p95 190.0 ms, budget 100.0 ms']))
+        self.assertEqual(check_budgets(results, budgets, latency_tolerance=2.0), (['home: 3 queries, budget 2'], []))
+
+
+@override_settings(IMAGE_PIPELINE_ENABLED=False)
+class AsyncViewTests(TransactionTestCase):
+
+    def setUp(self):
+        jwt_cache.clear()
+        home_feed_cache.cache.clear()
+        self.merchant = User.objects.create_user('merchant@ecofoods.test', 'merchant-pass', is_merchant=True)
+        self.buyer = User.objects.create_user('buyer@ecofoods.test', 'buyer-pass')
+        self.chat = Chat.objects.create(user=self.buyer, merchant=self.merchant)
+        Message.objects.create(chat=self.chat, sender=self.buyer, text='Hi')
+        product = Product.objects.create_product_from_merchant(
+            self.merchant, name='Apples', price='1.50', units='kg', description='Red')
+        ProductImage.objects.create_link(Image.objects.create_image('https://cdn.test/a.jpg'), product)
+        self.auth = {'HTTP_AUTHORIZATION': f'EcoFoods {self.merchant.token}'}
+        # Django 3.1's AsyncClient takes raw ASGI headers
+        self.async_auth = {'headers': [(b'host', b'testserver'),
+                                       (b'authorization', f'EcoFoods {self.merchant.token}'.encode())]}
+
+    @async_to_sync
+    async def test_async_views_match_sync_views(self):
+        client = AsyncClient()
+        for sync_name, async_name, kwargs in [
+            ('homepage', 'async_homepage', {}),
+            ('merchant_products', 'async_merchant_products', {}),
+            ('chat_messages', 'async_chat_messages', {'chat_uuid': self.chat.uuid}),
+        ]:
+            expected = await sync_to_async(self.client.get)(reverse(sync_name, kwargs=kwargs), **self.auth)
+            response = await client.get(reverse(async_name, kwargs=kwargs), **self.async_auth)
+
+            self.assertEqual(response.status_code, 200, async_name)
+            self.assertEqual(response.json(), expected.json(), async_name)
+
+    @async_to_sync
+    async def test_async_views_authenticate(self):
+        response = await AsyncClient().get(reverse('async_merchant_products'))
+        self.assertEqual(response.status_code, 403)
+
+        response = await AsyncClient().post(reverse('async_chat_messages', kwargs={'chat_uuid': self.chat.uuid}),
+                                            **self.async_auth)
+        self.assertEqual(response.status_code, 405)
+
+
+class QueryPlanTests(APITestCase):
+
+    def assertUsesIndex(self, queryset, index_name):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Tiny test tables would otherwise always be sequentially scanned.
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def test_product_queries_use_indexes(self):
+        self.assertUsesIndex(Product.objects.order_by('-created_at', 'uuid')[:50], 'product_feed_idx')
+        self.assertUsesIndex(Product.objects.filter(is_featured=True).order_by('-created_at')[:20],
+                             'product_featured_idx')
+        self.assertUsesIndex(Product.objects.filter(merchant=self.merchant).order_by('-created_at'),
+                             'product_merchant_idx')
+
+    def test_related_listing_queries_use_indexes(self):
+        chat = Chat.objects.create(user=self.merchant, merchant=self.merchant)
+        product = self.create_products(1)[0]
+
+        self.assertUsesIndex(Message.objects.filter(chat=chat).order_by('send_date'), 'message_chat_idx')
+        self.assertUsesIndex(Review.objects.filter(product=product).order_by('created_at'), 'review_product_idx')
+        self.assertUsesIndex(Order.objects.filter(user=self.merchant).order_by('created_at'), 'order_user_idx')
+        self.assertUsesIndex(ProductCategory.objects.filter(category_id=uuid.uuid4()).values('product'),
+                             'productcategory_category_idx')
@@ -0,0 +1,104 @@
+import threading
+import time
+
+from django.conf import settings
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from .utils import LRUCache
+
+
+class TokenBucket:
+
+    def __init__(self, capacity, refill_per_second, now):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = now
+        self.lock = threading.Lock()
+
+    def take(self, now):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def wait(self):
+        return (1 - self.tokens) / self.refill_per_second
+
+
+class TokenBucketThrottle(BaseThrottle):
+    # In-process token bucket: ``capacity`` attempts in a burst, refilled over ``period`` seconds.
+    # Buckets live in a bounded LRU and are dropped once they would have refilled completely.
+    scope = None
+    default_rate = (10, 60)
+    buckets = None
+    buckets_lock = threading.Lock()
+
+    def __init__(self):
+        self.bucket = None
+
+    def get_rate(self):
+        return getattr(settings, 'LOGIN_THROTTLE_RATES', {}).get(self.scope, self.default_rate)
+
+    @classmethod
+    def get_buckets(cls, ttl):
+        with cls.buckets_lock:
+            if cls.buckets is None:
+                cls.buckets = LRUCache(getattr(settings, 'LOGIN_THROTTLE_MAX_KEYS', 100000), ttl)
+            return cls.buckets
+
+    @classmethod
+    def clear(cls):
+        with cls.buckets_lock:
+            cls.buckets = None
+
+    def get_key(self, request, view):
+        raise NotImplementedError('.get_key() must be overridden')
+
+    def allow_request(self, request, view):
+        key = self.get_key(request, view)
+        if key is None:
+            return True
+
+        capacity, period = self.get_rate()
+        buckets = self.get_buckets(period)
+        now = time.monotonic()
+        with self.buckets_lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(capacity, capacity / period, now)
+            # Re-setting refreshes the TTL: an idle bucket expires exactly when it would be full.
+            buckets.set(key, bucket)
+
+        self.bucket = bucket
+        return bucket.take(now)
+
+    def wait(self):
+        return self.bucket.wait() if self.bucket is not None else None
+
+
+class LoginIPThrottle(TokenBucketThrottle):
+    scope = 'ip'
+    default_rate = (30, 60)
+    buckets = None
+
+    def get_key(self, request, view):
+        # X-Forwarded-For is whatever the client sent unless NUM_PROXIES says how many of its
+        # entries were added by our own proxies.
+        if api_settings.NUM_PROXIES is None:
+            return request.META.get('REMOTE_ADDR')
+        return self.get_ident(request)
+
+
+class LoginEmailThrottle(TokenBucketThrottle):
+    scope = 'email'
+    default_rate = (5, 60)
+    buckets = None
+
+    def get_key(self, request, view):
+        email = request.data.get('email') if hasattr(request.data, 'get') else None
+        return email.strip().lower() if isinstance(email, str) else None
@@ -0,0 +1,23 @@
+# Kept free of Django imports: these functions run in worker processes started with
+# the ``spawn`` method, which import this module from scratch.
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+
+def render_variants(data, sizes, quality=85):
+    """Resize an encoded image to every ``{name: (width, height)}`` box, returning JPEG bytes per name."""
+    with Image.open(BytesIO(data)) as original:
+        original.load()
+        source = ImageOps.exif_transpose(original)
+        if source.mode != 'RGB':
+            source = source.convert('RGB')
+
+    variants = {}
+    for name, size in sizes.items():
+        variant = source.copy()
+        variant.thumbnail(tuple(size), Image.LANCZOS)
+        buffer = BytesIO()
+        variant.save(buffer, format='JPEG', quality=quality, optimize=True)
+        variants[name] = buffer.getvalue()
+    return variants
@@ -1,5 +1,8 @@
 import json
-from typing import Any
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Tuple
 from uuid import UUID
 
 
@@ -8,3 +11,73 @@ class UUIDEncoder(json.JSONEncoder):
         if isinstance(o, UUID):
             return o.hex
         return json.JSONEncoder.default(self, o)
+
+
+class LRUCache:
+    # Entries can carry a tag (JWTCache tags tokens with their user), so all entries of a tag are
+    # dropped without scanning the cache. The tag index follows evictions and expiries.
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._tags = {}
+        self._tagged = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                self._discard(key)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, tag: Optional[Hashable] = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._untag(key)
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            if tag is not None:
+                self._tags[key] = tag
+                self._tagged.setdefault(tag, set()).add(key)
+            while len(self._data) > self.max_size:
+                self._discard(next(iter(self._data)))
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._discard(key)
+
+    def delete_tag(self, tag: Hashable) -> None:
+        with self._lock:
+            for key in list(self._tagged.get(tag, ())):
+                self._discard(key)
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        with self._lock:
+            return [(key, value) for key, (expires_at, value) in self._data.items()]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+            self._tagged.clear()
+
+    def _discard(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+        self._untag(key)
+
+    def _untag(self, key: Hashable) -> None:
+        tag = self._tags.pop(key, None)
+        if tag is not None:
+            keys = self._tagged[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tagged[tag]
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -1,12 +1,38 @@
+from collections.abc import Iterable
+from datetime import timedelta
+from decimal import Decimal
+from uuid import UUID
+
+from django.db import transaction, DatabaseError
+from django.db.models import Sum
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from rest_framework import status
+from rest_framework.parsers import JSONParser, FormParser, MultiPartParser
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import ViewSet
 
 from .serializers import LoginSerializer, RegistrationSerializer, ProductSerializer,\
-    UpdateUserSerializer, HomeViewSerializer, ProductSerializerForMerchant
-from .models import Product
+    UpdateUserSerializer, HomeViewSerializer, ProductSerializerForMerchant, ProductImportSerializer, \
+    MessageSerializer, OrderSerializer, CategorySerializer, ProductSearchSerializer, ImageSerializer, \
+    ImageUploadSerializer, DashboardQuerySerializer, DashboardStatsSerializer, DashboardDaySerializer, \
+    DashboardProductSerializer, ExportQuerySerializer, NearbyProductSerializer, NearbyQuerySerializer
+from .models import Product, Chat, Message, Category, Image, ProductDailyStats, MerchantOrderStats
+from .pagination import MessageKeysetPagination, ProductCursorPagination, RankedPagination, HomeFeedPagination, \
+    NearbyPagination
+from .search import get_product_search, tokenize
+from .parsers import NDJSONParser, CSVParser
+from .loaders import HomeFeedLoader
+from .flat import FlatProductSerializer, FlatMerchantProductSerializer, FlatNearbyProductSerializer
+from .geo import within_radius
+from .exports import exports, EXPORT_FORMATS
+from .cache import home_feed_cache
+from .instrumentation import metrics_registry
+from .permissions import IsSuperUser
+from .throttling import LoginIPThrottle, LoginEmailThrottle
 
 
 class RegistrationAPIView(APIView):
@@ -43,12 +69,13 @@ class UpdateUserAPIView(APIView):
 class MerchantProductsAPIView(ViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = ProductSerializerForMerchant
+    flat_serializer_class = FlatMerchantProductSerializer
 
     def retrieve(self, request):
-        products = Product.objects.all().filter(merchant=self.request.user)
-        product_serializer = self.serializer_class(products, many=True)
+        product_serializer = self.flat_serializer_class(fields=self.serializer_class.fields_from_request(request))
+        products = Product.objects.filter(merchant=self.request.user).order_by('-created_at')
         return Response(
-            product_serializer.data,
+            product_serializer.serialize(product_serializer.values(products)),
             status=status.HTTP_200_OK
         )
 
@@ -57,23 +84,85 @@ class HomePageAPIView(ViewSet):
     product_queryset = Product.objects.all()
     permission_classes = [IsAuthenticated]
     serializer_class = HomeViewSerializer
+    flat_serializer_class = FlatProductSerializer
+    nearby_query_serializer_class = NearbyQuerySerializer
+    nearby_serializer_class = NearbyProductSerializer
+    flat_nearby_serializer_class = FlatNearbyProductSerializer
+    nearby_pagination_class = NearbyPagination
+    cacheable_formats = ('json',)
 
     def retrieve(self, request):
+        if request.accepted_renderer.format not in self.cacheable_formats:
+            return self.get_feed(request)
+
+        entry = home_feed_cache.get(request)
+        if entry is None:
+            response = self.get_feed(request)
+            response.accepted_renderer = request.accepted_renderer
+            response.accepted_media_type = request.accepted_media_type
+            response.renderer_context = self.get_renderer_context()
+            response.render()
+            entry = home_feed_cache.set(request, response)
+
+        if entry['etag'] in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(entry['content'], content_type=entry['content_type'])
+        response['ETag'] = entry['etag']
+        return response
+
+    def get_feed(self, request):
         res_dict = {}
-        announcements = self.product_queryset
-        announcements_serializer = self.serializer_class(announcements, many=True)
-        advertisings = self.product_queryset.filter(is_featured=True)
-        advertisings_serializer = self.serializer_class(advertisings, many=True)
-        res_dict['announcements'] = announcements_serializer.data
-        res_dict['advertisings'] = advertisings_serializer.data
+        product_serializer = self.flat_serializer_class(fields=self.serializer_class.fields_from_request(request))
+        # The cursor pagination reads its ordering columns from the last product of the page.
+        ordering = [name.lstrip('-') for name in HomeFeedPagination.ordering]
+        loader = HomeFeedLoader(product_serializer.values(self.product_queryset.all(), *ordering))
+        announcements, advertisings = loader.load(request, view=self)
+        res_dict['next'] = loader.paginator.get_next_link()
+        res_dict['previous'] = loader.paginator.get_previous_link()
+        res_dict['announcements'] = product_serializer.serialize(announcements)
+        res_dict['advertisings'] = product_serializer.serialize(advertisings)
         return Response(
             res_dict,
             status=status.HTTP_200_OK
         )
 
+    def recommended(self, request):
+        # The user's precomputed recommendations, or the popular products when there are none.
+        # Not cached: unlike the feed, the answer is per user, and it is one indexed lookup anyway.
+        product_serializer = self.flat_serializer_class(fields=self.serializer_class.fields_from_request(request))
+        rows = product_serializer.serialize(product_serializer.values(
+            self.product_queryset.filter(recommendations__user=request.user).order_by('recommendations__rank')))
+        if not rows:
+            rows = product_serializer.serialize(product_serializer.values(
+                # rank__isnull=False keeps the join an inner one, products without any rows do not match.
+                self.product_queryset.filter(recommendations__user__isnull=True, recommendations__rank__isnull=False)
+                .order_by('recommendations__rank')))
+        return Response(
+            {
+                'results': rows,
+            },
+            status=status.HTTP_200_OK
+        )
+
+    def nearby(self, request):
+        # Products of the merchants within ``radius`` km of (lat, lng), nearest first
+        query_serializer = self.nearby_query_serializer_class(data=request.query_params.dict())
+        query_serializer.is_valid(raise_exception=True)
+        params = query_serializer.validated_data
+
+        product_serializer = self.flat_nearby_serializer_class(
+            fields=self.nearby_serializer_class.fields_from_request(request))
+        paginator = self.nearby_pagination_class()
+        ordering = [name.lstrip('-') for name in paginator.ordering]
+        products = within_radius(self.product_queryset.all(), params['lat'], params['lng'], params['radius'])
+        page = paginator.paginate_queryset(product_serializer.values(products, *ordering), request, view=self)
+        return paginator.get_paginated_response(product_serializer.serialize(page))
+
 
 class LoginAPIView(APIView):
     permission_classes = [AllowAny]
+    throttle_classes = [LoginIPThrottle, LoginEmailThrottle]
     serializer_class = LoginSerializer
 
     def post(self, request):
@@ -99,3 +188,282 @@ class ProductAPIView(APIView):
             },
             status=status.HTTP_201_CREATED,
         )
+
+
+class ImageUploadAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser, FormParser]
+    serializer_class = ImageSerializer
+    upload_serializer_class = ImageUploadSerializer
+
+    def post(self, request):
+        upload_serializer = self.upload_serializer_class(data=request.data)
+        upload_serializer.is_valid(raise_exception=True)
+        try:
+            image, created = Image.objects.create_from_upload(upload_serializer.validated_data['file'])
+        except ValueError as exc:
+            return Response({'file': [str(exc)]}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            self.serializer_class(image).data,
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK,
+        )
+
+
+class ProductImportAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = [JSONParser, NDJSONParser, CSVParser]
+    serializer_class = ProductImportSerializer
+    chunk_size = 500
+
+    def post(self, request):
+        rows = request.data
+        if isinstance(rows, dict):
+            rows = [rows]
+        # A list from JSON, an iterator of rows from the NDJSON and CSV parsers
+        elif isinstance(rows, (str, bytes)) or not isinstance(rows, Iterable):
+            return Response(
+                {'detail': 'Expected a product or a list of products.'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        created = 0
+        errors = []
+        chunk = []
+        for index, row in enumerate(rows):
+            chunk.append((index, row))
+            if len(chunk) >= self.chunk_size:
+                created += self._import_chunk(request.user, chunk, errors)
+                chunk = []
+
+        if chunk:
+            created += self._import_chunk(request.user, chunk, errors)
+
+        # bulk_create does not send post_save, so the feed cache is dropped here.
+        if created:
+            home_feed_cache.invalidate()
+
+        errors.sort(key=lambda error: error['row'])
+        return Response(
+            {
+                'created': created,
+                'errors': errors,
+            },
+            status=status.HTTP_201_CREATED if created or not errors else status.HTTP_400_BAD_REQUEST,
+        )
+
+    def _import_chunk(self, user, rows, errors):
+        context = {'known_categories': self._known_categories(row for _, row in rows)}
+        chunk = []
+        for index, row in rows:
+            serializer = self.serializer_class(data=row, context=context)
+            if not serializer.is_valid():
+                errors.append({'row': index, 'errors': serializer.errors})
+                continue
+
+            fields = dict(serializer.validated_data)
+            chunk.append((index, fields.pop('img'), fields.pop('categories', []), fields))
+
+        return self._save_chunk(user, chunk, errors) if chunk else 0
+
+    @staticmethod
+    def _known_categories(rows):
+        # The categories named anywhere in the chunk, in one query. Malformed ids are left to the
+        # serializer to report.
+        category_ids = set()
+        for row in rows:
+            values = row.get('categories') if isinstance(row, dict) else None
+            for value in values if isinstance(values, list) else ():
+                try:
+                    category_ids.add(UUID(str(value)))
+                except ValueError:
+                    pass
+        if not category_ids:
+            return set()
+        return set(Category.objects.filter(pk__in=category_ids).values_list('pk', flat=True))
+
+    @staticmethod
+    def _save_chunk(user, chunk, errors):
+        try:
+            with transaction.atomic():
+                products = Product.objects.bulk_create_from_merchant(user, [row for _, *row in chunk])
+                # bulk_create does not send post_save
+                get_product_search().index_products(products, created=True)
+        except DatabaseError as e:
+            errors.extend({'row': index, 'errors': {'non_field_errors': [str(e)]}} for index, *_ in chunk)
+            return 0
+
+        return len(chunk)
+
+
+class ChatMessagesAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = MessageSerializer
+    pagination_class = MessageKeysetPagination
+
+    def get_chat(self, request, chat_uuid):
+        return get_object_or_404(Chat.objects.for_participant(request.user), uuid=chat_uuid)
+
+    def get(self, request, chat_uuid):
+        chat = self.get_chat(request, chat_uuid)
+        paginator = self.pagination_class()
+        messages = paginator.paginate_queryset(Message.objects.filter(chat=chat), request)
+        return paginator.get_paginated_response(self.serializer_class(messages, many=True).data)
+
+    def post(self, request, chat_uuid):
+        chat = self.get_chat(request, chat_uuid)
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save(chat=chat, sender=request.user)
+        return Response(
+            serializer.data,
+            status=status.HTTP_201_CREATED,
+        )
+
+
+class OrderAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = OrderSerializer
+
+    def post(self, request):
+        serializer = self.serializer_class(context={'request': request}, data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+        return Response(
+            serializer.data,
+            status=status.HTTP_201_CREATED,
+        )
+
+
+class CategoryAPIView(ViewSet):
+    permission_classes = [IsAuthenticated]
+    serializer_class = CategorySerializer
+    product_serializer_class = HomeViewSerializer
+    flat_product_serializer_class = FlatProductSerializer
+    pagination_class = ProductCursorPagination
+
+    def list(self, request):
+        categories = Category.objects.select_related('image').order_by('name')
+        return Response(
+            self.serializer_class(categories, many=True).data,
+            status=status.HTTP_200_OK
+        )
+
+    def products(self, request, category_uuid):
+        category = get_object_or_404(Category, uuid=category_uuid)
+        product_serializer = self.flat_product_serializer_class(
+            fields=self.product_serializer_class.fields_from_request(request))
+        paginator = self.pagination_class()
+        ordering = [name.lstrip('-') for name in paginator.ordering]
+        products = product_serializer.values(Product.objects.filter(productcategory__category=category), *ordering)
+        page = paginator.paginate_queryset(products, request, view=self)
+        return paginator.get_paginated_response(product_serializer.serialize(page))
+
+
+class MerchantDashboardAPIView(APIView):
+    # Reads only the rollup tables, see ProductDailyStats and MerchantOrderStats
+    permission_classes = [IsAuthenticated]
+    query_serializer_class = DashboardQuerySerializer
+    day_serializer_class = DashboardDaySerializer
+    product_serializer_class = DashboardProductSerializer
+    stats_serializer_class = DashboardStatsSerializer
+
+    def get(self, request):
+        query_serializer = self.query_serializer_class(data=request.query_params.dict())
+        query_serializer.is_valid(raise_exception=True)
+        params = query_serializer.validated_data
+
+        last_day = timezone.localdate()
+        first_day = last_day - timedelta(days=params['days'] - 1)
+        stats = ProductDailyStats.objects.filter(merchant=request.user, day__range=(first_day, last_day))
+        sums = {name: Sum(name) for name in ('units_sold', 'revenue', 'review_count', 'rating_sum')}
+
+        empty = {'orders': 0, 'units_sold': 0, 'revenue': Decimal(0), 'review_count': 0, 'rating_sum': Decimal(0)}
+        days = {first_day + timedelta(days=i): dict(empty, day=first_day + timedelta(days=i))
+                for i in range(params['days'])}
+        for row in stats.values('day').annotate(**sums).order_by():
+            days[row['day']].update(row)
+
+        # A day's orders come from the status counts: an order holding several of the merchant's
+        # products is counted once there, but once per product in ProductDailyStats.
+        order_statuses = {}
+        orders = MerchantOrderStats.objects.filter(merchant=request.user, day__range=(first_day, last_day))
+        for row in orders.values('day', 'status').annotate(count=Sum('orders')).order_by():
+            days[row['day']]['orders'] += row['count']
+            order_statuses[row['status']] = order_statuses.get(row['status'], 0) + row['count']
+
+        totals = dict(empty)
+        for day in days.values():
+            for name in totals:
+                totals[name] += day[name]
+
+        products = stats.values('product', 'product__name').annotate(orders=Sum('orders'), **sums)\
+            .order_by('-revenue', 'product')[:params['top']]
+
+        return Response(
+            {
+                'from': first_day,
+                'to': last_day,
+                'totals': self.stats_serializer_class(totals).data,
+                'order_statuses': {name: count for name, count in sorted(order_statuses.items()) if count},
+                'days': self.day_serializer_class(days.values(), many=True).data,
+                'products': self.product_serializer_class(products, many=True).data,
+            },
+            status=status.HTTP_200_OK
+        )
+
+
+class ExportAPIView(APIView):
+    # Full or incremental (?since=) dumps, streamed a chunk of rows at a time, see api.exports
+    # (under ASGI, api.streams.ExportStreamApplication serves these URLs instead)
+    permission_classes = [IsSuperUser]
+    query_serializer_class = ExportQuerySerializer
+
+    def get(self, request, dataset, export_format):
+        query_serializer = self.query_serializer_class(data=request.query_params.dict())
+        query_serializer.is_valid(raise_exception=True)
+
+        export = exports[dataset](since=query_serializer.validated_data.get('since'))
+        _, content_type = EXPORT_FORMATS[export_format]
+        response = StreamingHttpResponse(export.stream(export_format), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{dataset}.{export_format}"'
+        return response
+
+
+class ProductSearchAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = HomeViewSerializer
+    query_serializer_class = ProductSearchSerializer
+    pagination_class = RankedPagination
+
+    def get(self, request):
+        query_serializer = self.query_serializer_class(data=request.query_params.dict())
+        query_serializer.is_valid(raise_exception=True)
+        params = query_serializer.validated_data
+
+        terms = tokenize(params['q'])
+        if not terms:
+            return Response({'next': None, 'results': []}, status=status.HTTP_200_OK)
+
+        products = Product.objects.select_related('merchant')
+        if 'price_min' in params:
+            products = products.filter(price__gte=params['price_min'])
+        if 'price_max' in params:
+            products = products.filter(price__lte=params['price_max'])
+        if 'is_featured' in params:
+            products = products.filter(is_featured=params['is_featured'])
+        if 'category' in params:
+            products = products.filter(productcategory__category=params['category'])
+
+        products = get_product_search().search(products, terms)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(products, request)
+        return paginator.get_paginated_response(self.serializer_class(page, many=True).data)
+
+
+class MetricsAPIView(APIView):
+    permission_classes = [IsSuperUser]
+
+    def get(self, request):
+        return HttpResponse(metrics_registry.render(), content_type='text/plain; version=0.0.4')